@@ -1,35 +1,95 @@
-from dataclasses import dataclass
-from functools import partial
+from dataclasses import dataclass, field
+import io
 
-from . import bkmk_json, xbel, chrome_json, netscape_html
 from .base import *
+from .columnar import ColumnarTree
+from .index import TreeIndex, hasher
+from . import merge as _merge
+from .merge import DEDUP_KEYS, MERGE_STRATEGIES
+from . import diff as _diff
+from .diff import Patch
+from .cache import ReadCache
+from . import compression as _compression
+from .compression import COMPRESSIONS
+from .icons import IconPool, icon_data, icon_refcounts
+from .formats import Format, FormatsView, FormatExtsView, REGISTRY as _REGISTRY, register_format
 
-FORMAT_EXTS = {
-    ".xbel": ["xbel"],
-    ".html": ["netscape-html"],
-    ".bkmk.json": ["bkmk-json"],
-    ".json": ["chrome-json", "bkmk-json"],
-}
+"""Map from each extension to the formats using it, best first; derived from the format registry"""
+FORMAT_EXTS = FormatExtsView()
 
-FORMATS = {
-    "bkmk-json": "bkmk JSON - own custom format, easiest for scripting with jq(1)",
-    "xbel": "XML Bookmark Exchange Language 1.0",
-    "netscape-html": "NETSCAPE Bookmark file 1 - supported by most browsers including Firefox and Chrome",
-    "chrome-json": "Chrome Bookmarks JSON - used internally by Chrome",
-}
+"""Map from each format to its description; derived from the format registry"""
+FORMATS = FormatsView()
+
+# the format modules are only imported when a format is used; this keeps
+# e.g. bkmk.xbel working without importing it first
+_FORMAT_MODULES = ("bkmk_json", "bkmk_bin", "xbel", "chrome_json", "netscape_html")
+
+def __getattr__(name):
+    if name in _FORMAT_MODULES:
+        import importlib
+        return importlib.import_module("." + name, __name__)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
 
 def guess_format(name, verbose=False):
-    fmt = None
-    for ext, fmts in FORMAT_EXTS.items():
-        if name.endswith(ext):
-            fmt = fmts[0]
-            if len(fmts) > 1 and verbose:
-                log("note: guessing format %s for *%s; possible others are: %s" % (fmt, ext, ", ".join(fmts[1:])))
-            break
-    if fmt is not None:
-        return fmt
-    else:
+    """Guess the format of a file from its extension, after any compression extensions like .gz"""
+    (ext, fmts) = _REGISTRY.guess(_compression.split_ext(name)[0])
+    if not fmts:
         raise ValueError("could not guess format of %s" % name)
+    if len(fmts) > 1 and verbose:
+        log("note: guessing format %s for *%s; possible others are: %s" % (fmts[0], ext, ", ".join(fmts[1:])))
+    return fmts[0]
+
+def format_ext(fmt):
+    """The file extension to use for fmt, the inverse of guess_format"""
+    exts = _REGISTRY.get(fmt).exts
+    if not exts:
+        raise ValueError("format has no file extension: %s" % fmt)
+    return exts[0]
+
+def _format_module(fmt):
+    return _REGISTRY.module(fmt)
+
+def is_binary(fmt):
+    """Whether fmt is read and written as bytes, from and to files opened in binary mode"""
+    return _REGISTRY.get(fmt).binary
+
+def reads_bytes(fmt):
+    """Whether fmt can be read from a binary file or an mmap, decoding it itself"""
+    f = _REGISTRY.get(fmt)
+    return f.binary or f.reads_bytes
+
+def text_reader(fp_in, fmt, encoding=None):
+    """Return fp_in, a binary file, as fmt can read it: as it is, or decoded in encoding if fmt only reads text.
+
+    Closing a decoded one closes fp_in.
+    """
+    return fp_in if reads_bytes(fmt) else io.TextIOWrapper(fp_in, encoding)
+
+def read_events(fp_in, fmt_in, drop_icons=False):
+    """Yield (event, node, depth) for the tree in fp_in, like walk() on it.
+
+    Where the format allows, the events come while reading, without the whole
+    tree ever being in memory. Folders come without their children.
+    """
+    return _format_module(fmt_in).events(fp_in, icons=IconPool(drop_icons))
+
+def write_events(events, fp_out, fmt_out, cull_special=False, cull_attr=False):
+    """Write a stream of (event, node, depth), same as Bookmarks.write on the tree it describes"""
+    _format_module(fmt_out).write_events(events, fp_out, cull_special, cull_attr)
+
+def normalize_events(events, fill_timestamps=False, prefix_ids="", ts=None):
+    """Apply the parts of Bookmarks.normalize that only need one node at a time, as the events pass"""
+    if fill_timestamps and ts is None:
+        import time
+        ts = int(time.time() * 1000000)
+    for ev in events:
+        (event, node, _) = ev
+        if event != EXIT_FOLDER:
+            if fill_timestamps:
+                _fill_timestamp(ts, node)
+            if prefix_ids:
+                _prefix_id(prefix_ids, node)
+        yield ev
 
 def _to_numid(i):
     if not i: return (0, i)
@@ -38,18 +98,6 @@ def _to_numid(i):
     except ValueError:
         return (10**len(i), i)
 
-def _set_max_id(node, ref):
-    ref[0] = max(ref[0], _to_numid(node.id))
-
-def _fill_id(node, ref):
-    if not node.id:
-        node.id = str(ref[0])
-        ref[0] += 1
-
-def _find_special_folder(node, rem):
-    if isinstance(node, Folder):
-        rem.pop(node.special, None)
-
 def _fill_timestamp(ts, node):
     if node.date_added is None:
         node.date_added = ts
@@ -66,67 +114,262 @@ def _prefix_id(prefix, node):
     if node.id:
         node.id = prefix + node.id
 
+class _EncodedStringIO(io.StringIO):
+    """A StringIO for text that will end up in a file of the given encoding"""
+    def __init__(self, encoding):
+        super().__init__()
+        self._encoding = encoding
+
+    @property
+    def encoding(self):
+        return self._encoding
+
 @dataclass
 class Bookmarks:
     root: Folder
+    _index: TreeIndex = field(default=None, init=False, repr=False, compare=False)
+
+    @property
+    def index(self):
+        """A TreeIndex of the tree, built on first use.
+
+        It is kept up to date by the methods below, but not when the tree is
+        modified directly; call invalidate_index() after doing that.
+        """
+        if self._index is None or self._index.root is not self.root:
+            self._index = TreeIndex(self.root)
+        return self._index
+
+    def invalidate_index(self):
+        self._index = None
 
     def _debug_eq(self, other, accept, xchildren):
+        # not self.hash(), whose cache may not know of direct changes
+        if hasher()(self.root) == hasher()(other.root):
+            return True
         return self.root._debug_eq(other.root, accept, xchildren)
 
+    def hash(self):
+        """Return a hash of the whole tree, equal for equal trees; see TreeIndex.hash.
+
+        It is cached in the index, so after changing the tree directly, call
+        index.changed() on the changed nodes first.
+        """
+        return self.index.hash()
+
+    def icon_refcounts(self):
+        """Return the number of nodes using each icon, as a Counter"""
+        return icon_refcounts(self.root)
+
     def fill_special(self):
         """Fill in missing special folders, so every special folder exists"""
-        rem = dict(FOLDER_DEFAULT_NAMES)
-        root_name = rem.pop(None)
-        if self.root.special is not None:
-            raise ValueError("cannot fill_special if root is a special folder")
-        if not self.root.name:
-            self.root.name = root_name
-        self.root.map_mut_share(_find_special_folder, rem)
-        extra_children = []
-        for (special, name) in rem.items():
-            extra_children.append(Folder("", None, name, "", None, [], special))
-        self.root.children = extra_children + self.root.children
+        self.normalize(fill_special=True)
 
     def fill_ids(self):
         """Fill in missing ids, so every element has an id"""
-        max_id = [_to_numid("")]
-        self.root.map_mut_share(_set_max_id, max_id)
-        self.root.map_mut_share(_fill_id, [max_id[0][0] + 1])
+        self.normalize(fill_ids=True)
 
     def fill_timestamps(self, ts=None):
         """Fill in missing timestamps, so every element has all timestamps"""
-        if ts is None:
-            import time
-            ts = int(time.time() * 1000000)
-        self.root.map_mut(partial(_fill_timestamp, ts))
+        self.normalize(fill_timestamps=True, ts=ts)
 
     def prefix_ids(self, prefix):
         """Add a prefix to all existing ids, useful when combining several sources"""
-        self.root.map_mut(partial(_prefix_id, prefix))
+        self.normalize(prefix_ids=prefix)
+
+    def normalize(self, fill_special=False, fill_ids=False, fill_timestamps=False, prefix_ids="", ts=None):
+        """Apply any mix of the above in a single pass over the tree.
+
+        The result is the same as calling fill_special, fill_ids,
+        fill_timestamps and prefix_ids one after the other, in that order.
+        """
+        root = self.root
+        if fill_special:
+            if root.special is not None:
+                raise ValueError("cannot fill_special if root is a special folder")
+            rem = dict(FOLDER_DEFAULT_NAMES)
+            root_name = rem.pop(None)
+            if not root.name:
+                root.name = root_name
+        if fill_timestamps and ts is None:
+            import time
+            ts = int(time.time() * 1000000)
+        # new ids are numbered after the largest existing one, but can only be
+        # given out once that is known, so keep the nodes needing one in order
+        max_id = _to_numid("")[0]
+        unfilled = []
+        # nothing to do is common, and then the tree need not be walked at all,
+        # which for a lazily loaded one means not loading it
+        walked = preorder(root) if fill_special or fill_ids or fill_timestamps or prefix_ids else ()
+        for node in walked:
+            if fill_special and isinstance(node, Folder):
+                rem.pop(node.special, None)
+            if fill_ids:
+                if node.id:
+                    max_id = max(max_id, _to_numid(node.id)[0])
+                else:
+                    unfilled.append(node)
+            if fill_timestamps:
+                _fill_timestamp(ts, node)
+            if prefix_ids:
+                _prefix_id(prefix_ids, node)
+        if fill_special:
+            extra_children = []
+            for (special, name) in rem.items():
+                extra_children.append(Folder("", None, name, "", None, [], special))
+                if fill_timestamps:
+                    _fill_timestamp(ts, extra_children[-1])
+            root.children = extra_children + root.children
+            if fill_ids:
+                # they come right after the root in pre-order
+                i = 1 if unfilled and unfilled[0] is root else 0
+                unfilled[i:i] = extra_children
+        for (i, node) in enumerate(unfilled, max_id + 1):
+            node.id = prefix_ids + str(i)
+        index = self._index
+        if index is not None and index.root is root:
+            index.hashes.clear()
+            if prefix_ids:
+                index._prefix_ids(prefix_ids)
+            if fill_special:
+                for c in extra_children:
+                    index._add(c, root)
+            for node in unfilled:
+                index._add_id(node)
+
+    def merge(self, *others, dedup="url", strategy="newest"):
+        """Merge other Bookmarks into this one, in one pass over each.
+
+        Folders with the same path are merged; special folders match by which
+        special folder they are, and others by name. Bookmarks are deduplicated
+        across the whole tree by dedup, one of DEDUP_KEYS; when merging by "id",
+        use prefix_ids first if the sources may have reused each other's ids.
+        Attributes of matched nodes are resolved by strategy, one of
+        MERGE_STRATEGIES. The others are not modified.
+        """
+        for other in others:
+            self.index.hashes.clear()
+            _merge.merge(self.index, other.root, dedup, strategy)
+
+    def diff(self, other):
+        """Return a Patch that turns this tree into other's; see bkmk.diff.
+
+        Both trees are hashed afresh, so this is right even if either was
+        changed directly since it was last hashed.
+        """
+        return _diff.diff(self.root, other.root, hasher(), hasher())
+
+    def apply_patch(self, patch):
+        """Apply a Patch from diff() to this tree, which must be the one it was made from"""
+        _diff.apply_patch(self.root, patch)
+        self.invalidate_index()
 
     @classmethod
     def new(cls):
         return cls(Folder.new())
 
+    def to_columnar(self):
+        """Convert to a ColumnarTree, for fast bulk operations"""
+        return ColumnarTree.from_tree(self.root)
+
     @classmethod
-    def read(cls, fp_in, fmt_in, fill_special=False, fill_ids=False, fill_timestamps=False, prefix_ids=""):
-        if fmt_in not in FORMATS:
-            raise ValueError("not a valid format: %s" % fmt_in)
-        bm = cls(globals()[fmt_in.replace("-", "_")].read(fp_in))
-        if fill_special:
-            bm.fill_special()
-        if fill_ids:
-            bm.fill_ids()
-        if fill_timestamps:
-            bm.fill_timestamps()
-        if prefix_ids:
-            bm.prefix_ids(prefix_ids)
+    def from_columnar(cls, columns):
+        return cls(columns.to_tree())
+
+    @classmethod
+    def read(cls, fp_in, fmt_in, fill_special=False, fill_ids=False, fill_timestamps=False, prefix_ids="",
+             drop_icons=False, cache=None, compression=None):
+        """Read a tree from fp_in, and normalize it.
+
+        Equal icons are shared between the nodes that have them, or with
+        drop_icons, not read at all.
+
+        cache is a ReadCache to look the input up in first, and to keep the
+        result in. Filled timestamps depend on the time, so those are never
+        cached but filled in after every read.
+
+        fp_in may be a text file, or for formats that reads_bytes(), a binary
+        one or an mmap, which the format decodes itself as it reads, in the
+        encoding the file declares; that saves decoding all of it up front.
+
+        With compression, fp_in is a binary file that is decompressed while
+        reading it; "auto" to detect from the magic bytes, or a name or list of
+        names from COMPRESSIONS, outermost first. Formats that only read text
+        get it decoded in the default encoding, as open() would.
+        """
+        if compression is not None:
+            if isinstance(fp_in, io.TextIOBase):
+                raise ValueError("compressed input must be read from a binary file")
+            fp_in = text_reader(_compression.reader(fp_in, compression), fmt_in)
+        if cache is None:
+            bm = cls(_format_module(fmt_in).read(fp_in, icons=IconPool(drop_icons)))
+            bm.normalize(fill_special, fill_ids, fill_timestamps, prefix_ids)
+            return bm
+        def parse(fp_in):
+            return cls.read(fp_in, fmt_in, fill_special, fill_ids, False, prefix_ids, drop_icons).root
+        opts = {"fill_special": fill_special, "fill_ids": fill_ids, "prefix_ids": prefix_ids, "drop_icons": drop_icons}
+        bm = cls(cache.read(fp_in, fmt_in, opts, parse))
+        bm.normalize(fill_timestamps=fill_timestamps)
         return bm
 
-    def write(self, fp_out, fmt_out, cull_special=False, cull_attr=False):
-        if fmt_out not in FORMATS:
-            raise ValueError("not a valid format: %s" % fmt_out)
-        globals()[fmt_out.replace("-", "_")].write(self.root, fp_out, cull_special, cull_attr)
+    def write(self, fp_out, fmt_out, cull_special=False, cull_attr=False, compression=None):
+        """Write the tree to fp_out.
+
+        With compression, a name or list of names from COMPRESSIONS,
+        outermost first, fp_out is a binary file to write compressed data to.
+        """
+        if compression is None:
+            _format_module(fmt_out).write(self.root, fp_out, cull_special, cull_attr)
+            return
+        if isinstance(fp_out, io.TextIOBase):
+            raise ValueError("compressed output must be written to a binary file")
+        with _compression.writer(fp_out, compression, text=not is_binary(fmt_out)) as fp:
+            _format_module(fmt_out).write(self.root, fp, cull_special, cull_attr)
+
+    def write_many(self, outputs, parallel=None):
+        """Write the tree to several outputs, each a (fp_out, fmt_out, opts) with opts the keyword arguments to write.
+
+        parallel is None to write them one after the other, or "threads" or
+        "processes" to write them concurrently, which is safe as writers never
+        modify the tree, and a lazily read one loads each folder once, for all
+        of them. With "processes", each output is formatted in a worker
+        and copied into its fp_out here, as file objects cannot be sent to
+        another process; the tree is sent in its columnar form, which unlike
+        the tree itself pickles at any depth.
+        """
+        for (_, fmt_out, _) in outputs:
+            _format_module(fmt_out)
+        if parallel is None:
+            for (fp_out, fmt_out, opts) in outputs:
+                self.write(fp_out, fmt_out, **opts)
+        elif parallel == "threads":
+            import concurrent.futures
+            with concurrent.futures.ThreadPoolExecutor(max(1, len(outputs))) as pool:
+                futures = [pool.submit(self.write, fp_out, fmt_out, **opts) for (fp_out, fmt_out, opts) in outputs]
+                for future in futures:
+                    future.result()
+        elif parallel == "processes":
+            import concurrent.futures
+            columns = self.to_columnar()
+            with concurrent.futures.ProcessPoolExecutor(max(1, len(outputs))) as pool:
+                futures = [(fp_out, pool.submit(self._write_columnar, columns, fmt_out, opts, getattr(fp_out, "encoding", None)))
+                    for (fp_out, fmt_out, opts) in outputs]
+                for (fp_out, future) in futures:
+                    fp_out.write(future.result())
+        else:
+            raise ValueError("not a valid parallel mode: %s" % parallel)
+
+    @classmethod
+    def _write_columnar(cls, columns, fmt_out, opts, encoding):
+        # runs in a worker process for write_many; encoding is that of the
+        # real output, which writers like xbel declare. Compressed output is
+        # always bytes.
+        if is_binary(fmt_out) or opts.get("compression") is not None:
+            fp = io.BytesIO()
+        else:
+            fp = _EncodedStringIO(encoding)
+        cls.from_columnar(columns).write(fp, fmt_out, **opts)
+        return fp.getvalue()
 
     @staticmethod
     def sanity_check_args(do_warn, **kwargs):
@@ -144,3 +387,37 @@ class Bookmarks:
             # in a round-trip test, timestamps will keep getting deleted and reassigned
             bad_args("cull_attr=True may undo some/all of the effects of fill_timestamps=True")
         return ok[0]
+
+def convert(fp_in, fmt_in, fp_out, fmt_out,
+            fill_special=False, fill_ids=False, fill_timestamps=False, prefix_ids="", drop_icons=False,
+            cull_special=False, cull_attr=False, cache=None, stream=False):
+    """Read fp_in and write it to fp_out, same as Bookmarks.read followed by Bookmarks.write.
+
+    With stream, the nodes are instead streamed from input to output without
+    building the tree, unless fill_special or fill_ids is set, which need to
+    see the whole tree, or a cache is given. That keeps memory flat, but
+    differs from the tree in two ways: for netscape-html, text between a
+    folder's children is not added to its name, as the folder may already
+    have been written; and if the input turns out to be malformed, what was
+    written of the output before that is left behind.
+    """
+    if not stream or fill_special or fill_ids or cache is not None:
+        Bookmarks.read(
+            fp_in, fmt_in, fill_special, fill_ids, fill_timestamps, prefix_ids, drop_icons, cache
+        ).write(fp_out, fmt_out, cull_special, cull_attr)
+    else:
+        events = normalize_events(read_events(fp_in, fmt_in, drop_icons), fill_timestamps, prefix_ids)
+        write_events(events, fp_out, fmt_out, cull_special, cull_attr)
+
+# the submodules too, as a star import bound them before the format modules
+# were imported lazily; it now imports those
+__all__ = [
+    *(name for name in base.__all__ if not name.startswith("_")),
+    "FORMATS", "FORMAT_EXTS", "COMPRESSIONS", "DEDUP_KEYS", "MERGE_STRATEGIES",
+    "Format", "FormatsView", "FormatExtsView", "register_format",
+    "guess_format", "format_ext", "is_binary", "reads_bytes", "text_reader",
+    "read_events", "write_events", "normalize_events", "convert",
+    "Bookmarks", "ColumnarTree", "TreeIndex", "hasher", "Patch", "ReadCache", "IconPool", "icon_data", "icon_refcounts",
+    "base", "cache", "columnar", "compression", "diff", "formats", "icons", "index", "merge",
+    *_FORMAT_MODULES,
+]
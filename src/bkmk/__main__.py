@@ -1,39 +1,156 @@
 #!/usr/bin/python3
 
-from bkmk import *
+# not *, which imports every format
+from bkmk import (Bookmarks, DEDUP_KEYS, FORMATS, FORMAT_EXTS, MERGE_STRATEGIES, ReadCache, convert, format_ext,
+    guess_format, is_binary, log, reads_bytes, text_reader)
+from bkmk.cache import DEFAULT_MAX_BYTES
+from bkmk.compression import split_ext, reader, writer
+from bkmk.formats import BUILTIN_FORMATS
 
 import argparse
 import contextlib
+import time
 
 import os.path
 import sys
 
+NORMALIZE_OPTS = ("fill_special", "fill_ids", "fill_timestamps", "prefix_ids")
+READ_OPTS = NORMALIZE_OPTS + ("drop_icons",)
+WRITE_OPTS = ("cull_special", "cull_attr")
+CONVERT_OPTS = READ_OPTS + WRITE_OPTS + ("stream",)
+
+DEFAULT_CACHE_MIB = DEFAULT_MAX_BYTES >> 20
+
+
+def open_file(stack, path, mode, fmt):
+    """Open path in mode "r" or "w" for fmt, through the compressions named by its extensions.
+
+    Inputs are opened in binary mode for the formats that reads_bytes(),
+    which find the encoding themselves; others get text, decompressed first.
+    """
+    compressions = split_ext(path)[1]
+    if mode == "r":
+        if not compressions:
+            return stack.enter_context(open(path, "rb" if reads_bytes(fmt) else "r"))
+        fp = stack.enter_context(open(path, "rb"))
+        return stack.enter_context(text_reader(stack.enter_context(reader(fp, compressions)), fmt))
+    if not compressions:
+        return stack.enter_context(open(path, mode + "b" if is_binary(fmt) else mode))
+    fp = stack.enter_context(open(path, mode + "b"))
+    return stack.enter_context(writer(fp, compressions, text=not is_binary(fmt)))
 
 def file_or_std(stack, path, mode, fmt, flag, stdname, std):
     if path and path != '-':
-        fp = stack.enter_context(open(path, mode))
         fmt = fmt if fmt else guess_format(path, verbose=True)
+        fp = open_file(stack, path, mode, fmt)
     else:
-        fp = std
         if fmt is None:
             raise ValueError("must give explicit %s when using %s" % (flag, stdname))
+        if mode == "r":
+            # pipes have no extension, so go by what they start with
+            fp = text_reader(reader(std.buffer, "auto"), fmt, std.encoding)
+        else:
+            fp = std.buffer if is_binary(fmt) else std
     return (fp, fmt)
 
-def _real_main(_prog, *argv):
-    parser = argparse.ArgumentParser(
-        prog = "bkmk",
-        description = 'Convert between different bookmark formats')
+def read_cache(args):
+    return ReadCache(args.cache_dir, args.cache_size << 20) if args.cache_dir else None
 
+def convert_file(path_in, fmt_in, path_out, fmt_out, opts):
+    """Convert one file for --batch, returning its entry in the summary instead of raising"""
+    result = {"input": path_in, "output": path_out, "from": fmt_in, "to": fmt_out, "ok": False, "error": None}
+    start = time.perf_counter()
+    try:
+        fmt_in = result["from"] = fmt_in if fmt_in else guess_format(path_in)
+        if os.path.exists(path_out) and os.path.samefile(path_in, path_out):
+            raise ValueError("output path is the input itself")
+        # written beside it and renamed into place once complete, so neither
+        # a failure nor an output that is somehow the input loses anything
+        (out_dir, out_name) = os.path.split(path_out)
+        tmp = os.path.join(out_dir, ".tmp-%d-%s" % (os.getpid(), out_name))
+        with contextlib.ExitStack() as stack:
+            fp_in = open_file(stack, path_in, "r", fmt_in)
+            try:
+                with contextlib.ExitStack() as out_stack:
+                    fp_out = open_file(out_stack, tmp, "w", fmt_out)
+                    convert(fp_in, fmt_in, fp_out, fmt_out, **opts)
+                os.replace(tmp, path_out)
+            except BaseException:
+                if os.path.exists(tmp):
+                    os.unlink(tmp)
+                raise
+        result["ok"] = True
+    except Exception as e:
+        result["error"] = "%s: %s" % (type(e).__name__, e)
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+def batch_main(args, inputs):
+    import concurrent.futures
+    import json
+    if not args.out_dir:
+        raise ValueError("must give --out-dir when using --batch")
+    if not args.fmt_out:
+        raise ValueError("must give explicit -t when using --batch")
+    os.makedirs(args.out_dir, exist_ok=True)
+    opts = {k: getattr(args, k) for k in CONVERT_OPTS}
+    opts["cache"] = read_cache(args)
+    results = [None] * len(inputs)
+    seen = set()
+    with concurrent.futures.ProcessPoolExecutor(args.jobs) as pool:
+        futures = {}
+        for (i, path_in) in enumerate(inputs):
+            # a.html -> OUT_DIR/a.xbel, keeping any unrecognised extension;
+            # outputs are never compressed
+            stem = split_ext(os.path.basename(path_in))[0]
+            for ext in FORMAT_EXTS:
+                if stem.endswith(ext):
+                    stem = stem[:-len(ext)]
+                    break
+            path_out = os.path.join(args.out_dir, stem + format_ext(args.fmt_out))
+            if path_out in seen:
+                results[i] = {"input": path_in, "output": path_out, "from": args.fmt_in, "to": args.fmt_out,
+                    "ok": False, "error": "output path already used by another input", "seconds": 0.0}
+                log("error: %s: %s" % (path_in, results[i]["error"]))
+                continue
+            seen.add(path_out)
+            futures[pool.submit(convert_file, path_in, args.fmt_in, path_out, args.fmt_out, opts)] = i
+        for future in concurrent.futures.as_completed(futures):
+            i = futures[future]
+            try:
+                results[i] = future.result()
+            except Exception as e:
+                # the worker itself died
+                results[i] = {"input": inputs[i], "output": None, "from": args.fmt_in, "to": args.fmt_out,
+                    "ok": False, "error": "%s: %s" % (type(e).__name__, e), "seconds": 0.0}
+            if not results[i]["ok"]:
+                log("error: %s: %s" % (results[i]["input"], results[i]["error"]))
+    failed = sum(1 for r in results if not r["ok"])
+    summary = {"converted": len(results) - failed, "failed": failed, "files": results}
+    with contextlib.ExitStack() as stack:
+        if args.summary and args.summary != '-':
+            fp = stack.enter_context(open(args.summary, "w"))
+        else:
+            fp = sys.stdout
+        json.dump(summary, fp, indent=2)
+        fp.write("\n")
+    return 1 if failed else 0
+
+def format_arg(name):
+    # only list them all when needed, as that has to look for plugins
+    if name not in FORMATS:
+        raise argparse.ArgumentTypeError("invalid choice: %r (choose from %s)" % (name, ", ".join(FORMATS)))
+    return name
+
+def add_tree_args(parser, inputs_note=""):
+    """Add the options for formats and for normalising the tree"""
+    builtin = ", ".join(fmt.name for fmt in BUILTIN_FORMATS)
     parser.add_argument(
-        'input', nargs='?', default=None, help="Input path; omit or '-' for stdin.")
-    parser.add_argument(
-        'output', nargs='?', default=None, help="Output path; omit or '-' for stdout.")
-    parser.add_argument(
-        '-f', '--from', metavar='FMT', dest='fmt_in', default=None, choices=FORMATS.keys(),
-        help="Input format, one of: %s. Omit to auto-detect from input path." % ", ".join(FORMATS.keys()))
+        '-f', '--from', metavar='FMT', dest='fmt_in', default=None, type=format_arg,
+        help="Input format, one of: %s, or any added by a plugin. Omit to auto-detect from input path%s." % (builtin, inputs_note))
     parser.add_argument(
-        '-t', '--to', metavar='FMT', dest='fmt_out', default=None, choices=FORMATS.keys(),
-        help="Output format, one of: %s. Omit to auto-detect from output path." % ", ".join(FORMATS.keys()))
+        '-t', '--to', metavar='FMT', dest='fmt_out', default=None, type=format_arg,
+        help="Output format, one of: %s, or any added by a plugin. Omit to auto-detect from output path." % builtin)
     parser.add_argument(
         '--fill-special', default=False, action=argparse.BooleanOptionalAction,
         help="Fill in missing special folders after reading, so every special folder exists")
@@ -46,6 +163,16 @@ def _real_main(_prog, *argv):
     parser.add_argument(
         '--prefix-ids', default="", metavar="PREFIX",
         help="Add a prefix to all existing ids after reading, useful when combining several sources")
+    parser.add_argument(
+        '--drop-icons', default=False, action=argparse.BooleanOptionalAction,
+        help="Drop all icons while reading, for much smaller output when they aren't wanted")
+    parser.add_argument(
+        '--cache-dir', default=None, metavar='DIR',
+        help="""Keep parsed inputs in DIR, and read them from there instead of parsing them \
+        again while they are unchanged. Inputs from stdin are never cached.""")
+    parser.add_argument(
+        '--cache-size', type=int, default=DEFAULT_CACHE_MIB, metavar='MIB',
+        help="With --cache-dir, remove the least recently used entries once DIR is bigger than this.")
     parser.add_argument(
         '--cull-special', default=False, action=argparse.BooleanOptionalAction,
         help="Cull empty special folders that are not recognised by the output format")
@@ -56,19 +183,105 @@ def _real_main(_prog, *argv):
         inappropriate element. We never emit attributes if the format does not support \
         it for any element, since that requires making up an attribute name from thin air.
         """)
+
+def merge_main(*argv):
+    parser = argparse.ArgumentParser(
+        prog = "bkmk merge",
+        description = 'Merge several bookmark files into one, deduplicating bookmarks')
+
+    parser.add_argument(
+        'inputs', nargs='+', metavar='input', help="Input paths, merged in this order.")
+    parser.add_argument(
+        '-o', '--output', default=None, help="Output path; omit or '-' for stdout.")
+    add_tree_args(parser, "s, per input")
+    parser.add_argument(
+        '--dedup', default="url", choices=[k or "none" for k in DEDUP_KEYS],
+        help="What to deduplicate bookmarks by, across the whole tree.")
+    parser.add_argument(
+        '--strategy', default="newest", choices=MERGE_STRATEGIES,
+        help="""Whose attributes to keep for bookmarks and folders that match: the newest \
+        by date_modified, or the first or last one merged.""")
     args = parser.parse_args(argv)
 
+    with contextlib.ExitStack() as stack:
+        fp_out, fmt_out = file_or_std(stack, args.output, "w", args.fmt_out, "-t", "stdout", sys.stdout)
+        Bookmarks.sanity_check_args(True, **args.__dict__)
+        bm = Bookmarks.new()
+        cache = read_cache(args)
+        for path in args.inputs:
+            with contextlib.ExitStack() as in_stack:
+                fp_in, fmt_in = file_or_std(in_stack, path, "r", args.fmt_in, "-f", "stdin", sys.stdin)
+                other = Bookmarks.read(fp_in, fmt_in, drop_icons=args.drop_icons, cache=cache)
+            bm.merge(other, dedup=None if args.dedup == "none" else args.dedup, strategy=args.strategy)
+        bm.normalize(**{k: getattr(args, k) for k in NORMALIZE_OPTS})
+        bm.write(fp_out, fmt_out, **{k: getattr(args, k) for k in WRITE_OPTS})
+    return 0
+
+def _real_main(_prog, *argv):
+    if argv[:1] == ("merge",):
+        return merge_main(*argv[1:])
+
+    parser = argparse.ArgumentParser(
+        prog = "bkmk",
+        description = 'Convert between different bookmark formats',
+        epilog = "See also: bkmk merge --help")
+
+    parser.add_argument(
+        'input', nargs='?', default=None, help="Input path; omit or '-' for stdin.")
+    parser.add_argument(
+        'output', nargs='?', default=None, help="Output path; omit or '-' for stdout.")
+    parser.add_argument(
+        'more_inputs', nargs='*', default=[], help=argparse.SUPPRESS)
+    add_tree_args(parser)
+    parser.add_argument(
+        '--also', default=[], action='append', metavar='PATH',
+        help="""Also write to PATH, in the format guessed from its extension, from the same \
+        parse of the input. May be given several times.""")
+    parser.add_argument(
+        '--stream', default=False, action=argparse.BooleanOptionalAction,
+        help="""Stream nodes from input to output without building the whole tree, so memory \
+        stays flat however big the input is. Ignored with --fill-special, --fill-ids, \
+        --cache-dir or --also, which need the tree. Unlike the default, text between a \
+        netscape-html folder's children is not added to its name, and a malformed input \
+        leaves partial output behind.""")
+    parser.add_argument(
+        '--parallel', default=None, choices=("threads", "processes"),
+        help="With --also, write all the outputs concurrently on threads or processes.")
+    parser.add_argument(
+        '--batch', default=False, action='store_true',
+        help="""Treat every positional argument as an input, and convert each of them into \
+        --out-dir, in the format given by -t. Failures are reported without stopping the \
+        batch, and a JSON summary is written to --summary.""")
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=None, metavar='N',
+        help="With --batch, the number of processes to convert with. Omit to use one per CPU.")
+    parser.add_argument(
+        '--out-dir', default=None, metavar='DIR',
+        help="With --batch, the directory to write outputs to; each is named after its input.")
+    parser.add_argument(
+        '--summary', default=None, metavar='PATH',
+        help="With --batch, where to write the JSON summary; omit or '-' for stdout.")
+    args = parser.parse_args(argv)
+
+    if args.batch:
+        inputs = [p for p in (args.input, args.output) if p is not None] + args.more_inputs
+        Bookmarks.sanity_check_args(True, **args.__dict__)
+        return batch_main(args, inputs)
+    if args.more_inputs:
+        parser.error("too many paths, did you mean to use --batch?")
+
     with contextlib.ExitStack() as stack:
         fp_in, fmt_in = file_or_std(stack, args.input, "r", args.fmt_in, "-f", "stdin", sys.stdin)
         fp_out, fmt_out = file_or_std(stack, args.output, "w", args.fmt_out, "-t", "stdout", sys.stdout)
         Bookmarks.sanity_check_args(True, **args.__dict__)
-        Bookmarks.read(
-            fp_in, fmt_in,
-            **{k: getattr(args, k) for k in ("fill_special", "fill_ids", "fill_timestamps", "prefix_ids")}
-        ).write(
-            fp_out, fmt_out,
-            **{k: getattr(args, k) for k in ("cull_special", "cull_attr")}
-        )
+        if args.also:
+            outputs = [(fp_out, fmt_out)]
+            outputs.extend(file_or_std(stack, path, "w", None, "-t", "stdout", sys.stdout) for path in args.also)
+            bm = Bookmarks.read(fp_in, fmt_in, **{k: getattr(args, k) for k in READ_OPTS}, cache=read_cache(args))
+            opts = {k: getattr(args, k) for k in WRITE_OPTS}
+            bm.write_many([(fp, fmt, opts) for (fp, fmt) in outputs], args.parallel)
+        else:
+            convert(fp_in, fmt_in, fp_out, fmt_out, **{k: getattr(args, k) for k in CONVERT_OPTS}, cache=read_cache(args))
     return 0
 
 def main():
@@ -1,5 +1,10 @@
+from __future__ import annotations
+
+import codecs
+
 from dataclasses import dataclass
 from enum import Enum
+from typing import Union
 
 FAKE_SEPARATOR_URLS = [
     "about:bookmark-separator",
@@ -22,60 +27,84 @@ def _debug_eq_attr(self, other, accept, depth, attrs):
             r.append(False)
     return all(r)
 
+# the node classes declare __slots__ by hand rather than using
+# dataclass(slots=True), which needs Python >= 3.10 and breaks super()
+
 @dataclass
 class Base:
+    __slots__ = ("id", "date_added")
     id: str
     """When this entry was added."""
     date_added: int | None # unix epoch, micros
 
     def map_mut(self, mut):
-        mut(self)
+        """Apply a mutation to every item in the tree, parents before their children."""
+        for node in preorder(self):
+            mut(node)
 
     def map_mut_share(self, mut, share):
-        mut(self, share)
+        """Apply a mutation with access to shared state, to every item in the tree.
+
+        The share should be a container, not a single value. To share a single
+        variable, put it inside a list of length 1.
+        """
+        for node in preorder(self):
+            mut(node, share)
+
+    def _debug_eq(self, other, accept, xchildren, depth=0):
+        def children(a, b, depth):
+            if isinstance(a, Folder) and isinstance(b, Folder):
+                return zip(xchildren(a.children, depth), xchildren(b.children, depth))
+            return None
+        # compare everything rather than stopping early, to log all the differences
+        return all([a._debug_eq_node(b, accept, depth) for (a, b, depth) in walk_pairs(self, other, children)])
 
-    def _debug_eq(self, other, accept, xchildren, depth):
+    def _debug_eq_node(self, other, accept, depth):
         r = []
         r.append(_debug_eq_attr(self, other, accept, depth, "id date_added"))
         return all(r)
 
 @dataclass
 class Separator(Base):
-    def _debug_eq(self, other, accept, xchildren, depth):
+    __slots__ = ()
+
+    def _debug_eq_node(self, other, accept, depth):
         if type(self) != type(other):
             log("err: type mismatch:", type(self).__name__, "vs", type(other).__name__)
             return False
         r = []
-        r.append(super()._debug_eq(other, accept, xchildren, depth))
+        r.append(super()._debug_eq_node(other, accept, depth))
         return all(r)
 
 @dataclass
 class UserEntry(Base):
+    __slots__ = ("name", "icon", "date_modified")
     name: str
     icon: str
     """When this entry was modified."""
     date_modified: int | None # unix epoch, micros
 
-    def _debug_eq(self, other, accept, xchildren, depth):
+    def _debug_eq_node(self, other, accept, depth):
         r = []
-        r.append(super()._debug_eq(other, accept, xchildren, depth))
+        r.append(super()._debug_eq_node(other, accept, depth))
         r.append(_debug_eq_attr(self, other, accept, depth, "name icon date_modified"))
         return all(r)
 
 @dataclass
 class Bookmark(UserEntry):
+    __slots__ = ("url", "url_date_modified", "url_date_visited")
     url: str
     """When the URL was modified."""
     url_date_modified: int | None # unix epoch, micros
     """When the URL was last visited."""
     url_date_visited: int | None # unix epoch, micros
 
-    def _debug_eq(self, other, accept, xchildren, depth):
+    def _debug_eq_node(self, other, accept, depth):
         if type(self) != type(other):
             log("err: type mismatch:", type(self).__name__, "vs", type(other).__name__)
             return False
         r = []
-        r.append(super()._debug_eq(other, accept, xchildren, depth))
+        r.append(super()._debug_eq_node(other, accept, depth))
         r.append(_debug_eq_attr(self, other, accept, depth, "url url_date_modified url_date_visited"))
         return all(r)
 
@@ -96,41 +125,150 @@ def _keep_child(cull_special, supported, node):
 
 @dataclass
 class Folder(UserEntry):
+    __slots__ = ("children", "special")
     children: list['BookmarksTy']
     special: None | SpecialFolder
 
-    def map_mut(self, mut):
-        """Apply a mutation to every item in the folder and its subfolders."""
-        mut(self)
-        for c in self.children:
-            c.map_mut(mut)
-
-    def map_mut_share(self, mut, share):
-        """Apply a mutation with access to shared state, to every item in the folder and its subfolders.
-
-        The share should be a container, not a single value. To share a single
-        variable, put it inside a list of length 1.
-        """
-        mut(self, share)
-        for c in self.children:
-            c.map_mut_share(mut, share)
-
-    def _debug_eq(self, other, accept, xchildren, depth=0):
+    def _debug_eq_node(self, other, accept, depth):
         if type(self) != type(other):
             log("err: type mismatch:", type(self).__name__, "vs", type(other).__name__)
             return False
         r = []
-        r.append(super()._debug_eq(other, accept, xchildren, depth))
+        r.append(super()._debug_eq_node(other, accept, depth))
         r.append(_debug_eq_attr(self, other, accept, depth, "special"))
-        for a, b in zip(xchildren(self.children, depth), xchildren(other.children, depth)):
-            r.append(a._debug_eq(b, accept, xchildren, depth+1))
         return all(r)
 
     @classmethod
     def new(cls):
         return cls("", None, "", "", None, [], None)
 
-BookmarksTy = Separator | Bookmark | Folder
+BookmarksTy = Union[Separator, Bookmark, Folder]
+
+"""
+Traversal without recursion, so the depth of a tree is only limited by memory
+
+Everything that visits a whole tree should go through these.
+"""
+
+def preorder(root):
+    """Yield every node in the tree, parents before their children.
+
+    A folder's children are looked up after it has been yielded, so the
+    consumer may still change them.
+    """
+    yield root
+    if not isinstance(root, Folder): return
+    # a stack of iterators rather than of nodes, so leaves never touch the stack
+    stack = [iter(root.children)]
+    while stack:
+        for node in stack[-1]:
+            yield node
+            if isinstance(node, Folder):
+                stack.append(iter(node.children))
+                break
+        else:
+            stack.pop()
+
+def postorder(root):
+    """Yield every node in the tree, children before their parents"""
+    return (node for (event, node, _) in walk(root) if event != ENTER_FOLDER)
+
+"""Events yielded by walk()"""
+ENTER_FOLDER = "enter_folder"
+LEAF = "leaf"
+EXIT_FOLDER = "exit_folder"
+
+def walk(root, keep=None):
+    """Yield (event, node, depth) for every node in the tree, in document order.
+
+    Folders give ENTER_FOLDER before their children and EXIT_FOLDER after them,
+    everything else gives LEAF. If keep is given, children for which keep(child)
+    is false are skipped along with everything inside them.
+    """
+    if not isinstance(root, Folder):
+        yield (LEAF, root, 0)
+        return
+    children = (lambda folder: iter(folder.children)) if keep is None else (lambda folder: filter(keep, folder.children))
+    yield (ENTER_FOLDER, root, 0)
+    stack = [(root, children(root))]
+    while stack:
+        (folder, it) = stack[-1]
+        depth = len(stack)
+        for node in it:
+            if isinstance(node, Folder):
+                yield (ENTER_FOLDER, node, depth)
+                stack.append((node, children(node)))
+                break
+            yield (LEAF, node, depth)
+        else:
+            stack.pop()
+            yield (EXIT_FOLDER, folder, depth - 1)
+
+def cull_special_events(events, supported):
+    """Drop empty special folders that are not in supported, from a stream of events.
+
+    This is the same as walking with _keep_child(True, supported, ...) as keep.
+    A folder is only known to be empty at the event after it, so the
+    ENTER_FOLDER of any folder that might be dropped is held back until then.
+    """
+    held = None
+    for ev in events:
+        (event, node, depth) = ev
+        if held is not None:
+            if event == EXIT_FOLDER and node is held[1]:
+                held = None
+                continue
+            yield held
+            held = None
+        if event == ENTER_FOLDER and depth > 0 and node.special is not None and node.special not in supported:
+            held = ev
+        else:
+            yield ev
+    if held is not None:
+        yield held
+
+def walk_pairs(a, b, children):
+    """Walk two trees in lockstep, yielding (a, b, depth) for each pair of nodes, parents first.
+
+    children(a, b, depth) gives the pairs of children to walk into, or None if
+    there are none. It is only called after the pair has been yielded.
+    """
+    yield (a, b, 0)
+    pairs = children(a, b, 0)
+    stack = [iter(pairs)] if pairs is not None else []
+    while stack:
+        depth = len(stack)
+        for (a, b) in stack[-1]:
+            yield (a, b, depth)
+            pairs = children(a, b, depth)
+            if pairs is not None:
+                stack.append(iter(pairs))
+                break
+        else:
+            stack.pop()
+
+def transform(root, convert, children):
+    """Convert a tree into a tree of some other type, e.g. a format's AST.
+
+    convert(node, depth) returns (new, out), where new is the converted node and
+    out is something with an append() method to add its converted children to,
+    or None if the node has no children. children(node) gives the children of a
+    node whose out is not None. Nodes are converted in pre-order.
+    """
+    (new_root, out) = convert(root, 0)
+    stack = [(out, iter(children(root)))] if out is not None else []
+    while stack:
+        (out, it) = stack[-1]
+        depth = len(stack)
+        for c in it:
+            (new, c_out) = convert(c, depth)
+            out.append(new)
+            if c_out is not None:
+                stack.append((c_out, iter(children(c))))
+                break
+        else:
+            stack.pop()
+    return new_root
 
 """
 Utils for having optional keys in dictionary literals
@@ -155,6 +293,79 @@ def _on(v):
 
 _REMOVE_ME = object()
 
+"""Size in characters at which a BufferedWriter flushes its output"""
+DEFAULT_WRITE_BUFSIZE = 1 << 16
+
+class BufferedWriter:
+    """Collect output in a bounded buffer, and write it out in large chunks"""
+    """What the output is made of, str or bytes"""
+    EMPTY = ""
+
+    def __init__(self, fp_out, bufsize=DEFAULT_WRITE_BUFSIZE):
+        self.fp_out = fp_out
+        self.bufsize = bufsize
+        self.buf = []
+        self.size = 0
+
+    def emit(self, s):
+        self.buf.append(s)
+        self.size += len(s)
+        if self.size >= self.bufsize:
+            self.flush()
+
+    def flush(self):
+        self.fp_out.write(self.EMPTY.join(self.buf))
+        self.buf.clear()
+        self.size = 0
+
+class EventWriter(BufferedWriter):
+    """Base for writers that consume a stream of (event, node, depth).
+
+    Subclasses define enter_folder, leaf and exit_folder, which get the node
+    and its depth. Folders come without their children, which may not have
+    been read yet.
+    """
+    def handle_events(self, events):
+        handlers = {ENTER_FOLDER: self.enter_folder, LEAF: self.leaf, EXIT_FOLDER: self.exit_folder}
+        for (event, node, depth) in events:
+            handlers[event](node, depth)
+
+"""How much of a binary input DecodingReader reads first, to find its encoding in"""
+DETECT_ENCODING_SIZE = 1 << 12
+
+class DecodingReader:
+    """Read str from fp_in, which may be a text file, or a binary one like an mmap.
+
+    Binary input is decoded a chunk at a time, so there is never a decoded
+    copy of all of it at once, in the encoding that detect_encoding(head)
+    finds in the first bytes.
+    """
+    def __init__(self, fp_in, detect_encoding):
+        self.fp_in = fp_in
+        self.detect_encoding = detect_encoding
+        self.encoding = None
+        self.decoder = None
+        self.text = False
+
+    def read(self, size=-1):
+        if self.text:
+            return self.fp_in.read(size)
+        if self.decoder is None:
+            chunk = self.fp_in.read(max(size, DETECT_ENCODING_SIZE) if size >= 0 else -1)
+            if isinstance(chunk, str):
+                self.text = True
+                return chunk
+            self.encoding = self.detect_encoding(chunk)
+            self.decoder = codecs.getincrementaldecoder(self.encoding)()
+        else:
+            chunk = self.fp_in.read(size)
+        while True:
+            s = self.decoder.decode(chunk, final=not chunk)
+            # a chunk may end in the middle of a character, but only an empty one is the end
+            if s or not chunk:
+                return s
+            chunk = self.fp_in.read(size)
+
 def log(*args):
     import sys
     print("bkmk:", *args, file=sys.stderr)
@@ -163,5 +374,8 @@ __all__ = [
     "FAKE_SEPARATOR_URLS", "FAKE_SEPARATOR_ICON", "FOLDER_DEFAULT_NAMES",
     "Separator", "Bookmark", "SpecialFolder", "Folder", "_keep_child",
     "_d", "_o", "_oe", "_on",
+    "preorder", "postorder", "ENTER_FOLDER", "LEAF", "EXIT_FOLDER", "walk", "walk_pairs", "transform",
+    "cull_special_events",
+    "DEFAULT_WRITE_BUFSIZE", "BufferedWriter", "EventWriter", "DETECT_ENCODING_SIZE", "DecodingReader",
     "log",
 ]
@@ -0,0 +1,296 @@
+"""bkmk binary format, a compact snapshot that loads without parsing.
+
+Little-endian, laid out as:
+
+- a header, HEADER
+- a table of fixed-width node records, NODE, in pre-order; the root is node 0
+- the children of every folder, as node numbers (u32); each folder's record
+  gives the position of its first child in here, and how many it has
+- the string pool: string_count + 1 offsets (u64) into the data after them,
+  which is the UTF-8 of every distinct string one after the other
+
+Reading maps a large file with mmap where it can, and only creates the nodes
+of a folder's children when they are first accessed, so loading a large file
+costs next to nothing until it is used.
+
+A tree read from a mapped file reads from it until every folder has been
+accessed, so the file must not be truncated or rewritten in place meanwhile;
+on most systems that kills the process with SIGBUS. Files smaller than
+MMAP_MIN_SIZE are read into memory instead, where this can't happen; to
+rewrite a larger one, load the whole tree first, e.g. with copy.deepcopy(),
+or write a new file and rename it into place.
+"""
+
+from .base import *
+from .icons import IconPool
+
+import io
+import mmap
+import os
+import struct
+import threading
+
+from functools import partial
+
+MAGIC = b"BKMKBIN\0"
+VERSION = 1
+
+"""magic, version, node_count, children_count, string_count"""
+HEADER = struct.Struct("<8sIQQQ")
+"""kind, special, id, name, icon, url, date_added, date_modified,
+url_date_modified, url_date_visited, first child, number of children"""
+NODE = struct.Struct("<BB2x4I4q2I")
+CHILD = struct.Struct("<I")
+OFFSET = struct.Struct("<Q")
+
+KIND_SEPARATOR = 0
+KIND_BOOKMARK = 1
+KIND_FOLDER = 2
+
+"""Stored in place of a missing timestamp, and of no special folder"""
+NO_TIME = -(1 << 63)
+NO_SPECIAL = 0
+
+"""Files at least this big are mapped rather than read into memory"""
+MMAP_MIN_SIZE = 16 << 20
+
+def _t(ue):
+    return NO_TIME if ue is None else ue
+
+def _ut(t):
+    return None if t == NO_TIME else t
+
+_LOAD_LOCK = threading.RLock()
+
+class LazyChildren(list):
+    """A list of children that is only filled in from loader() on first use"""
+    __slots__ = ("_loader",)
+
+    def __init__(self, loader):
+        super().__init__()
+        self._loader = loader
+
+    def _load(self):
+        if self._loader is None: return
+        # writers on several threads may reach the same folder at once; none
+        # may see it until it is complete
+        with _LOAD_LOCK:
+            loader = self._loader
+            if loader is not None:
+                list.extend(self, loader())
+                self._loader = None
+
+    def __radd__(self, other):
+        # list + LazyChildren would otherwise add the empty list underneath
+        self._load()
+        return other + list(self)
+
+    def __reduce_ex__(self, protocol):
+        # copies and pickles are plain lists, without the file behind them
+        self._load()
+        return (list, (list(self),))
+
+def _loading(name):
+    method = getattr(list, name)
+    def load_then(self, *args, **kwargs):
+        self._load()
+        # list's own methods see the other's list underneath, so load that too
+        for arg in args:
+            if isinstance(arg, LazyChildren):
+                arg._load()
+        return method(self, *args, **kwargs)
+    load_then.__name__ = name
+    return load_then
+
+for _name in (
+    "__len__", "__iter__", "__reversed__", "__getitem__", "__setitem__", "__delitem__", "__contains__",
+    "__eq__", "__ne__", "__lt__", "__le__", "__gt__", "__ge__", "__repr__", "__add__", "__iadd__",
+    "__mul__", "__rmul__", "__imul__",
+    "append", "extend", "insert", "pop", "remove", "index", "count", "sort", "reverse", "clear", "copy",
+):
+    setattr(LazyChildren, _name, _loading(_name))
+del _name
+
+class BinaryReader:
+    def __init__(self, buf, icons):
+        self.buf = buf
+        self.icons = icons
+        if len(buf) < HEADER.size:
+            raise ValueError("not a bkmk-bin file: too short")
+        (magic, version, self.node_count, children_count, string_count) = HEADER.unpack_from(buf, 0)
+        if magic != MAGIC:
+            raise ValueError("not a bkmk-bin file")
+        if version != VERSION:
+            raise ValueError("unsupported bkmk-bin version: %s" % version)
+        self.nodes_at = HEADER.size
+        self.children_at = self.nodes_at + self.node_count * NODE.size
+        self.offsets_at = self.children_at + children_count * CHILD.size
+        self.strings_at = self.offsets_at + (string_count + 1) * OFFSET.size
+        self.children_count = children_count
+        self.string_count = string_count
+        if len(buf) < self.strings_at:
+            raise ValueError("bkmk-bin file is truncated")
+        # only what costs nothing is checked here; each record is checked as
+        # it is first read, so a damaged part fails once it is reached
+        (first_offset,) = OFFSET.unpack_from(buf, self.offsets_at)
+        (self.pool_size,) = OFFSET.unpack_from(buf, self.offsets_at + string_count * OFFSET.size)
+        if first_offset != 0:
+            raise ValueError("bkmk-bin file has a broken string table")
+        if self.strings_at + self.pool_size != len(buf):
+            raise ValueError("bkmk-bin file is truncated" if self.strings_at + self.pool_size > len(buf)
+                else "bkmk-bin file has trailing data")
+        if self.node_count == 0:
+            raise ValueError("bkmk-bin file has no root")
+        self.strings = {}
+
+    def string(self, i):
+        s = self.strings.get(i)
+        if s is None:
+            if i >= self.string_count:
+                raise ValueError("bkmk-bin string out of range: %s" % i)
+            (start, end) = struct.unpack_from("<2Q", self.buf, self.offsets_at + i * OFFSET.size)
+            if not start <= end <= self.pool_size:
+                raise ValueError("bkmk-bin file has a broken string table")
+            s = self.strings[i] = str(self.buf[self.strings_at + start:self.strings_at + end], "utf-8")
+        return s
+
+    def node(self, i):
+        (kind, special, id, name, icon, url, date_added, date_modified, url_date_modified, url_date_visited,
+            first, count) = NODE.unpack_from(self.buf, self.nodes_at + i * NODE.size)
+        s = self.string
+        if kind == KIND_SEPARATOR:
+            return Separator(s(id), _ut(date_added))
+        elif kind == KIND_BOOKMARK:
+            return Bookmark(s(id), _ut(date_added), s(name), self.icons.intern(s(icon)), _ut(date_modified),
+                s(url), _ut(url_date_modified), _ut(url_date_visited))
+        elif kind == KIND_FOLDER:
+            special = SpecialFolder(special) if special != NO_SPECIAL else None
+            if first + count > self.children_count:
+                raise ValueError("bkmk-bin node %s has children out of range" % i)
+            children = LazyChildren(partial(self.children, i, first, count)) if count else []
+            return Folder(s(id), _ut(date_added), s(name), self.icons.intern(s(icon)), _ut(date_modified), children, special)
+        else:
+            raise ValueError("unrecognised node kind: %s" % kind)
+
+    def children(self, parent, first, count):
+        at = self.children_at + first * CHILD.size
+        nodes = struct.unpack_from("<%dI" % count, self.buf, at)
+        # children come after their folder, as pre-order puts them, so a tree
+        # read from any file is finite
+        if min(nodes) <= parent or max(nodes) >= self.node_count:
+            raise ValueError("bkmk-bin node %s has children out of range" % parent)
+        return list(map(self.node, nodes))
+
+def read(fp_in, icons=None):
+    """Read a tree from fp_in, a binary file or an mmap, creating only the root until more is accessed.
+
+    The file holds one copy of each distinct string, so icons are already
+    shared; icons, an IconPool, is still used to drop them if asked to.
+
+    A file of MMAP_MIN_SIZE or more, or an mmap given as fp_in, must be left
+    as it is while the tree is still being loaded from it; see above.
+    """
+    icons = IconPool() if icons is None else icons
+    if isinstance(fp_in, mmap.mmap):
+        # already mapped by the caller
+        buf = fp_in
+    else:
+        try:
+            # anything else with a fileno, like a decompressing stream, reads
+            # something other than what is in the file
+            if not isinstance(fp_in, (io.FileIO, io.BufferedReader, io.BufferedRandom)):
+                raise io.UnsupportedOperation("not a plain file")
+            if os.fstat(fp_in.fileno()).st_size < MMAP_MIN_SIZE:
+                raise io.UnsupportedOperation("small enough to read")
+            buf = mmap.mmap(fp_in.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, OSError, ValueError):
+            # not a regular file, e.g. a pipe or a BytesIO; io.UnsupportedOperation is both
+            buf = fp_in.read()
+    root = BinaryReader(buf, icons).node(0)
+    if not isinstance(root, Folder):
+        raise ValueError("expected a folder at the top level, got: %s" % type(root).__name__)
+    return root
+
+def events(fp_in, icons=None):
+    """Yield (event, node, depth) for the tree in fp_in, creating nodes as they are reached"""
+    return walk(read(fp_in, icons))
+
+class BinaryWriter(EventWriter):
+    """Write a stream of events as bkmk-bin.
+
+    Node records are kept in a bytearray, and each folder's is completed once
+    its children are known, so only the strings are held as Python objects.
+    """
+    EMPTY = b""
+
+    def __init__(self, fp_out):
+        super().__init__(fp_out)
+        self.nodes = bytearray()
+        self.children = bytearray()
+        self.strings = {"": 0}
+        # for each open folder: [its node number, its children's node numbers]
+        self.open = []
+
+    def string(self, s):
+        i = self.strings.get(s)
+        if i is None:
+            i = self.strings[s] = len(self.strings)
+        return i
+
+    def add(self, node, kind, special=NO_SPECIAL):
+        i = len(self.nodes) // NODE.size
+        if self.open:
+            self.open[-1][1].append(i)
+        s = self.string
+        if kind == KIND_SEPARATOR:
+            (name, icon, date_modified) = (0, 0, NO_TIME)
+        else:
+            (name, icon, date_modified) = (s(node.name), s(node.icon), _t(node.date_modified))
+        if kind == KIND_BOOKMARK:
+            (url, url_date_modified, url_date_visited) = (s(node.url), _t(node.url_date_modified), _t(node.url_date_visited))
+        else:
+            (url, url_date_modified, url_date_visited) = (0, NO_TIME, NO_TIME)
+        self.nodes += NODE.pack(kind, special, s(node.id), name, icon, url, _t(node.date_added), date_modified,
+            url_date_modified, url_date_visited, 0, 0)
+        return i
+
+    def leaf(self, node, _depth):
+        self.add(node, KIND_SEPARATOR if isinstance(node, Separator) else KIND_BOOKMARK)
+
+    def enter_folder(self, node, _depth):
+        i = self.add(node, KIND_FOLDER, node.special.value if node.special is not None else NO_SPECIAL)
+        self.open.append([i, []])
+
+    def exit_folder(self, _node, _depth):
+        (i, children) = self.open.pop()
+        first = len(self.children) // CHILD.size
+        self.children += struct.pack("<%dI" % len(children), *children)
+        # fill in the first child and count, the last two fields
+        at = (i + 1) * NODE.size - 2 * CHILD.size
+        self.nodes[at:at + 2 * CHILD.size] = struct.pack("<2I", first, len(children))
+
+    def write_events(self, events):
+        self.handle_events(events)
+        encoded = [s.encode("utf-8") for s in self.strings]
+        offsets = [0]
+        for b in encoded:
+            offsets.append(offsets[-1] + len(b))
+        # the big sections are already in one piece, write them as they are
+        self.fp_out.write(HEADER.pack(MAGIC, VERSION, len(self.nodes) // NODE.size,
+            len(self.children) // CHILD.size, len(encoded)))
+        self.fp_out.write(self.nodes)
+        self.fp_out.write(self.children)
+        self.fp_out.write(struct.pack("<%dQ" % len(offsets), *offsets))
+        for b in encoded:
+            self.emit(b)
+        self.flush()
+
+def write_events(events, fp_out, _cull_special, _cull_attr):
+    BinaryWriter(fp_out).write_events(events)
+
+def write(root, fp_out, _cull_special, _cull_attr):
+    write_events(walk(root), fp_out, _cull_special, _cull_attr)
+
+def _roundtrip_acceptable_diff(*args):
+    # same as bkmk-json, no diff is acceptable
+    return False
@@ -1,37 +1,46 @@
 from .base import *
+from . import json_stream
+from .icons import IconPool
 
 import json
 
-def from_ast(node):
+def from_ast_node(node, _depth, icons=None):
+    """Convert a single node, with its children left empty, putting its icon through icons if given"""
     node_type = node["type"]
     id = node.get("id", "")
     date_added = node.get("date_added", None)
     name = node.get("name", "")
     icon = node.get("icon", "")
+    if icons is not None:
+        icon = icons.intern(icon)
     date_modified = node.get("date_modified", None)
     if node_type == "folder":
-        children = list(map(from_ast, node["children"]))
         special = SpecialFolder[node["special"]] if "special" in node else None
-        return Folder(id, date_added, name, icon, date_modified, children, special)
+        w = Folder(id, date_added, name, icon, date_modified, [], special)
+        return (w, w.children)
     elif node_type == "bookmark":
         url = node["url"]
         url_date_modified = node.get("url_date_modified", None)
         url_date_visited = node.get("url_date_visited", None)
-        return Bookmark(id, date_added, name, icon, date_modified, url, url_date_modified, url_date_visited)
+        return (Bookmark(id, date_added, name, icon, date_modified, url, url_date_modified, url_date_visited), None)
     elif node_type == "separator":
-        return Separator(id, date_added)
+        return (Separator(id, date_added), None)
     else:
         raise ValueError("unrecognised node type: %s" % node_type)
 
-def to_ast(node):
+def from_ast(node):
+    return transform(node, from_ast_node, lambda node: node["children"])
+
+def to_ast_node(node, _depth):
+    """Convert a single node, with its children left empty"""
     if isinstance(node, Separator):
-        return _d({
+        return (_d({
             "type": "separator",
             "id": _oe(node.id),
             "date_added": _on(node.date_added),
-        })
+        }), None)
     elif isinstance(node, Bookmark):
-        return _d({
+        return (_d({
             "type": "bookmark",
             "id": _oe(node.id),
             "date_added": _on(node.date_added),
@@ -41,26 +50,84 @@ def to_ast(node):
             "url": node.url,
             "url_date_modified": _on(node.url_date_modified),
             "url_date_visited": _on(node.url_date_visited),
-        })
+        }), None)
     elif isinstance(node, Folder):
-        return _d({
+        w = _d({
             "type": "folder",
             "id": _oe(node.id),
             "date_added": _on(node.date_added),
             "name": node.name,
             "icon": _oe(node.icon),
             "date_modified": _on(node.date_modified),
-            "children": list(map(to_ast, node.children)),
+            "children": [],
             "special": _o(node.special.name if node.special else None, None),
         })
+        return (w, w["children"])
     else:
         assert False
 
-def read(fp_in):
-    return from_ast(json.load(fp_in))
+def to_ast(node):
+    return transform(node, to_ast_node, lambda node: node.children)
+
+NODE_TYPES = ("folder", "bookmark", "separator")
+
+def from_parsed(node, icons=None):
+    """Convert an object from json_stream, whose children have already been converted.
+
+    Every object comes through here, not only nodes. Any that isn't a node,
+    like the value of a key this doesn't know, is returned as it is, so that
+    it is ignored as from_ast ignores it; so is a broken node, which then
+    fails in its parent, or at the top level.
+    """
+    if node.get("type") not in NODE_TYPES:
+        return node
+    try:
+        (w, out) = from_ast_node(node, None, icons)
+        if out is not None:
+            out.extend(node["children"])
+            for c in out:
+                if not isinstance(c, (Separator, Bookmark, Folder)):
+                    raise ValueError
+    except (KeyError, TypeError, ValueError):
+        return node
+    return w
+
+def _fail(node):
+    """Raise what from_ast would for node, which from_parsed left as it was"""
+    while True:
+        from_ast_node(node, None)
+        node = next(c for c in node["children"] if not isinstance(c, (Separator, Bookmark, Folder)))
+
+def read(fp_in, bufsize=json_stream.DEFAULT_BUFSIZE, icons=None):
+    """Read a tree from fp_in incrementally, same as from_ast(json.load(fp_in)).
+
+    Icons are interned in icons, an IconPool, or a new one if not given.
+    """
+    icons = IconPool() if icons is None else icons
+    root = json_stream.load(fp_in, lambda node: from_parsed(node, icons), bufsize)
+    if isinstance(root, dict):
+        _fail(root)
+    if not isinstance(root, (Separator, Bookmark, Folder)):
+        raise ValueError("expected a node at the top level, got: %s" % type(root).__name__)
+    return root
+
+def events(fp_in, bufsize=json_stream.DEFAULT_BUFSIZE, icons=None):
+    """Yield (event, node, depth) for the tree in fp_in.
+
+    A folder's "children" may come before the rest of its keys, so the tree is
+    read in full before the first event.
+    """
+    return walk(read(fp_in, bufsize, icons))
+
+def write_events(events, fp_out, _cull_attr, _cull_special, bufsize=DEFAULT_WRITE_BUFSIZE):
+    """Write a stream of (event, node, depth) as it comes, same as write()"""
+    w = json_stream.JSONTreeWriter(fp_out, to_ast_node, 0, bufsize)
+    w.handle_events(events)
+    w.flush()
 
-def write(root, fp_out, _cull_attr, _cull_special):
-    json.dump(to_ast(root), fp_out, indent=2)
+def write(root, fp_out, _cull_attr, _cull_special, bufsize=DEFAULT_WRITE_BUFSIZE):
+    """Write a tree node by node, same as json.dump(to_ast(root), fp_out, indent=2)"""
+    write_events(walk(root), fp_out, _cull_attr, _cull_special, bufsize)
 
 def _roundtrip_acceptable_diff(*args):
     # bkmk-json should support everything, no diff is acceptable
@@ -0,0 +1,162 @@
+"""An on-disk cache of parsed input files, so unchanged inputs are not parsed again.
+
+Each entry is the tree as read, stored as bkmk-bin, which loads without
+parsing. An entry is found by the path, size and mtime of the input, along
+with the format and read options it was read with; if those changed but the
+content did not, for example after a copy or a touch, it is found by a hash
+of the content instead.
+
+The directory holds two kinds of files:
+
+- KEY_SUFFIX: named after a hash of (path, size, mtime, format, options),
+  containing the name of the entry for it
+- ENTRY_SUFFIX: named after a hash of (content, format, options), containing
+  the tree
+
+Using a file brings its mtime up to date, and once the directory grows over
+its size limit the least recently used files are removed. Files are written
+under a temporary name and renamed into place, so several processes can
+share a directory.
+"""
+
+from .base import *
+
+import hashlib
+import os
+
+"""Default limit on the total size of the files in a cache directory"""
+DEFAULT_MAX_BYTES = 256 << 20
+
+"""Changes whenever what is cached for the same input would change"""
+CACHE_VERSION = 1
+
+KEY_SUFFIX = ".key"
+ENTRY_SUFFIX = ".bkmk.bin"
+
+_HASH_BUFSIZE = 1 << 20
+
+def _hexdigest(*parts):
+    return hashlib.blake2b(repr(parts).encode(), digest_size=20).hexdigest()
+
+def _file_path(fp_in):
+    """Return the path of the regular file fp_in reads from, or None"""
+    name = getattr(fp_in, "name", None)
+    if not isinstance(name, str):
+        return None
+    try:
+        same = os.path.samestat(os.fstat(fp_in.fileno()), os.stat(name))
+    except (AttributeError, OSError, ValueError):
+        return None
+    return os.path.abspath(name) if same and os.path.isfile(name) else None
+
+class ReadCache:
+    """A cache of parsed input files in the directory cache_dir.
+
+    hits and misses count the reads that were and were not served from the
+    cache, for those that could be cached at all.
+    """
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, name):
+        return os.path.join(self.cache_dir, name)
+
+    def _write(self, name, write):
+        import tempfile
+        os.makedirs(self.cache_dir, exist_ok=True)
+        (fd, tmp) = tempfile.mkstemp(dir=self.cache_dir, prefix=".tmp-")
+        try:
+            with open(fd, "wb") as fp:
+                write(fp)
+            os.replace(tmp, self._path(name))
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def _load(self, name):
+        """Return the tree in the entry name, or None if it isn't there or can't be read"""
+        from . import bkmk_bin
+        path = self._path(name)
+        try:
+            with open(path, "rb") as fp:
+                # only the header and sizes are checked up front, which catches
+                # an entry cut short; damage inside one that kept its size shows
+                # as a ValueError once the damaged part of the tree is reached
+                root = bkmk_bin.read(fp)
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        except ValueError as e:
+            log("warn: ignoring broken cache entry %s: %s" % (path, e))
+            return None
+        return root
+
+    def _content_hash(self, path):
+        h = hashlib.blake2b(digest_size=20)
+        with open(path, "rb") as fp:
+            for chunk in iter(lambda: fp.read(_HASH_BUFSIZE), b""):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def read(self, fp_in, fmt_in, opts, parse):
+        """Return the tree in fp_in, from the cache or else from parse(fp_in).
+
+        opts are the read options that parse applies, as a dict; they are part
+        of what is cached. Inputs that are not regular files, like pipes,
+        can't be cached and are always parsed.
+        """
+        path = _file_path(fp_in)
+        if path is None:
+            return parse(fp_in)
+        st = os.stat(path)
+        opts = sorted(opts.items())
+        key = _hexdigest(CACHE_VERSION, path, st.st_size, st.st_mtime_ns, fmt_in, opts) + KEY_SUFFIX
+        try:
+            with open(self._path(key)) as fp:
+                entry = fp.read()
+            os.utime(self._path(key))
+        except FileNotFoundError:
+            entry = None
+        root = self._load(entry) if entry else None
+        if root is None:
+            entry = _hexdigest(CACHE_VERSION, self._content_hash(path), fmt_in, opts) + ENTRY_SUFFIX
+            root = self._load(entry)
+            if root is None:
+                from . import bkmk_bin
+                self.misses += 1
+                root = parse(fp_in)
+                self._write(entry, lambda fp: bkmk_bin.write(root, fp, False, False))
+            else:
+                self.hits += 1
+            self._write(key, lambda fp: fp.write(entry.encode()))
+            self.evict()
+        else:
+            self.hits += 1
+        return root
+
+    def evict(self):
+        """Remove the least recently used files until the cache is within max_bytes"""
+        files = []
+        try:
+            entries = list(os.scandir(self.cache_dir))
+        except FileNotFoundError:
+            return
+        for f in entries:
+            if not f.name.endswith((KEY_SUFFIX, ENTRY_SUFFIX)): continue
+            try:
+                st = f.stat()
+            except FileNotFoundError:
+                continue
+            files.append((st.st_mtime_ns, st.st_size, f.path))
+        total = sum(size for (_, size, _) in files)
+        files.sort()
+        for (_, size, path) in files:
+            if total <= self.max_bytes: break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
@@ -1,17 +1,17 @@
 from .base import *
+from . import json_stream, timestamps
 
+import dataclasses
 import json
+import shutil
+import tempfile
 
-SUPPORTED_VERSION = 1
-WINDOWS_UNIX_DIFF = 11644473600000000
+from functools import partial
 
-def from_fmt_time(cs):
-    if cs is None: return None
-    return int(cs) - WINDOWS_UNIX_DIFF
+SUPPORTED_VERSION = 1
 
-def to_fmt_time(ue):
-    if ue is None: return None
-    return str(ue + WINDOWS_UNIX_DIFF)
+from_fmt_time = timestamps.WINDOWS_MICROS.decode
+to_fmt_time = timestamps.WINDOWS_MICROS.encode
 
 # chrome bookmarks have a bit of a customised root structure, deal with it here
 
@@ -24,7 +24,8 @@ SPECIAL_FOLDERS_BY_NAME = {
 
 SPECIAL_FOLDERS_BY_ENUM = {v: k for (k, v) in SPECIAL_FOLDERS_BY_NAME.items()}
 
-def from_ast(node, special=None):
+def from_ast_node(node, _depth, special=None):
+    """Convert a single node, with its children left empty"""
     node_type = node["type"]
     id = node.get("id", "")
     date_added = from_fmt_time(node.get("date_added", None))
@@ -32,22 +33,27 @@ def from_ast(node, special=None):
     icon = "" # TODO: not supported by format
     date_modified = from_fmt_time(node.get("date_modified", None))
     if node_type == "folder":
-        children = list(map(from_ast, node["children"]))
-        return Folder(id, date_added, name, icon, date_modified, children, special)
+        w = Folder(id, date_added, name, icon, date_modified, [], special)
+        return (w, w.children)
     elif node_type == "url":
         url = node["url"]
         url_date_modified = None # TODO: not supported by format
         url_date_visited = from_fmt_time(node.get("date_last_used", None))
         if any(url.startswith(f) for f in FAKE_SEPARATOR_URLS):
-            return Separator(id, date_added)
+            return (Separator(id, date_added), None)
         else:
-            return Bookmark(id, date_added, name, icon, date_modified, url, url_date_modified, url_date_visited)
+            return (Bookmark(id, date_added, name, icon, date_modified, url, url_date_modified, url_date_visited), None)
     else:
         raise ValueError("unrecognised node type: %s" % node_type)
 
-def to_ast(node, cull_special):
+def from_ast(node, special=None):
+    convert = lambda node, depth: from_ast_node(node, depth, special if depth == 0 else None)
+    return transform(node, convert, lambda node: node["children"])
+
+def to_ast_node(node, _depth):
+    """Convert a single node, with its children left empty"""
     if isinstance(node, Separator):
-        return _d({
+        return (_d({
             "type": "url",
             "id": _oe(node.id),
             "date_added": _on(to_fmt_time(node.date_added)),
@@ -56,9 +62,9 @@ def to_ast(node, cull_special):
             "date_modified": _on(to_fmt_time(node.date_added)),
             "url": FAKE_SEPARATOR_URLS[0],
             "date_last_used": _on(to_fmt_time(node.date_added)),
-        })
+        }), None)
     elif isinstance(node, Bookmark):
-        return _d({
+        return (_d({
             "type": "url",
             "id": _oe(node.id),
             "date_added": _on(to_fmt_time(node.date_added)),
@@ -69,25 +75,44 @@ def to_ast(node, cull_special):
             # TODO: not supported by format
             #"": _on(to_fmt_time(node.url_date_modified)),
             "date_last_used": _on(to_fmt_time(node.url_date_visited)),
-        })
+        }), None)
     elif isinstance(node, Folder):
-        return _d({
+        w = _d({
             "type": "folder",
             "id": _oe(node.id),
             "date_added": _on(to_fmt_time(node.date_added)),
             "name": node.name,
             "icon": _oe(node.icon),
             "date_modified": _on(to_fmt_time(node.date_modified)),
-            "children": [
-                to_ast(c, cull_special) for c in node.children
-                if _keep_child(cull_special, SPECIAL_FOLDERS_BY_ENUM.keys(), c)
-            ],
+            "children": [],
         })
+        return (w, w["children"])
     else:
         assert False
 
-def read(fp_in):
-    p = json.load(fp_in)
+def to_ast(node, cull_special):
+    children = lambda node: [
+        c for c in node.children
+        if _keep_child(cull_special, SPECIAL_FOLDERS_BY_ENUM.keys(), c)
+    ]
+    return transform(node, to_ast_node, children)
+
+def from_parsed(node):
+    """Convert an object from json_stream if it is a node, whose children have already been converted"""
+    if "type" not in node:
+        # the top level, roots and meta_info
+        return node
+    (w, out) = from_ast_node(node, None)
+    if out is not None:
+        out.extend(node["children"])
+    return w
+
+def read(fp_in, bufsize=json_stream.DEFAULT_BUFSIZE, icons=None):
+    """Read a tree from fp_in incrementally, converting nodes as soon as they are parsed.
+
+    The format has no icons, so icons is only there to match the other formats.
+    """
+    p = json_stream.load(fp_in, from_parsed, bufsize)
     if "version" not in p:
         ver = SUPPORTED_VERSION
         log("warn: no version found, assume we support it")
@@ -96,32 +121,101 @@ def read(fp_in):
         if ver != SUPPORTED_VERSION:
             raise ValueError("unsupported chrome-json version: %s" % ver)
 
-    w = from_ast(p["roots"][SPECIAL_FOLDERS_BY_ENUM[None]], None)
+    w = p["roots"][SPECIAL_FOLDERS_BY_ENUM[None]]
     assert isinstance(w, Folder)
     special_children = []
     for k, v in p["roots"].items():
         if k == SPECIAL_FOLDERS_BY_ENUM[None]: continue
-        root = from_ast(v, SPECIAL_FOLDERS_BY_NAME[k])
-        assert isinstance(root, Folder)
-        special_children.append(root)
+        special = SPECIAL_FOLDERS_BY_NAME[k]
+        assert isinstance(v, Folder)
+        v.special = special
+        special_children.append(v)
     w.children = special_children + w.children
     return w
 
-def write(root, fp_out, cull_special, _cull_attr):
-    w = {
-        "version": SUPPORTED_VERSION,
-        "roots": {},
-    }
+def events(fp_in, bufsize=json_stream.DEFAULT_BUFSIZE, icons=None):
+    """Yield (event, node, depth) for the tree in fp_in.
+
+    The special folders are separate roots that may come in any order, so the
+    tree is read in full before the first event.
+    """
+    return walk(read(fp_in, bufsize, icons))
+
+"""How much of each root write_events() keeps in memory before spilling to a temporary file"""
+SPOOL_MAX_SIZE = 1 << 22
+
+def write_events(events, fp_out, cull_special, _cull_attr, bufsize=DEFAULT_WRITE_BUFSIZE):
+    """Write a stream of (event, node, depth), same as write().
+
+    Each root has to be written whole, but the special folders are interleaved
+    with the other children of the tree's root. So every root is written to
+    its own temporary file as the events come, and they are copied out at the
+    end.
+    """
+    if cull_special:
+        events = cull_special_events(events, SPECIAL_FOLDERS_BY_ENUM.keys())
+    # name -> (spool, writer), in the order the roots are first seen
+    roots = {}
+    def new_root(name):
+        spool = tempfile.SpooledTemporaryFile(SPOOL_MAX_SIZE, "w+", encoding="utf-8")
+        if name in roots:
+            # a later special folder of the same kind replaces the earlier one
+            roots[name][0].close()
+        roots[name] = (spool, json_stream.JSONTreeWriter(spool, to_ast_node, 2, bufsize))
+        return roots[name][1]
+    try:
+        # the rest go under the root itself
+        synced = new_root(SPECIAL_FOLDERS_BY_ENUM[None])
+        # the writer for the special folder being written, if any
+        special = None
+        for (event, node, depth) in events:
+            # the events are named after the writer's methods
+            if special is not None:
+                getattr(special, event)(node, depth - 1)
+                if event == EXIT_FOLDER and depth == 1:
+                    special = None
+            elif event == ENTER_FOLDER and depth == 1 and node.special is not None:
+                special = new_root(SPECIAL_FOLDERS_BY_ENUM[node.special])
+                special.enter_folder(node, 0)
+            else:
+                getattr(synced, event)(node, depth)
+        # synced always comes last
+        roots[SPECIAL_FOLDERS_BY_ENUM[None]] = roots.pop(SPECIAL_FOLDERS_BY_ENUM[None])
+
+        fp_out.write('{\n  "version": %s,\n  "roots": {' % json.dumps(SUPPORTED_VERSION))
+        for (i, (name, (spool, w))) in enumerate(roots.items()):
+            fp_out.write("%s\n    %s: " % ("," if i else "", json.dumps(name)))
+            w.flush()
+            spool.seek(0)
+            shutil.copyfileobj(spool, fp_out)
+        fp_out.write("\n  }\n}")
+    finally:
+        for (spool, _) in roots.values():
+            spool.close()
+
+def write(root, fp_out, cull_special, _cull_attr, bufsize=DEFAULT_WRITE_BUFSIZE):
+    """Write a tree node by node, laid out like json.dump(indent=2).
+
+    Unlike write_events(), the roots are all at hand here, so each is written
+    straight to fp_out in turn without spooling.
+    """
     is_special = lambda c: isinstance(c, Folder) and c.special is not None
-    special_children = [c for c in root.children if is_special(c)]
-    for r in special_children:
-        w["roots"][SPECIAL_FOLDERS_BY_ENUM[r.special]] = to_ast(r, cull_special)
-    # writing to root is pretty hacky, oh well
-    orig_children = root.children
-    root.children = [c for c in root.children if not is_special(c)]
-    w["roots"][SPECIAL_FOLDERS_BY_ENUM[None]] = to_ast(root, cull_special)
-    json.dump(w, fp_out, indent=2)
-    root.children = orig_children
+    roots = {}
+    for r in root.children:
+        if is_special(r):
+            roots[SPECIAL_FOLDERS_BY_ENUM[r.special]] = r
+    # the rest go under the root itself, so write a copy of it with just those
+    rest = [c for c in root.children if not is_special(c)]
+    roots[SPECIAL_FOLDERS_BY_ENUM[None]] = dataclasses.replace(root, children=rest)
+
+    keep = partial(_keep_child, cull_special, SPECIAL_FOLDERS_BY_ENUM.keys())
+    w = json_stream.JSONTreeWriter(fp_out, to_ast_node, 2, bufsize)
+    w.emit('{\n  "version": %s,\n  "roots": {' % json.dumps(SUPPORTED_VERSION))
+    for (i, (name, r)) in enumerate(roots.items()):
+        w.emit("%s\n    %s: " % ("," if i else "", json.dumps(name)))
+        w.write_tree(r, keep)
+    w.emit("\n  }\n}")
+    w.flush()
 
 def _roundtrip_sortkey(node):
     if isinstance(node, Folder) and node.special:
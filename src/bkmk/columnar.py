@@ -0,0 +1,267 @@
+"""Columnar (struct-of-arrays) representation of a tree.
+
+For bulk edits and analytics over huge collections, where one Python object
+per node is too slow and too big. Nodes are rows, stored in pre-order so that
+every node comes after its parent and siblings keep their order. Numeric
+attributes live in typed arrays, strings in interned pools.
+"""
+
+from .base import *
+
+from array import array
+from bisect import bisect_left
+from dataclasses import dataclass, field
+from itertools import islice
+
+"""Stored in the timestamp columns in place of None"""
+NO_TIME = -(1 << 63)
+
+KIND_SEPARATOR = 0
+KIND_BOOKMARK = 1
+KIND_FOLDER = 2
+
+"""Stored in the special column in place of None"""
+NO_SPECIAL = -1
+
+"""The timestamp columns, and the kinds of node that have each of them"""
+TIME_COLUMNS = {
+    "date_added": (KIND_SEPARATOR, KIND_BOOKMARK, KIND_FOLDER),
+    "date_modified": (KIND_BOOKMARK, KIND_FOLDER),
+    "url_date_modified": (KIND_BOOKMARK,),
+    "url_date_visited": (KIND_BOOKMARK,),
+}
+
+class StringPool:
+    """Interned strings, referred to by their index in the pool"""
+    def __init__(self, strings=("",)):
+        self.strings = list(strings)
+        self._index = None
+
+    @property
+    def index(self):
+        """Map from string to index, only built when needed"""
+        if self._index is None:
+            self._index = {s: i for (i, s) in enumerate(self.strings)}
+        return self._index
+
+    def add(self, s):
+        i = self.index.get(s)
+        if i is None:
+            i = self.index[s] = len(self.strings)
+            self.strings.append(s)
+        return i
+
+    def __getitem__(self, i):
+        return self.strings[i]
+
+    def __len__(self):
+        return len(self.strings)
+
+_TYPECODES = {"parent": "i", "kind": "b", "special": "b", "id": "I", "name": "I", "icon": "I", "url": "I"}
+
+def _t(ue):
+    return NO_TIME if ue is None else ue
+
+def _ut(t):
+    return None if t == NO_TIME else t
+
+@dataclass
+class ColumnarTree:
+    parent: array # of row index, or -1 for the root
+    kind: array # of KIND_*
+    special: array # of SpecialFolder value, or NO_SPECIAL
+    id: array # of index into ids
+    name: array # of index into names
+    icon: array # of index into icons
+    url: array # of index into urls
+    date_added: array # of unix epoch micros, or NO_TIME
+    date_modified: array
+    url_date_modified: array
+    url_date_visited: array
+    ids: StringPool
+    names: StringPool
+    icons: StringPool
+    urls: StringPool
+    # column -> its rows in the order of its values, built by select()
+    _sorted: dict = field(default_factory=dict, repr=False, compare=False)
+
+    def __len__(self):
+        return len(self.kind)
+
+    @classmethod
+    def from_tree(cls, root):
+        ids, names, icons, urls = StringPool(), StringPool(), StringPool(), StringPool()
+        cols = {c: [] for c in ("parent", "kind", "special", "id", "name", "icon", "url", *TIME_COLUMNS)}
+        parent, kind, special, id, name, icon, url, date_added, date_modified, url_date_modified, url_date_visited = cols.values()
+        stack = [(root, -1)]
+        while stack:
+            node, p = stack.pop()
+            row = len(kind)
+            parent.append(p)
+            id.append(ids.add(node.id))
+            date_added.append(_t(node.date_added))
+            if isinstance(node, Bookmark):
+                kind.append(KIND_BOOKMARK)
+                special.append(NO_SPECIAL)
+                url.append(urls.add(node.url))
+                url_date_modified.append(_t(node.url_date_modified))
+                url_date_visited.append(_t(node.url_date_visited))
+            else:
+                url.append(0)
+                url_date_modified.append(NO_TIME)
+                url_date_visited.append(NO_TIME)
+                if isinstance(node, Folder):
+                    kind.append(KIND_FOLDER)
+                    special.append(node.special.value if node.special is not None else NO_SPECIAL)
+                    stack.extend((c, row) for c in reversed(node.children))
+                else:
+                    kind.append(KIND_SEPARATOR)
+                    special.append(NO_SPECIAL)
+            if isinstance(node, Separator):
+                name.append(0)
+                icon.append(0)
+                date_modified.append(NO_TIME)
+            else:
+                name.append(names.add(node.name))
+                icon.append(icons.add(node.icon))
+                date_modified.append(_t(node.date_modified))
+        return cls(**{c: array(_TYPECODES.get(c, "q"), v) for (c, v) in cols.items()},
+            ids=ids, names=names, icons=icons, urls=urls)
+
+    def to_tree(self):
+        nodes = []
+        for i in range(len(self.kind)):
+            kind = self.kind[i]
+            id = self.ids[self.id[i]]
+            date_added = _ut(self.date_added[i])
+            if kind == KIND_SEPARATOR:
+                node = Separator(id, date_added)
+            elif kind == KIND_BOOKMARK:
+                node = Bookmark(
+                    id, date_added, self.names[self.name[i]], self.icons[self.icon[i]], _ut(self.date_modified[i]),
+                    self.urls[self.url[i]], _ut(self.url_date_modified[i]), _ut(self.url_date_visited[i]))
+            else:
+                special = SpecialFolder(self.special[i]) if self.special[i] != NO_SPECIAL else None
+                node = Folder(
+                    id, date_added, self.names[self.name[i]], self.icons[self.icon[i]], _ut(self.date_modified[i]),
+                    [], special)
+            if self.parent[i] >= 0:
+                nodes[self.parent[i]].children.append(node)
+            nodes.append(node)
+        return nodes[0]
+
+    def fill_timestamps(self, ts):
+        """Fill in missing timestamps, same as Bookmarks.fill_timestamps"""
+        kind_runs = {}
+        for (column, kinds) in TIME_COLUMNS.items():
+            values = getattr(self, column)
+            missing = _runs(values, NO_TIME)
+            if not missing: continue
+            self._sorted.pop(column, None)
+            # rows of the other kinds don't have the column at all; missing
+            # rows come in long runs, e.g. the whole column when no format
+            # fills it in, so each run is filled with one slice assignment
+            others = []
+            for kind in {KIND_SEPARATOR, KIND_BOOKMARK, KIND_FOLDER}.difference(kinds):
+                if kind not in kind_runs:
+                    kind_runs[kind] = _runs(self.kind, kind)
+                others += kind_runs[kind]
+            others.sort()
+            for (start, end) in _subtract(missing, others):
+                values[start:end] = array("q", [ts]) * (end - start)
+
+    def prefix_ids(self, prefix):
+        """Add a prefix to all existing ids, same as Bookmarks.prefix_ids"""
+        # ids are interned, so this only touches the pool, never the rows
+        strings = self.ids.strings
+        self.ids = StringPool([strings[0], *map(prefix.__add__, islice(strings, 1, None))])
+
+    def select(self, column, start=None, end=None):
+        """Return the rows whose timestamp column is in the range [start, end).
+
+        Rows where the timestamp is missing are never selected. The first call
+        for a column sorts it, later calls only bisect; the sort is redone
+        after fill_timestamps, but not if the arrays are modified directly.
+        """
+        if column not in TIME_COLUMNS:
+            raise ValueError("not a timestamp column: %s" % column)
+        values = getattr(self, column)
+        if column not in self._sorted:
+            # keys from a list are the ints already in it, where the array
+            # would make a new one for each
+            self._sorted[column] = array("i", sorted(range(len(values)), key=values.tolist().__getitem__))
+        order = self._sorted[column]
+        # bisected through the order rather than on a sorted copy of the
+        # values, which would take longer to build than the searches save
+        by_value = _Ordered(values, order)
+        lo = bisect_left(by_value, NO_TIME + 1 if start is None else max(start, NO_TIME + 1))
+        hi = len(values) if end is None else bisect_left(by_value, end, lo)
+        return array("i", sorted(order[lo:hi]))
+
+class _Ordered:
+    """values, seen in the order of the row indices order, for bisect"""
+    def __init__(self, values, order):
+        self.values = values
+        self.order = order
+
+    def __getitem__(self, i):
+        return self.values[self.order[i]]
+
+    def __len__(self):
+        return len(self.order)
+
+def _runs(values, v):
+    """Return the runs of v in the array values, as a list of (start, end) indices"""
+    data = values.tobytes()
+    size = values.itemsize
+    item = array(values.typecode, [v]).tobytes()
+    pattern = None
+    runs = []
+    i = data.find(item)
+    while i >= 0:
+        if i % size:
+            # straddles two items
+            i = data.find(item, i + 1)
+            continue
+        if not data.startswith(item, i + size):
+            # a run of one, as often as not
+            runs.append((i // size, i // size + 1))
+            i = data.find(item, i + size)
+            continue
+        if pattern is None:
+            pattern = memoryview(item * len(values))
+        # lo items from i are known to be v, hi are known not to be; double
+        # lo until it is past the end of the run, then bisect for it, only
+        # ever comparing the items past lo
+        (lo, hi) = (2, (len(data) - i) // size + 1)
+        n = 4
+        while n < hi:
+            if data.startswith(pattern[:(n - lo) * size], i + lo * size):
+                (lo, n) = (n, n * 2)
+            else:
+                hi = n
+        while hi - lo > 1:
+            n = (lo + hi) // 2
+            if data.startswith(pattern[:(n - lo) * size], i + lo * size):
+                lo = n
+            else:
+                hi = n
+        runs.append((i // size, i // size + lo))
+        i = data.find(item, i + lo * size)
+    return runs
+
+def _subtract(runs, holes):
+    """Yield the parts of runs outside of holes, both sorted lists of (start, end) that don't overlap"""
+    holes = iter(holes)
+    hole = next(holes, None)
+    for (start, end) in runs:
+        while hole is not None and hole[1] <= start:
+            hole = next(holes, None)
+        while hole is not None and hole[0] < end:
+            if hole[0] > start:
+                yield (start, hole[0])
+            start = max(start, hole[1])
+            if hole[1] > end: break
+            hole = next(holes, None)
+        if start < end:
+            yield (start, end)
@@ -0,0 +1,191 @@
+"""Compressed input and output, streamed through gzip, bz2 and lzma.
+
+Compressions stack, as in a.xbel.gz.xz; lists of them are always outermost
+first, the order they are undone in when reading. They are recognised by
+file extension, or when reading, by the magic bytes each starts with.
+"""
+
+from .base import *
+
+import io
+
+from dataclasses import dataclass
+
+@dataclass(frozen=True)
+class Compression:
+    name: str
+    ext: str
+    magic: bytes
+    """Module whose open() streams it"""
+    module: str
+
+COMPRESSIONS = {c.name: c for c in (
+    Compression("gzip", ".gz", b"\x1f\x8b", "gzip"),
+    Compression("bz2", ".bz2", b"BZh", "bz2"),
+    Compression("xz", ".xz", b"\xfd7zXZ\x00", "lzma"),
+)}
+
+_MAGIC_SIZE = max(len(c.magic) for c in COMPRESSIONS.values())
+
+def split_ext(path):
+    """Return path without its compression extensions, and their compressions"""
+    compressions = []
+    while True:
+        for c in COMPRESSIONS.values():
+            if path.endswith(c.ext) and len(path) > len(c.ext):
+                path = path[:-len(c.ext)]
+                compressions.append(c.name)
+                break
+        else:
+            return (path, compressions)
+
+def _compressions(compression):
+    if compression is None:
+        return []
+    if isinstance(compression, str):
+        compression = [compression]
+    try:
+        return [COMPRESSIONS[name] for name in compression]
+    except KeyError as e:
+        raise ValueError("not a valid compression: %s" % e.args[0]) from None
+
+def _open(c, fp, mode):
+    import importlib
+    # given a file object, this never closes it
+    return importlib.import_module(c.module).open(fp, mode)
+
+class _Prefixed(io.RawIOBase):
+    """fp, with bytes already read from it put back in front"""
+    def __init__(self, prefix, fp):
+        super().__init__()
+        self.prefix = prefix
+        self.fp = fp
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self.prefix:
+            data = self.prefix[:len(b)]
+            self.prefix = self.prefix[len(data):]
+        else:
+            data = getattr(self.fp, "read1", self.fp.read)(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+class _Layers(io.BufferedIOBase):
+    """The last of layers, streams wrapped one around the other over fp.
+
+    Closing it closes every layer, outermost first, so each can finish what
+    it wrote into the next; fp is left open. The name and fileno are fp's,
+    so a ReadCache can still tell which file it is.
+    """
+    def __init__(self, fp, layers):
+        super().__init__()
+        self.fp = fp
+        self.layers = layers
+
+    @property
+    def top(self):
+        return self.layers[-1] if self.layers else self.fp
+
+    @property
+    def name(self):
+        return self.fp.name
+
+    def fileno(self):
+        return self.fp.fileno()
+
+    def readable(self):
+        return self.top.readable()
+
+    def writable(self):
+        return self.top.writable()
+
+    def read(self, size=-1):
+        return self.top.read(size)
+
+    def read1(self, size=-1):
+        return getattr(self.top, "read1", self.top.read)(size)
+
+    def readinto(self, b):
+        return self.top.readinto(b)
+
+    def write(self, b):
+        return self.top.write(b)
+
+    def flush(self):
+        if not self.top.closed:
+            self.top.flush()
+
+    def close(self):
+        if self.closed: return
+        try:
+            super().close()
+        finally:
+            for layer in reversed(self.layers):
+                layer.close()
+
+def _head(fp):
+    """Return the first bytes of fp, and a stream of all of it"""
+    peek = getattr(fp, "peek", None)
+    if peek is not None:
+        # usually enough, and then nothing is consumed
+        head = peek(_MAGIC_SIZE)
+        if len(head) >= _MAGIC_SIZE:
+            return (head[:_MAGIC_SIZE], None)
+    head = fp.read(_MAGIC_SIZE)
+    return (head, io.BufferedReader(_Prefixed(head, fp)))
+
+def _detect(fp_in):
+    found = []
+    layers = []
+    fp = fp_in
+    while True:
+        (head, prefixed) = _head(fp)
+        if prefixed is not None:
+            fp = prefixed
+            layers.append(fp)
+        for c in COMPRESSIONS.values():
+            if head.startswith(c.magic):
+                found.append(c.name)
+                fp = _open(c, fp, "rb")
+                layers.append(fp)
+                break
+        else:
+            return (found, layers)
+
+def detect(fp_in):
+    """Return the names of the compressions fp_in starts with the magic bytes of, outermost first.
+
+    This reads from fp_in, so it is only useful to know what reader(fp_in,
+    "auto") would do, or with a file that can be seeked back.
+    """
+    return _detect(fp_in)[0]
+
+def reader(fp_in, compression):
+    """Return a binary stream of fp_in, a binary file, decompressed.
+
+    compression is "auto" to detect it from the magic bytes, or a name or a
+    list of names from COMPRESSIONS. Closing it leaves fp_in open. Formats
+    read binary input themselves, so it is not decoded here.
+    """
+    if compression == "auto":
+        layers = _detect(fp_in)[1]
+    else:
+        layers = []
+        for c in _compressions(compression):
+            layers.append(_open(c, layers[-1] if layers else fp_in, "rb"))
+    return _Layers(fp_in, layers)
+
+def writer(fp_out, compression, text=False, encoding=None):
+    """Return a stream that compresses into fp_out, a binary file.
+
+    compression is a name or a list of names from COMPRESSIONS. The stream
+    must be closed to finish the compressed data, which leaves fp_out open.
+    """
+    layers = []
+    for c in _compressions(compression):
+        layers.append(_open(c, layers[-1] if layers else fp_out, "wb"))
+    fp = _Layers(fp_out, layers)
+    return io.TextIOWrapper(fp, encoding) if text else fp
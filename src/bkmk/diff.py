@@ -0,0 +1,262 @@
+"""Structural diff between two trees, and patches to turn one into the other.
+
+Nodes of the new tree are matched to nodes of the old one by id, falling back
+to url for bookmarks and to path for folders. What is left over is deleted or
+inserted; matched nodes whose folder changed, or whose place among their
+siblings did, are moved; and matched nodes whose attributes differ are
+updated.
+
+A patch refers to nodes of the old tree by their position in pre-order, and
+to inserted nodes by numbers after those, so it is plain JSON and only as
+big as the changes.
+"""
+
+from .base import *
+
+from bisect import bisect_left
+from dataclasses import dataclass
+
+"""Version of the patch format"""
+PATCH_VERSION = 1
+
+UPDATE = "update"
+DELETE = "delete"
+INSERT = "insert"
+MOVE = "move"
+
+_ATTRS = {
+    Separator: ("id", "date_added"),
+    Bookmark: ("id", "date_added", "name", "icon", "date_modified", "url", "url_date_modified", "url_date_visited"),
+    Folder: ("id", "date_added", "name", "icon", "date_modified", "special"),
+}
+
+def _to_json_attr(attr, v):
+    return v.name if attr == "special" and v is not None else v
+
+def _from_json_attr(attr, v):
+    return SpecialFolder[v] if attr == "special" and v is not None else v
+
+def _to_value(node):
+    from . import bkmk_json
+    obj = bkmk_json.to_ast_node(node, 0)[0]
+    obj.pop("children", None)
+    return obj
+
+def _from_value(obj):
+    from . import bkmk_json
+    if obj.get("type") == "folder":
+        obj = dict(obj, children=[])
+    return bkmk_json.from_ast_node(obj, 0)[0]
+
+@dataclass
+class Patch:
+    """The changes from one tree to another, as produced by diff().
+
+    ops is a list of, in this order:
+
+    - [UPDATE, node, {attribute: new value}]
+    - [DELETE, node], for nodes whose folder is kept; the rest go with it
+    - [INSERT, node, folder, index, value] and [MOVE, node, folder, index],
+      in pre-order of the new tree
+
+    where value is the node as in bkmk-json, without children.
+    """
+    """Number of nodes in the tree this applies to"""
+    base: int
+    ops: list
+
+    def to_json(self):
+        return {"version": PATCH_VERSION, "base": self.base, "ops": self.ops}
+
+    @classmethod
+    def from_json(cls, obj):
+        if obj.get("version") != PATCH_VERSION:
+            raise ValueError("unsupported patch version: %s" % obj.get("version"))
+        return cls(obj["base"], obj["ops"])
+
+    def _count(self, op):
+        return sum(1 for o in self.ops if o[0] == op)
+
+    def summary(self):
+        """Return the number of each kind of change"""
+        return {op: self._count(op) for op in (INSERT, DELETE, MOVE, UPDATE)}
+
+def _folder_key(folder):
+    return ("special", folder.special.name) if folder.special is not None else ("name", folder.name)
+
+def _index_tree(root):
+    """Return the nodes in pre-order, and id(node) -> (parent, position among its siblings)"""
+    nodes = []
+    parents = {id(root): (None, 0)}
+    for node in preorder(root):
+        nodes.append(node)
+        if isinstance(node, Folder):
+            for (i, c) in enumerate(node.children):
+                parents[id(c)] = (node, i)
+    return (nodes, parents)
+
+def _paths(root):
+    """Yield (folder, path) for every folder under root, path being a tuple of _folder_key"""
+    stack = [(root, ())]
+    while stack:
+        (folder, path) = stack.pop()
+        yield (folder, path)
+        for c in reversed(folder.children):
+            if isinstance(c, Folder):
+                stack.append((c, path + (_folder_key(c),)))
+
+def _preorder_skipping(root, skip):
+    """Like preorder, but without the children of folders whose id() is in skip"""
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        yield node
+        if isinstance(node, Folder) and id(node) not in skip:
+            stack.extend(reversed(node.children))
+
+def _lis(seq):
+    """Return the positions in seq of a longest increasing subsequence"""
+    tails = []
+    tails_at = []
+    prev = [None] * len(seq)
+    for (i, v) in enumerate(seq):
+        j = bisect_left(tails, v)
+        if j == len(tails):
+            tails.append(v)
+            tails_at.append(i)
+        else:
+            tails[j] = v
+            tails_at[j] = i
+        prev[i] = tails_at[j - 1] if j else None
+    out = []
+    i = tails_at[-1] if tails_at else None
+    while i is not None:
+        out.append(i)
+        i = prev[i]
+    out.reverse()
+    return out
+
+def diff(a, b, hash_a=None, hash_b=None):
+    """Return the Patch from the tree a to the tree b.
+
+    Given hash functions for the nodes of each tree, like TreeIndex.hash,
+    folders with equal hashes are matched as a whole without looking inside.
+    """
+    (a_nodes, a_parents) = _index_tree(a)
+    ref = {id(n): i for (i, n) in enumerate(a_nodes)}
+    by_id = {}
+    for n in a_nodes:
+        if n.id:
+            # ids should be unique, but don't match on those that aren't
+            by_id[n.id] = n if n.id not in by_id else None
+    by_url = {}
+    for n in a_nodes:
+        if isinstance(n, Bookmark):
+            by_url.setdefault(n.url, []).append(n)
+    by_path = {path: f for (f, path) in _paths(a)}
+
+    # id(node in b) -> matched node in a
+    match = {id(b): a}
+    matched = {id(a)}
+    # id() of folders in b that were matched as a whole
+    same = set()
+    if hash_a is not None and hash_b is not None:
+        if hash_a(a) == hash_b(b):
+            return Patch(len(a_nodes), [])
+        by_hash = {}
+        for n in a_nodes:
+            if isinstance(n, Folder):
+                by_hash.setdefault(hash_a(n), n)
+        stack = list(reversed(b.children))
+        while stack:
+            node = stack.pop()
+            if not isinstance(node, Folder): continue
+            candidate = by_hash.get(hash_b(node))
+            if candidate is not None:
+                pairs = list(zip(preorder(node), preorder(candidate)))
+                if not any(id(o) in matched for (_, o) in pairs):
+                    for (n, o) in pairs:
+                        match[id(n)] = o
+                        matched.add(id(o))
+                    same.add(id(node))
+                    continue
+            stack.extend(reversed(node.children))
+    def try_match(node, candidate):
+        if candidate is not None and type(candidate) == type(node) and id(candidate) not in matched:
+            match[id(node)] = candidate
+            matched.add(id(candidate))
+            return True
+        return False
+    b_paths = {id(f): path for (f, path) in _paths(b)}
+    for node in _preorder_skipping(b, same):
+        if node is b or id(node) in match: continue
+        if node.id and try_match(node, by_id.get(node.id)):
+            continue
+        if isinstance(node, Bookmark):
+            for candidate in by_url.get(node.url, ()):
+                if try_match(node, candidate): break
+        elif isinstance(node, Folder):
+            try_match(node, by_path.get(b_paths[id(node)]))
+
+    ops = []
+    for node in _preorder_skipping(b, same):
+        old = match.get(id(node))
+        if old is None: continue
+        changes = {attr: _to_json_attr(attr, getattr(node, attr))
+            for attr in _ATTRS[type(node)] if getattr(node, attr) != getattr(old, attr)}
+        if changes:
+            ops.append([UPDATE, ref[id(old)], changes])
+    for n in a_nodes:
+        if id(n) not in matched and id(a_parents[id(n)][0]) in matched:
+            ops.append([DELETE, ref[id(n)]])
+
+    new_ref = {}
+    for folder in _preorder_skipping(b, same):
+        if not isinstance(folder, Folder) or id(folder) in same: continue
+        old = match.get(id(folder))
+        folder_ref = ref[id(old)] if old is not None else new_ref[id(folder)]
+        # children that were already in this folder keep their place, unless
+        # they changed order among themselves; keep the most of them we can
+        staying = []
+        for (i, c) in enumerate(folder.children):
+            o = match.get(id(c))
+            if o is not None and old is not None and a_parents[id(o)][0] is old:
+                staying.append((i, a_parents[id(o)][1]))
+        kept = {staying[j][0] for j in _lis([pos for (_, pos) in staying])}
+        for (i, c) in enumerate(folder.children):
+            if i in kept: continue
+            o = match.get(id(c))
+            if o is None:
+                new_ref[id(c)] = len(a_nodes) + len(new_ref)
+                ops.append([INSERT, new_ref[id(c)], folder_ref, i, _to_value(c)])
+            else:
+                ops.append([MOVE, ref[id(o)], folder_ref, i])
+    return Patch(len(a_nodes), ops)
+
+def apply_patch(root, patch):
+    """Apply patch to the tree root in place, turning it into the new tree the patch was made from"""
+    (nodes, parents) = _index_tree(root)
+    if len(nodes) != patch.base:
+        raise ValueError("patch is for a tree of %d nodes, not %d" % (patch.base, len(nodes)))
+    detach = set()
+    for op in patch.ops:
+        if op[0] == UPDATE:
+            node = nodes[op[1]]
+            for (attr, v) in op[2].items():
+                if attr not in _ATTRS[type(node)]:
+                    raise ValueError("not an attribute of %s: %s" % (type(node).__name__, attr))
+                setattr(node, attr, _from_json_attr(attr, v))
+        elif op[0] in (DELETE, MOVE):
+            detach.add(id(nodes[op[1]]))
+    for folder in {id(p): p for (p, _) in map(parents.__getitem__, detach)}.values():
+        folder.children = [c for c in folder.children if id(c) not in detach]
+    for op in patch.ops:
+        if op[0] == INSERT:
+            if op[1] != len(nodes):
+                raise ValueError("inserted nodes out of order: %s" % op[1])
+            nodes.append(_from_value(op[4]))
+            nodes[op[2]].children.insert(op[3], nodes[-1])
+        elif op[0] == MOVE:
+            nodes[op[2]].children.insert(op[3], nodes[op[1]])
+        elif op[0] not in (UPDATE, DELETE):
+            raise ValueError("unrecognised patch op: %s" % op[0])
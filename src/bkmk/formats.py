@@ -0,0 +1,175 @@
+"""The registry of formats, each implemented by a module imported on first use.
+
+A format module provides:
+
+- read(fp_in, icons=None), returning the root Folder
+- events(fp_in, icons=None), yielding (event, node, depth) as walk() does
+- write(root, fp_out, cull_special, cull_attr)
+- write_events(events, fp_out, cull_special, cull_attr)
+
+where icons is an IconPool to put every icon through. fp_in and fp_out are
+text files, unless the Format says it is binary; a text format that can
+also read bytes, decoding them itself, says so with reads_bytes, and is then
+given binary input where that is what there is, e.g. when decompressing.
+
+Other packages can add formats through the ENTRY_POINT_GROUP entry point
+group, each entry point naming a Format. Only the modules of the formats that
+are used get imported; plugins are only looked for once a format is asked for
+that isn't built in, or all of them are listed.
+"""
+
+from .base import *
+
+import importlib
+
+from collections.abc import Mapping
+from dataclasses import dataclass
+
+ENTRY_POINT_GROUP = "bkmk.formats"
+
+@dataclass(frozen=True)
+class Format:
+    name: str
+    """One line, for help text"""
+    description: str
+    """Absolute name of the module implementing the format"""
+    module: str
+    """File extensions; the first is written with, the others only guessed from
+    when no format has them first"""
+    exts: tuple = ()
+    """Whether files are read and written as bytes, in binary mode"""
+    binary: bool = False
+    """Whether read and events also take a binary file or an mmap"""
+    reads_bytes: bool = False
+
+BUILTIN_FORMATS = (
+    Format("bkmk-json", "bkmk JSON - own custom format, easiest for scripting with jq(1)",
+        "bkmk.bkmk_json", (".bkmk.json", ".json"), reads_bytes=True),
+    Format("xbel", "XML Bookmark Exchange Language 1.0",
+        "bkmk.xbel", (".xbel",), reads_bytes=True),
+    Format("netscape-html", "NETSCAPE Bookmark file 1 - supported by most browsers including Firefox and Chrome",
+        "bkmk.netscape_html", (".html",), reads_bytes=True),
+    Format("chrome-json", "Chrome Bookmarks JSON - used internally by Chrome",
+        "bkmk.chrome_json", (".json",), reads_bytes=True),
+    Format("bkmk-bin", "bkmk binary - own compact snapshot, loads lazily without parsing; needs binary files",
+        "bkmk.bkmk_bin", (".bkmk.bin",), binary=True),
+)
+
+def _entry_points():
+    import importlib.metadata
+    eps = importlib.metadata.entry_points()
+    if hasattr(eps, "select"):
+        return eps.select(group=ENTRY_POINT_GROUP)
+    # Python < 3.10
+    return eps.get(ENTRY_POINT_GROUP, [])
+
+class FormatRegistry:
+    def __init__(self, formats=()):
+        self.formats = {}
+        self.modules = {}
+        self.plugins_loaded = False
+        for fmt in formats:
+            self.register(fmt)
+
+    def register(self, fmt):
+        """Add a Format; each name can only be registered once"""
+        if not isinstance(fmt, Format):
+            raise TypeError("not a Format: %r" % (fmt,))
+        if fmt.name in self.formats:
+            raise ValueError("format already registered: %s" % fmt.name)
+        self.formats[fmt.name] = fmt
+
+    def load_plugins(self):
+        """Register the formats of the ENTRY_POINT_GROUP entry points, once"""
+        if self.plugins_loaded: return
+        self.plugins_loaded = True
+        for ep in _entry_points():
+            try:
+                self.register(ep.load())
+            except Exception as e:
+                log("warn: ignoring format plugin %s: %s: %s" % (ep.name, type(e).__name__, e))
+
+    def get(self, name):
+        fmt = self.formats.get(name)
+        if fmt is None and not self.plugins_loaded:
+            self.load_plugins()
+            fmt = self.formats.get(name)
+        if fmt is None:
+            raise ValueError("not a valid format: %s" % name)
+        return fmt
+
+    def all(self):
+        self.load_plugins()
+        return list(self.formats.values())
+
+    def module(self, name):
+        """Return the module implementing the format, importing it on first use"""
+        module = self.modules.get(name)
+        if module is None:
+            module = self.modules[name] = importlib.import_module(self.get(name).module)
+        return module
+
+    def exts(self, formats=None):
+        """Return a map from extension to the formats using it, most specific extensions first"""
+        formats = self.all() if formats is None else formats
+        primary = {}
+        secondary = {}
+        for fmt in formats:
+            for (i, ext) in enumerate(fmt.exts):
+                (secondary if i else primary).setdefault(ext, []).append(fmt.name)
+        exts = {ext: primary.get(ext, []) + secondary.get(ext, []) for ext in (*primary, *secondary)}
+        # so that e.g. .bkmk.json is matched before .json
+        return dict(sorted(exts.items(), key=lambda item: -len(item[0])))
+
+    def guess(self, path):
+        """Return the extension of path, and the formats it could be in, best first.
+
+        Plugins are only looked at when no format known so far matches, so
+        they can't take over the extensions of the built in formats, e.g.
+        .json, nor any path ending in them.
+        """
+        for formats in (list(self.formats.values()), None):
+            if formats is None:
+                if self.plugins_loaded: break
+                self.load_plugins()
+            for (ext, names) in self.exts(formats).items():
+                if path.endswith(ext):
+                    return (ext, names)
+        return (None, [])
+
+REGISTRY = FormatRegistry(BUILTIN_FORMATS)
+
+def register_format(fmt):
+    """Add a Format to the registry, for formats that aren't installed as a plugin"""
+    REGISTRY.register(fmt)
+
+class FormatsView(Mapping):
+    """A read-only view of the registry, from name to description"""
+    def __getitem__(self, name):
+        try:
+            return REGISTRY.get(name).description
+        except ValueError:
+            raise KeyError(name) from None
+
+    def __iter__(self):
+        return iter([fmt.name for fmt in REGISTRY.all()])
+
+    def __len__(self):
+        return len(REGISTRY.all())
+
+    def __repr__(self):
+        return repr(dict(self))
+
+class FormatExtsView(Mapping):
+    """A read-only view of the registry, from extension to the formats using it"""
+    def __getitem__(self, ext):
+        return REGISTRY.exts()[ext]
+
+    def __iter__(self):
+        return iter(REGISTRY.exts())
+
+    def __len__(self):
+        return len(REGISTRY.exts())
+
+    def __repr__(self):
+        return repr(dict(self))
@@ -0,0 +1,59 @@
+"""Icons, shared between the nodes that have the same one.
+
+Icons are usually data: URLs of a few KB each, and exports repeat the same
+one for every bookmark of a site. Readers put every icon through an IconPool,
+so a tree holds only one copy of each distinct icon however many nodes use it,
+or none at all if icons are dropped.
+"""
+
+from .base import *
+
+from collections import Counter
+from functools import lru_cache
+
+"""How many distinct icons writers keep the escaped form of"""
+ICON_MEMO_SIZE = 1024
+
+class IconPool:
+    """Interns the icons of the nodes being read.
+
+    intern(icon) returns the copy of icon already in the pool, adding it if it
+    is new, so equal icons end up as the same string. With drop set, every
+    icon becomes "" instead.
+    """
+    def __init__(self, drop=False):
+        self.drop = drop
+        self.icons = {"": ""}
+
+    def intern(self, icon):
+        if self.drop: return ""
+        return self.icons.setdefault(icon, icon)
+
+    def __len__(self):
+        return len(self.icons)
+
+def icon_refcounts(root):
+    """Return the number of nodes using each icon in the tree, not counting the empty icon"""
+    return Counter(n.icon for n in preorder(root) if not isinstance(n, Separator) and n.icon)
+
+@lru_cache(256)
+def icon_data(icon):
+    """Decode a data: URL icon into (media type, bytes), or None if it isn't one.
+
+    Icons are kept as they were read, and only decoded when asked for here;
+    the result is memoised, as the same icons tend to be asked for repeatedly.
+    """
+    if not icon.startswith("data:") or "," not in icon:
+        return None
+    import base64
+    import binascii
+    import urllib.parse
+    (header, data) = icon[5:].split(",", 1)
+    params = header.split(";")
+    media_type = params[0] or "text/plain"
+    try:
+        if params[-1] == "base64":
+            return (media_type, base64.b64decode(data, validate=True))
+        return (media_type, urllib.parse.unquote_to_bytes(data))
+    except (binascii.Error, ValueError):
+        return None
@@ -0,0 +1,149 @@
+"""Hash indexes over a tree, for fast lookups by id and url, and of parents.
+
+Nodes are dataclasses that compare by value, so they cannot be dict keys;
+parents are keyed by id() of the node instead, which is only safe as long as
+the nodes stay in the tree.
+
+Also Merkle hashes of subtrees, so that equal subtrees can be found without
+comparing them node by node.
+"""
+
+from .base import *
+
+import hashlib
+
+_HASHED_ATTRS = {
+    Separator: ("id", "date_added"),
+    Bookmark: ("id", "date_added", "name", "icon", "date_modified", "url", "url_date_modified", "url_date_visited"),
+    Folder: ("id", "date_added", "name", "icon", "date_modified"),
+}
+
+def node_hash(node, child_hashes=()):
+    """Hash a node's attributes, and for a folder its special and its children's hashes in order"""
+    ty = type(node)
+    h = hashlib.blake2b(repr((ty.__name__, *map(node.__getattribute__, _HASHED_ATTRS[ty]))).encode(), digest_size=16)
+    if ty is Folder:
+        h.update(repr(node.special.name if node.special is not None else None).encode())
+        for c in child_hashes:
+            h.update(c)
+    return h.digest()
+
+def subtree_hash(node, hashes):
+    """Return the hash of the subtree at node.
+
+    hashes maps id(node) -> (node, hash) for the subtrees hashed so far;
+    those in it are trusted, and the rest are added.
+    """
+    cached = hashes.get(id(node))
+    if cached is not None:
+        return cached[1]
+    # a folder is pushed twice: to push its children, then to hash it after them
+    stack = [(node, False)]
+    while stack:
+        (n, ready) = stack.pop()
+        if id(n) in hashes: continue
+        if ready:
+            hashes[id(n)] = (n, node_hash(n, [hashes[id(c)][1] for c in n.children]))
+        elif isinstance(n, Folder):
+            stack.append((n, True))
+            stack.extend((c, False) for c in reversed(n.children) if id(c) not in hashes)
+        else:
+            hashes[id(n)] = (n, node_hash(n))
+    return hashes[id(node)][1]
+
+def hasher():
+    """Return a function hashing subtrees like TreeIndex.hash, with its own cache.
+
+    Nothing is cached between calls of hasher(), so it is right whatever
+    has been done to the tree before, unlike a TreeIndex.
+    """
+    hashes = {}
+    return lambda node: subtree_hash(node, hashes)
+
+class TreeIndex:
+    """Maps from id to node, from url to bookmarks, and from node to parent.
+
+    Built in one pass over the tree. It is not updated when the tree is
+    modified directly, only by the methods of Bookmarks that modify it;
+    otherwise build a new one.
+    """
+    def __init__(self, root):
+        self.root = root
+        # id -> first node with it in pre-order; nodes without an id are not included
+        self.by_id = {}
+        # url -> bookmarks with it, in pre-order
+        self.by_url = {}
+        # id(node) -> parent folder
+        self.parents = {}
+        # id -> all nodes with it, only for ids used more than once
+        self.dups = {}
+        # id(node) -> (node, hash of its subtree), filled in by hash(); the
+        # node is kept so its id() can't be reused while it's in here
+        self.hashes = {}
+        for node in preorder(root):
+            self._add_id(node)
+            if isinstance(node, Folder):
+                for c in node.children:
+                    self._add(c, node)
+
+    def _add(self, node, parent):
+        """Index a new node, except for its id"""
+        self.parents[id(node)] = parent
+        if isinstance(node, Bookmark):
+            self.by_url.setdefault(node.url, []).append(node)
+
+    def _add_id(self, node):
+        if not node.id: return
+        first = self.by_id.setdefault(node.id, node)
+        if first is not node:
+            self.dups.setdefault(node.id, [first]).append(node)
+
+    def _prefix_ids(self, prefix):
+        """Update for all ids having been prefixed"""
+        self.by_id = {prefix + k: v for (k, v) in self.by_id.items()}
+        self.dups = {prefix + k: v for (k, v) in self.dups.items()}
+
+    def get_id(self, id):
+        """Return the node with this id, or None"""
+        return self.by_id.get(id)
+
+    def get_url(self, url):
+        """Return the bookmarks with this url, in pre-order"""
+        return self.by_url.get(url, [])
+
+    def parent(self, node):
+        """Return the folder containing node, or None for the root"""
+        return self.parents.get(id(node))
+
+    def path(self, node):
+        """Return the folders from the root down to the one containing node"""
+        path = []
+        parent = self.parent(node)
+        while parent is not None:
+            path.append(parent)
+            parent = self.parent(parent)
+        path.reverse()
+        return path
+
+    def hash(self, node=None):
+        """Return the hash of the subtree at node, or of the whole tree.
+
+        Hashes are cached, so after the first call only changed subtrees are
+        hashed again; that relies on changed() being called for every change.
+        """
+        return subtree_hash(self.root if node is None else node, self.hashes)
+
+    def changed(self, node):
+        """Invalidate the hashes of node and the folders above it.
+
+        Call this after changing a node's attributes, or the order of a
+        folder's children. Adding or removing nodes also changes parents,
+        ids and urls, so call Bookmarks.invalidate_index() after that instead.
+        """
+        while node is not None:
+            self.hashes.pop(id(node), None)
+            node = self.parent(node)
+
+    def duplicate_ids(self):
+        """Return a map from each id used more than once, to the nodes using it"""
+        return self.dups
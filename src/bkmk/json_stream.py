@@ -0,0 +1,241 @@
+"""Incremental JSON reading and writing, for the JSON based formats.
+
+json.load() needs the whole text in memory, and builds every object before a
+format can convert any of them. Here the text is read in chunks, and each
+object is handed to a hook as soon as it is complete, so a format can replace
+it with its own node and let the raw dict go.
+
+Likewise json.dump() needs a complete copy of the tree as dicts and lists,
+whereas JSONTreeWriter writes it out node by node.
+"""
+
+from .base import *
+
+import json
+import re
+
+from json import JSONDecodeError
+
+"""Default size of the chunks that load() reads"""
+DEFAULT_BUFSIZE = 1 << 16
+
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+_BARE_TOKEN = re.compile(r'[^,:\[\]{}" \t\n\r]*')
+_NESTED = object()
+
+class JSONReader:
+    """Parse one JSON value from fp_in, reading it in chunks of bufsize.
+
+    A negative bufsize reads the whole input in one go. fp_in may be text, or
+    binary in UTF-8, UTF-16 or UTF-32 as json.loads() detects on bytes.
+
+    Objects and arrays are tracked on an explicit stack, so nesting depth is
+    only limited by memory. Everything else, including objects with nothing
+    nested inside them, is decoded by json itself, which is much faster.
+    """
+    def __init__(self, fp_in, object_hook=None, bufsize=DEFAULT_BUFSIZE):
+        self.fp_in = DecodingReader(fp_in, json.detect_encoding)
+        self.object_hook = object_hook
+        self.bufsize = bufsize
+        self.decoder = json.JSONDecoder()
+        self.object_decoder = json.JSONDecoder(object_hook=object_hook)
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def more(self):
+        """Read another chunk, dropping what has already been parsed"""
+        if self.eof: return False
+        chunk = self.fp_in.read(self.bufsize)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Skip whitespace and return the next character, or "" at the end"""
+        while True:
+            self.pos = _WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.more():
+                return ""
+
+    def error(self, msg):
+        # positions are relative to the current chunk, not the whole input
+        return JSONDecodeError(msg, self.buf, self.pos)
+
+    def scalar(self):
+        if self.buf[self.pos:self.pos+1] != '"':
+            # numbers and literals: make sure we have all of it, json would
+            # happily decode just the start of a number
+            while _BARE_TOKEN.match(self.buf, self.pos).end() == len(self.buf) and self.more():
+                pass
+        while True:
+            try:
+                (value, end) = self.decoder.raw_decode(self.buf, self.pos)
+            except JSONDecodeError:
+                # maybe the value continues in the next chunk
+                if self.more(): continue
+                raise
+            self.pos = end
+            return value
+
+    def flat_object(self):
+        """Decode an object in one go if nothing seems nested inside it, otherwise return _NESTED"""
+        while True:
+            (buf, pos) = (self.buf, self.pos)
+            end = buf.find("}", pos)
+            if end >= 0:
+                if buf.find("[", pos, end) >= 0 or buf.find("{", pos + 1, end) >= 0:
+                    # probably nested, though it could be inside a string
+                    return _NESTED
+                try:
+                    (obj, self.pos) = self.object_decoder.raw_decode(buf, pos)
+                    return obj
+                except JSONDecodeError:
+                    # that "}" was inside a string, so it might be incomplete
+                    pass
+            if len(buf) - pos < self.bufsize and self.more(): continue
+            return _NESTED
+
+    def key(self):
+        if self.peek() != '"':
+            raise self.error("Expecting property name enclosed in double quotes")
+        key = self.scalar()
+        if self.peek() != ":":
+            raise self.error("Expecting ':' delimiter")
+        self.pos += 1
+        return key
+
+    def hook(self, obj):
+        return self.object_hook(obj) if self.object_hook is not None else obj
+
+    def read(self):
+        # [container, key for the next value if container is a dict]
+        stack = []
+        while True:
+            c = self.peek()
+            if c == "{":
+                value = self.flat_object()
+                if value is _NESTED:
+                    self.pos += 1
+                    if self.peek() == "}":
+                        self.pos += 1
+                        value = self.hook({})
+                    else:
+                        stack.append([{}, self.key()])
+                        continue
+            elif c == "[":
+                self.pos += 1
+                if self.peek() == "]":
+                    self.pos += 1
+                    value = []
+                else:
+                    stack.append([[], None])
+                    continue
+            else:
+                value = self.scalar()
+            # add the value to its container, and close any containers that end here
+            while True:
+                if not stack:
+                    if self.peek() != "":
+                        raise self.error("Extra data")
+                    return value
+                frame = stack[-1]
+                (container, key) = frame
+                is_dict = key is not None
+                if is_dict:
+                    container[key] = value
+                else:
+                    container.append(value)
+                c = self.peek()
+                if c == ",":
+                    self.pos += 1
+                    if is_dict:
+                        frame[1] = self.key()
+                    break
+                elif c == ("}" if is_dict else "]"):
+                    self.pos += 1
+                    stack.pop()
+                    value = self.hook(container) if is_dict else container
+                else:
+                    raise self.error("Expecting ',' delimiter")
+
+def load(fp_in, object_hook=None, bufsize=DEFAULT_BUFSIZE):
+    """Parse the JSON value in fp_in, same as json.load(fp_in, object_hook=object_hook).
+
+    object_hook is called on every object once it is complete, including the
+    objects inside it, and its result is used in place of the object.
+    """
+    return JSONReader(fp_in, object_hook, bufsize).read()
+
+_encode = json.JSONEncoder().encode
+
+def _value(v, indent):
+    if isinstance(v, (dict, list)) and v:
+        # only scalars are expected, but lay anything else out the same way
+        return json.dumps(v, indent=2).replace("\n", "\n" + indent)
+    return _encode(v)
+
+def _items(d, indent):
+    return ["%s: %s" % (_encode(k), _value(v, indent)) for (k, v) in d.items()]
+
+def dumps_object(d, level):
+    """Format d like json.dump(indent=2) does, for an object nested level deep"""
+    if not d: return "{}"
+    indent = "  " * (level+1)
+    return "{\n%s%s\n%s}" % (indent, (",\n" + indent).join(_items(d, indent)), "  " * level)
+
+class JSONTreeWriter(EventWriter):
+    """Write a tree as JSON text a node at a time, laid out like json.dump(indent=2).
+
+    convert(node, depth) gives (object, children), like a format's to_ast_node,
+    with the object's "children" list left empty. The root object is written
+    nested level deep. Only what is needed for the open folders is kept, so
+    memory does not grow with the size of the tree.
+    """
+    def __init__(self, fp_out, convert, level=0, bufsize=DEFAULT_WRITE_BUFSIZE):
+        super().__init__(fp_out, bufsize)
+        self.convert = convert
+        self.level = level
+        # for each open folder: [number of children written, text to write after them]
+        self.open = []
+
+    def begin_child(self):
+        if not self.open: return
+        frame = self.open[-1]
+        indent = "\n" + "  " * (self.level + 2 * len(self.open))
+        self.emit(indent if frame[0] == 0 else "," + indent)
+        frame[0] += 1
+
+    def leaf(self, node, depth):
+        self.begin_child()
+        self.emit(dumps_object(self.convert(node, depth)[0], self.level + 2 * depth))
+
+    def enter_folder(self, node, depth):
+        self.begin_child()
+        obj = self.convert(node, depth)[0]
+        keys = list(obj.keys())
+        i = keys.index("children")
+        level = self.level + 2 * depth
+        indent = "  " * (level+1)
+        before = _items({k: obj[k] for k in keys[:i]}, indent)
+        after = _items({k: obj[k] for k in keys[i+1:]}, indent)
+        self.emit("{\n%s%s" % (indent, "".join(item + ",\n" + indent for item in before)))
+        self.emit('"children": [')
+        end = "".join(",\n" + indent + item for item in after) + "\n%s}" % ("  " * level)
+        self.open.append([0, end])
+
+    def exit_folder(self, node, depth):
+        (count, end) = self.open.pop()
+        if count:
+            self.emit("\n%s]" % ("  " * (self.level + 2 * depth + 1)))
+        else:
+            self.emit("]")
+        self.emit(end)
+
+    def write_tree(self, root, keep=None):
+        self.handle_events(walk(root, keep))
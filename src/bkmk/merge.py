@@ -0,0 +1,107 @@
+"""Merging several trees into one, in a single pass over each of them.
+
+Folders are matched by their path from the root: special folders by which
+special folder they are, others by name. Bookmarks and separators are matched
+anywhere in the tree by url or id, through a TreeIndex of the result, so the
+whole merge is linear in the total size of the trees.
+"""
+
+from .base import *
+
+import dataclasses
+
+"""What to deduplicate bookmarks by"""
+DEDUP_KEYS = ("url", "id", None)
+
+"""How to resolve the attributes of matched nodes: keep those of the newest by
+date_modified, or the first or last one merged"""
+MERGE_STRATEGIES = ("newest", "first", "last")
+
+_MERGED_ATTRS = {
+    Separator: (),
+    Bookmark: ("name", "icon", "date_modified", "url_date_modified", "url_date_visited"),
+    Folder: ("name", "icon", "date_modified"),
+}
+
+def _take_other(node, other, strategy):
+    if strategy == "first":
+        return False
+    elif strategy == "last":
+        return True
+    else:
+        # a missing date is older than any other
+        return other.date_modified is not None and (node.date_modified is None or other.date_modified > node.date_modified)
+
+def merge_attrs(node, other, strategy):
+    """Resolve the attributes of node and other, a match of the same type, into node.
+
+    Ids, urls, children and special are never changed; date_added becomes the
+    earliest of the two.
+    """
+    if other.date_added is not None and (node.date_added is None or other.date_added < node.date_added):
+        node.date_added = other.date_added
+    if not isinstance(node, Separator) and _take_other(node, other, strategy):
+        for attr in _MERGED_ATTRS[type(node)]:
+            setattr(node, attr, getattr(other, attr))
+
+def _folder_key(folder):
+    return ("special", folder.special) if folder.special is not None else ("name", folder.name)
+
+def merge(index, other, dedup="url", strategy="newest"):
+    """Merge the tree other into index.root, keeping index up to date.
+
+    Nodes are copied from other, which is left as it is. Separators are only
+    copied into folders that this merge created, unless dedup is None, as
+    otherwise every merge of the same folder would add more of them.
+    """
+    if dedup not in DEDUP_KEYS:
+        raise ValueError("not a valid dedup key: %s" % dedup)
+    if strategy not in MERGE_STRATEGIES:
+        raise ValueError("not a valid merge strategy: %s" % strategy)
+    root = index.root
+    merge_attrs(root, other, strategy)
+    # id(folder) -> {_folder_key: subfolder}, for folders in the result
+    subfolders = {}
+    def find_subfolder(target, folder):
+        if id(target) not in subfolders:
+            subfolders[id(target)] = m = {}
+            for c in target.children:
+                if isinstance(c, Folder):
+                    m.setdefault(_folder_key(c), c)
+        return subfolders[id(target)].get(_folder_key(folder))
+    def add(node, target):
+        target.children.append(node)
+        index._add(node, target)
+        index._add_id(node)
+    # [iterator over a folder's children in other, the folder they go into, whether the merge created it]
+    stack = [[iter(other.children), root, False]]
+    while stack:
+        (it, target, created) = stack[-1]
+        node = next(it, None)
+        if node is None:
+            stack.pop()
+            continue
+        if isinstance(node, Folder):
+            sub = find_subfolder(target, node)
+            if sub is not None:
+                merge_attrs(sub, node, strategy)
+                stack.append([iter(node.children), sub, False])
+            else:
+                sub = dataclasses.replace(node, children=[])
+                add(sub, target)
+                subfolders[id(target)][_folder_key(sub)] = sub
+                stack.append([iter(node.children), sub, True])
+            continue
+        match = None
+        if dedup == "url" and isinstance(node, Bookmark):
+            match = next(iter(index.get_url(node.url)), None)
+        elif dedup == "id" and node.id:
+            match = index.get_id(node.id)
+            if type(match) != type(node):
+                match = None
+        if match is not None:
+            merge_attrs(match, node, strategy)
+        elif isinstance(node, Separator) and dedup is not None and not created:
+            pass
+        else:
+            add(dataclasses.replace(node), target)
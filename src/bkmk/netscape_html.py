@@ -1,19 +1,45 @@
 from .base import *
+from . import timestamps
+from .icons import ICON_MEMO_SIZE, IconPool
 
+import codecs
+import re
 import sys
 
-from html import escape
+from functools import lru_cache
+from html import escape, unescape
 from html.parser import HTMLParser
 
 DOCTYPE = "NETSCAPE-Bookmark-file-1"
 
-def from_fmt_time(u):
-    if u is None: return None
-    return int(u) * 1000000
+"""Default size of the chunks that read() feeds to the parser"""
+DEFAULT_BUFSIZE = 1 << 16
 
-def to_fmt_time(ue):
-    if ue is None: return None
-    return str(int(ue / 1000000.0))
+_META_CHARSET = re.compile(rb"""<meta[^>]*charset\s*=\s*["']?([-\w.:]+)""", re.IGNORECASE)
+
+def detect_encoding(head):
+    """Return the encoding of a file starting with head: from its BOM, else its <META> charset, else UTF-8"""
+    if head.startswith(codecs.BOM_UTF8):
+        return "utf-8-sig"
+    if head.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return "utf-16"
+    m = _META_CHARSET.search(head)
+    if m is None:
+        return "utf-8"
+    charset = m.group(1).decode("ascii")
+    try:
+        encoding = codecs.lookup(charset).name
+    except LookupError:
+        log("warn: unknown charset %s, reading as UTF-8 instead" % charset)
+        return "utf-8"
+    # it was just read as ASCII, so it can't be that, as browsers also assume
+    return "utf-8" if encoding.startswith(("utf-16", "utf-32")) else encoding
+
+"""Parser engines supported by read()"""
+ENGINES = ("html.parser", "fast")
+
+from_fmt_time = timestamps.UNIX_SECONDS.decode
+to_fmt_time = timestamps.UNIX_SECONDS.encode
 
 SPECIAL_FOLDERS_BY_NAME = {
     "personal_toolbar_folder": SpecialFolder.TOOLBAR,
@@ -22,6 +48,8 @@ SPECIAL_FOLDERS_BY_NAME = {
 
 SPECIAL_FOLDERS_BY_ENUM = {v: k for (k, v) in SPECIAL_FOLDERS_BY_NAME.items()}
 
+_FAKE_SEPARATOR_URLS = tuple(FAKE_SEPARATOR_URLS)
+
 def from_special_folder(attrs):
     for a, b in SPECIAL_FOLDERS_BY_NAME.items():
         if attrs.get(a, "") == "true":
@@ -35,16 +63,21 @@ def to_special_folder(folder):
 # we write our own custom parser because these files don't have </dt> tags
 # which really confuses beautifulsoup and makes it generate incorrect stuff
 # like <dt><dt><dt></dt></dt></dt>
-class NetscapeHTMLParser(HTMLParser):
-    def __init__(self):
-        super().__init__(convert_charrefs=True)
+class NetscapeTreeBuilder:
+    """Build a tree from the handle_* callbacks of a parser engine, interning icons in icons"""
+    def __init__(self, icons=None):
+        self.icons = IconPool() if icons is None else icons
         self.started = False
         self.stack = []
         self.result = None
+        self.data = []
 
     def current(self):
         return self.stack[-1] if self.stack else None
 
+    def push_root(self, folder):
+        self.stack.append(folder)
+
     def append_child(self, elem):
         cur = self.current()
         assert isinstance(cur, Folder)
@@ -56,139 +89,384 @@ class NetscapeHTMLParser(HTMLParser):
         if not isinstance(cur, Folder):
             self.stack.pop()
 
+    def pop_folder(self):
+        n = self.stack.pop()
+        if not self.stack:
+            assert not self.result
+            self.result = n
+
+    def flush_data(self):
+        if not self.data: return
+        data = "".join(self.data).strip()
+        self.data.clear()
+        cur = self.current()
+        if not cur: return
+        if not data: return
+        if isinstance(cur, Separator): return # floccus and other fake separators
+        cur.name += data
+
+    def new_anchor(self, id, date_added, attrs):
+        icon = self.icons.intern(attrs.get("icon", ""))
+        date_modified = from_fmt_time(attrs.get("last_modified", None))
+        url = attrs["href"]
+        if url.startswith(_FAKE_SEPARATOR_URLS):
+            # floccus uses fake separators even though netscape-html supports real ones
+            return Separator(id, date_added)
+        else:
+            url_date_modified = None # TODO: not supported by format
+            url_date_visited = from_fmt_time(attrs.get("last_visit", None))
+            return Bookmark(id, date_added, "", icon, date_modified, url, url_date_modified, url_date_visited)
+
     def handle_starttag(self, tag, attrs):
+        self.flush_data()
         if not self.started:
             raise ValueError("did not see expected DOCTYPE")
+        if tag == "dt":
+            # there are no closing <dt> tags. this effectively closes off the previous Bookmark
+            # it is a no-op if the current item is a Folder
+            self.pop_any_child()
+            return
+        elif tag == "dl":
+            if not isinstance(self.current(), Folder):
+                # hack around floccus and possibly other tools not writing <h1>
+                assert not self.stack
+                self.push_root(Folder.new())
+            return
+        elif tag not in ("h1", "h3", "a", "hr"):
+            return
+
         attrs = dict(attrs)
         id = attrs.get("id", "")
         date_added = from_fmt_time(attrs.get("add_date", None))
 
         if tag in ("h1", "h3"):
-            icon = attrs.get("icon", "")
+            icon = self.icons.intern(attrs.get("icon", ""))
             date_modified = from_fmt_time(attrs.get("last_modified", None))
             special = from_special_folder(attrs) if tag == "h3" else None
             folder = Folder(id, date_added, "", icon, date_modified, [], special)
             if tag == "h1":
-                self.stack.append(folder)
+                self.push_root(folder)
             else:
                 self.append_child(folder)
         elif tag == "a":
-            icon = attrs.get("icon", "")
-            date_modified = from_fmt_time(attrs.get("last_modified", None))
-            url = attrs["href"]
-            if any(url.startswith(f) for f in FAKE_SEPARATOR_URLS):
-                # floccus uses fake separators even though netscape-html supports real ones
-                b = Separator(id, date_added)
-            else:
-                url_date_modified = None # TODO: not supported by format
-                url_date_visited = from_fmt_time(attrs.get("last_visit", None))
-                b = Bookmark(id, date_added, "", icon, date_modified, url, url_date_modified, url_date_visited)
-            self.append_child(b)
+            self.append_child(self.new_anchor(id, date_added, attrs))
         elif tag == "hr":
             self.pop_any_child()
             self.append_child(Separator(id, date_added))
-        elif tag == "dt":
-            # there are no closing <dt> tags. this effectively closes off the previous Bookmark
-            # it is a no-op if the current item is a Folder
-            self.pop_any_child()
-        elif tag == "dl":
-            if not isinstance(self.current(), Folder):
-                # hack around floccus and possibly other tools not writing <h1>
-                assert not self.stack
-                self.stack.append(Folder.new())
 
     def handle_endtag(self, tag):
+        self.flush_data()
         if tag == "dl":
-            if not isinstance(self.current(), Folder):
-                self.stack.pop()
+            self.pop_any_child()
             assert isinstance(self.current(), Folder)
-            n = self.stack.pop()
-            if not self.stack:
-                assert not self.result
-                self.result = n
+            self.pop_folder()
 
     def handle_comment(self, data):
-        pass
+        self.flush_data()
 
     def handle_decl(self, data):
+        self.flush_data()
         if data == "DOCTYPE " + DOCTYPE:
             self.started = True
 
+    def handle_pi(self, data):
+        self.flush_data()
+
     def handle_data(self, data):
+        # the data may be split into multiple chunks, e.g. when it straddles
+        # two feed() calls; buffer it until the next bit of markup
+        self.data.append(data)
+
+class NetscapeEventBuilder(NetscapeTreeBuilder):
+    """Like NetscapeTreeBuilder, but turn nodes into events as soon as they are complete.
+
+    Nodes are not added to their parents, so memory does not grow with the
+    size of the input. A folder's ENTER_FOLDER waits for its first child so
+    that its name is known; text between its children, which the tree builder
+    would add to its name, is lost.
+    """
+    def __init__(self, icons=None):
+        super().__init__(icons)
+        self.events = []
+        # the folder on top of the stack, if its ENTER_FOLDER is still to come
+        self.pending = None
+
+    def enter_pending(self):
+        if self.pending is not None:
+            self.events.append((ENTER_FOLDER, self.pending, len(self.stack) - 1))
+            self.pending = None
+
+    def push_root(self, folder):
+        self.stack.append(folder)
+        self.pending = folder
+
+    def append_child(self, elem):
+        assert isinstance(self.current(), Folder)
+        self.enter_pending()
+        self.stack.append(elem)
+        if isinstance(elem, Folder):
+            self.pending = elem
+
+    def pop_any_child(self):
         cur = self.current()
-        if not cur: return
-        data = data.strip()
-        if not data: return
-        if isinstance(cur, Separator): return # floccus and other fake separators
-        # sometimes the data is split into multiple chunks
-        cur.name += data
+        if not isinstance(cur, Folder):
+            self.stack.pop()
+            self.events.append((LEAF, cur, len(self.stack)))
+
+    def pop_folder(self):
+        self.enter_pending()
+        n = self.stack.pop()
+        self.events.append((EXIT_FOLDER, n, len(self.stack)))
+        if not self.stack:
+            assert not self.result
+            self.result = n
+
+class NetscapeHTMLParser(NetscapeTreeBuilder, HTMLParser):
+    def __init__(self, icons=None):
+        HTMLParser.__init__(self, convert_charrefs=True)
+        NetscapeTreeBuilder.__init__(self, icons)
+
+    def close(self):
+        HTMLParser.close(self)
+        self.flush_data()
+
+class NetscapeHTMLEventParser(NetscapeEventBuilder, NetscapeHTMLParser):
+    pass
+
+class _Malformed(Exception):
+    pass
+
+# only the subset of HTML that bookmark exporters actually write; anything else
+# is _Malformed and makes read() fall back to NetscapeHTMLParser
+_TOKEN = re.compile(r"""<(?:
+    ([a-zA-Z][a-zA-Z0-9]*)((?:\s+[^\s"'/<=>]+(?:\s*=\s*(?:"[^"]*"|'[^']*'))?)*)\s*>
+  | /([a-zA-Z][-.a-zA-Z0-9:_]*)\s*>
+  | !--(.*?)-->
+  | !([dD][oO][cC][tT][yY][pP][eE][^>]*)>
+)""", re.S | re.X)
+# the most common line in any export, equivalent to <DT> <A ...> name </A>
+_BOOKMARK = re.compile(r"""<[dD][tT]><[aA]((?:\s+[^\s"'/<=>]+(?:\s*=\s*(?:"[^"]*"|'[^']*'))?)*)\s*>([^<]*)</[aA]>""")
+_ATTR = re.compile(r"""([^\s"'/<=>]+)(?:\s*=\s*("[^"]*"|'[^']*'))?""")
+_NOT_TAG_OPEN = re.compile(r"<[^a-zA-Z/!?]")
+# elements whose content HTMLParser does not (or, depending on the Python
+# version, might not) parse as normal markup
+_RAWTEXT_TAGS = {"script", "style", "xmp", "iframe", "noembed", "noframes", "noscript", "plaintext"}
+_RCDATA_TAGS = {"title", "textarea"}
+# tags whose attributes NetscapeTreeBuilder looks at
+_ATTR_TAGS = {"h1", "h3", "a", "hr"}
+
+def _parse_attrs(attrs):
+    if "&" not in attrs:
+        return {a.lower(): v[1:-1] if v else None for (a, v) in _ATTR.findall(attrs)}
+    return {a.lower(): unescape(v[1:-1]) if v else None for (a, v) in _ATTR.findall(attrs)}
+
+class NetscapeFastParser(NetscapeTreeBuilder):
+    """Scan the input with precompiled regexes for the few tags we care about.
+
+    This is several times faster than NetscapeHTMLParser, but only accepts a
+    strict subset of HTML, raising _Malformed on anything else.
+    """
+    def handle_bookmark(self, attrs, name):
+        self.flush_data()
+        if not self.started:
+            raise ValueError("did not see expected DOCTYPE")
+        self.pop_any_child()
+        attrs = _parse_attrs(attrs)
+        node = self.new_anchor(attrs.get("id", ""), from_fmt_time(attrs.get("add_date", None)), attrs)
+        self.append_child(node)
+        name = unescape(name).strip()
+        if name and not isinstance(node, Separator):
+            node.name += name
+
+    def parse(self, text):
+        find = text.find
+        match = _TOKEN.match
+        match_bookmark = _BOOKMARK.match
+        n = len(text)
+        i = 0
+        while i < n:
+            j = find("<", i)
+            if j < 0: j = n
+            if i < j:
+                data = text[i:j]
+                # whitespace between tags is common and would be stripped anyway
+                if self.data or not data.isspace():
+                    self.handle_data(unescape(data))
+                if j == n: break
+            m = match_bookmark(text, j)
+            if m is not None:
+                i = m.end()
+                self.handle_bookmark(*m.groups())
+                continue
+            m = match(text, j)
+            if m is None:
+                if not _NOT_TAG_OPEN.match(text, j):
+                    raise _Malformed("unrecognised markup at offset %s" % j)
+                # like HTMLParser, treat it as text
+                self.handle_data("<")
+                i = j + 1
+                continue
+            i = m.end()
+            tag, attrs, endtag, comment, decl = m.groups()
+            if tag is not None:
+                tag = tag.lower()
+                if tag in _RAWTEXT_TAGS:
+                    raise _Malformed("unsupported element: %s" % tag)
+                if tag in _RCDATA_TAGS:
+                    k = find("<", i)
+                    if text[k:k+len(tag)+2].lower() != "</" + tag:
+                        raise _Malformed("markup inside element: %s" % tag)
+                self.handle_starttag(tag, _parse_attrs(attrs) if tag in _ATTR_TAGS else ())
+            elif endtag is not None:
+                self.handle_endtag(endtag.lower())
+            elif comment is not None:
+                if "--" in comment or comment.startswith((">", "->")):
+                    raise _Malformed("unusual comment at offset %s" % j)
+                self.handle_comment(comment)
+            else:
+                self.handle_decl(decl)
+        self.flush_data()
+
+def _read_fast(fp_in, icons):
+    text = fp_in.read()
+    try:
+        parser = NetscapeFastParser(icons)
+        parser.parse(text)
+        if parser.result is not None:
+            return parser.result
+    except Exception as e:
+        log("note: fast engine failed (%s), falling back to html.parser" % e)
+    parser = NetscapeHTMLParser(icons)
+    parser.feed(text)
+    parser.close()
+    return parser.result
 
-def read(fp_in):
-    parser = NetscapeHTMLParser()
-    parser.feed(fp_in.read())
-    result = parser.result
+def read(fp_in, bufsize=DEFAULT_BUFSIZE, engine="html.parser", icons=None):
+    """Read a tree from fp_in, feeding the parser in chunks of bufsize.
+
+    A negative bufsize feeds the whole input in one go.
+
+    engine is one of ENGINES. The "fast" engine reads the whole input in one go
+    and falls back to "html.parser" if the input is not in the usual layout.
+
+    Icons are interned in icons, an IconPool, or a new one if not given.
+
+    fp_in may be text, or binary, which is decoded as it is read in the
+    encoding that detect_encoding finds.
+    """
+    if engine not in ENGINES:
+        raise ValueError("not a valid engine: %s" % engine)
+    fp_in = DecodingReader(fp_in, detect_encoding)
+    if engine == "fast":
+        result = _read_fast(fp_in, icons)
+    else:
+        parser = NetscapeHTMLParser(icons)
+        while True:
+            chunk = fp_in.read(bufsize)
+            if not chunk: break
+            parser.feed(chunk)
+        parser.close()
+        result = parser.result
     if result is None:
         raise ValueError("failed to parse anything out of the file")
     return result
 
-def expand_attrs(attrs):
-    return "".join(' %s="%s"' % (k.upper(), escape(v, quote=True)) for k, v in attrs.items())
-
-def write_node(node, fp_out, cull_special, cull_attr, depth=0):
-    indent = "    " * depth
-    if isinstance(node, Separator):
-        attrs = _d({
-            "id": _oe(node.id),
-            "add_date": _on(to_fmt_time(node.date_added)),
-        })
-        if cull_attr:
-            attrs.pop("id", None)
-            attrs.pop("add_date", None)
-        print("%s<HR%s>" % (indent, expand_attrs(attrs)), file=fp_out)
-    elif isinstance(node, Bookmark):
-        attrs = _d({
-            "id": _oe(node.id),
-            "add_date": _on(to_fmt_time(node.date_added)),
-            "icon": _oe(node.icon),
-            "last_modified": _on(to_fmt_time(node.date_modified)),
-            "href": node.url,
-            # TODO: not supported by format
-            #"": _on(to_fmt_time(node.url_date_modified)),
-            "last_visit": _on(to_fmt_time(node.url_date_visited)),
-        })
-        if cull_attr:
-            attrs.pop("id", None)
-        print("%s<DT><A%s>%s</A>" % (indent, expand_attrs(attrs), escape(node.name)), file=fp_out)
-    elif isinstance(node, Folder):
-        attrs = _d({
-            "id": _oe(node.id),
-            "add_date": _on(to_fmt_time(node.date_added)),
-            "icon": _oe(node.icon),
-            "last_modified": _on(to_fmt_time(node.date_modified)),
-            **to_special_folder(node),
-        })
-        if cull_attr:
-            attrs.pop("id", None)
-            attrs.pop("icon", None)
+def events(fp_in, bufsize=DEFAULT_BUFSIZE, icons=None):
+    """Yield (event, node, depth) while reading fp_in in chunks of bufsize, without building a tree.
+
+    See NetscapeEventBuilder for how this can differ from walk(read(fp_in)).
+    """
+    fp_in = DecodingReader(fp_in, detect_encoding)
+    parser = NetscapeHTMLEventParser(icons)
+    while True:
+        chunk = fp_in.read(bufsize)
+        if chunk:
+            parser.feed(chunk)
+        else:
+            parser.close()
+        yield from parser.events
+        parser.events.clear()
+        if not chunk: break
+    if parser.result is None:
+        raise ValueError("failed to parse anything out of the file")
+
+def _attr(name, v):
+    return ' %s="%s"' % (name, escape(v)) if v else ""
+
+@lru_cache(ICON_MEMO_SIZE)
+def _attr_icon(icon):
+    # the same few icons come up over and over, and are long to escape
+    return _attr("ICON", icon)
+
+def _attr_time(name, ue):
+    return ' %s="%s"' % (name, to_fmt_time(ue)) if ue is not None else ""
+
+class NetscapeHTMLWriter(EventWriter):
+    """Write a tree, formatting each line directly from the node's fields"""
+    def __init__(self, fp_out, cull_special, cull_attr, bufsize=DEFAULT_WRITE_BUFSIZE):
+        super().__init__(fp_out, bufsize)
+        self.cull_special = cull_special
+        self.cull_attr = cull_attr
+
+    def leaf(self, node, depth):
+        indent = "    " * depth
+        if isinstance(node, Separator):
+            attrs = "" if self.cull_attr else _attr("ID", node.id) + _attr_time("ADD_DATE", node.date_added)
+            self.emit("%s<HR%s>\n" % (indent, attrs))
+        elif isinstance(node, Bookmark):
+            attrs = "".join((
+                "" if self.cull_attr else _attr("ID", node.id),
+                _attr_time("ADD_DATE", node.date_added),
+                _attr_icon(node.icon),
+                _attr_time("LAST_MODIFIED", node.date_modified),
+                ' HREF="%s"' % escape(node.url),
+                # TODO: url_date_modified not supported by format
+                _attr_time("LAST_VISIT", node.url_date_visited),
+            ))
+            self.emit("%s<DT><A%s>%s</A>\n" % (indent, attrs, escape(node.name)))
+        else:
+            assert False
+
+    def enter_folder(self, node, depth):
+        indent = "    " * depth
+        cull_attr = self.cull_attr
+        special = SPECIAL_FOLDERS_BY_ENUM.get(node.special, None)
+        if cull_attr and depth == 0:
+            attrs = ""
+        else:
+            attrs = "".join((
+                "" if cull_attr else _attr("ID", node.id),
+                _attr_time("ADD_DATE", node.date_added),
+                "" if cull_attr else _attr_icon(node.icon),
+                _attr_time("LAST_MODIFIED", node.date_modified),
+                ' %s="true"' % special.upper() if special is not None else "",
+            ))
+        name = escape(node.name)
         if depth == 0:
-            if cull_attr:
-                attrs = {}
-            print("<TITLE>%s</TITLE>" % escape(node.name), file=fp_out)
-            print("<H1%s>%s</H1>" % (expand_attrs(attrs), escape(node.name)), file=fp_out)
+            self.emit("<TITLE>%s</TITLE>\n<H1%s>%s</H1>\n" % (name, attrs, name))
         else:
-            print("%s<DT><H3%s>%s</H3>" % (indent, expand_attrs(attrs), escape(node.name)), file=fp_out)
-        print("%s<DL><p>" % indent, file=fp_out)
-        for c in node.children:
-            if _keep_child(cull_special, SPECIAL_FOLDERS_BY_ENUM.keys(), c):
-                write_node(c, fp_out, cull_special, cull_attr, depth+1)
-        print("%s</DL><p>" % indent, file=fp_out)
-    else:
-        assert False
+            self.emit("%s<DT><H3%s>%s</H3>\n" % (indent, attrs, name))
+        self.emit("%s<DL><p>\n" % indent)
+
+    def exit_folder(self, node, depth):
+        self.emit("%s</DL><p>\n" % ("    " * depth))
+
+    def write_events(self, events):
+        if self.cull_special:
+            events = cull_special_events(events, SPECIAL_FOLDERS_BY_ENUM.keys())
+        self.emit("<!DOCTYPE %s>\n" % DOCTYPE)
+        self.emit('<META HTTP-EQUIV="Content-Type" CONTENT="text/html; charset=UTF-8">\n')
+        self.handle_events(events)
+        self.flush()
+
+    def write(self, root):
+        self.write_events(walk(root))
+
+def write_events(events, fp_out, cull_special, cull_attr):
+    NetscapeHTMLWriter(fp_out, cull_special, cull_attr).write_events(events)
 
 def write(root, fp_out, cull_special, cull_attr):
-    print("<!DOCTYPE %s>" % DOCTYPE, file=fp_out)
-    print('<META HTTP-EQUIV="Content-Type" CONTENT="text/html; charset=UTF-8">', file=fp_out)
-    write_node(root, fp_out, cull_special, cull_attr, 0)
+    write_events(walk(root), fp_out, cull_special, cull_attr)
 
 def _roundtrip_acceptable_diff(cull_attr, depth, ty, attr, v_a, v_b):
     if attr == "id":
@@ -0,0 +1,100 @@
+"""Conversion between our timestamps, unix epoch micros, and those of the formats.
+
+Every format has a TimeCodec here, which memoises its conversions: the same
+few values tend to come up over and over, especially after fill_timestamps,
+which gives most nodes the same one. All the arithmetic is done on integers,
+so no precision is lost to floats along the way.
+"""
+
+from .base import *
+
+import sys
+
+from datetime import date, datetime, timedelta, timezone
+from functools import lru_cache
+
+"""How many distinct values each conversion remembers"""
+MEMO_SIZE = 4096
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_EPOCH_DATE = date(1970, 1, 1)
+
+"""Microseconds from 1601-01-01, the Windows epoch, to the unix epoch"""
+WINDOWS_UNIX_DIFF = 11644473600000000
+
+class TimeCodec:
+    """decode(v) converts a format's timestamp to unix epoch micros, and encode(ue) back.
+
+    Both take None for a missing timestamp, and give None back. decode_many
+    and encode_many convert a whole sequence at once.
+    """
+    def __init__(self, decode, encode, memo_size=MEMO_SIZE):
+        self.decode = lru_cache(memo_size)(decode)
+        self.encode = lru_cache(memo_size)(encode)
+
+    def decode_many(self, values):
+        return list(map(self.decode, values))
+
+    def encode_many(self, values):
+        return list(map(self.encode, values))
+
+    def clear(self):
+        """Forget all memoised values"""
+        self.decode.cache_clear()
+        self.encode.cache_clear()
+
+_warned_old_python = []
+
+def _from_iso(iso):
+    if iso is None: return None
+    if sys.version_info < (3, 11) and not _warned_old_python:
+        log("warn: parsing ISO 8601 dates properly requires Python >= 3.11")
+        _warned_old_python.append(True)
+    dt = datetime.fromisoformat(iso)
+    if dt.tzinfo is None:
+        # local time, as datetime.timestamp() has it
+        dt = dt.astimezone()
+    td = dt - _EPOCH
+    return (td.days * 86400 + td.seconds) * 1000000 + td.microseconds
+
+@lru_cache(MEMO_SIZE)
+def _iso_date(days):
+    return (_EPOCH_DATE + timedelta(days)).isoformat()
+
+def _to_iso(ue):
+    if ue is None: return None
+    # same as datetime.isoformat() in UTC, plus the Z, but the date is the
+    # only slow part, and many timestamps share one
+    (days, us) = divmod(ue, 86400000000)
+    (s, us) = divmod(us, 1000000)
+    (m, s) = divmod(s, 60)
+    (h, m) = divmod(m, 60)
+    if us:
+        return "%sT%02d:%02d:%02d.%06dZ" % (_iso_date(days), h, m, s, us)
+    return "%sT%02d:%02d:%02dZ" % (_iso_date(days), h, m, s)
+
+def _from_seconds(s):
+    if s is None: return None
+    return int(s) * 1000000
+
+def _to_seconds(ue):
+    if ue is None: return None
+    # truncated towards zero
+    return str(ue // 1000000 if ue >= 0 else -(-ue // 1000000))
+
+def _from_windows(s):
+    if s is None: return None
+    return int(s) - WINDOWS_UNIX_DIFF
+
+def _to_windows(ue):
+    if ue is None: return None
+    return str(ue + WINDOWS_UNIX_DIFF)
+
+"""ISO 8601, as in XBEL"""
+ISO_8601 = TimeCodec(_from_iso, _to_iso)
+
+"""Unix epoch seconds as a string, as in Netscape HTML"""
+UNIX_SECONDS = TimeCodec(_from_seconds, _to_seconds)
+
+"""Windows epoch micros as a string, as in Chrome JSON"""
+WINDOWS_MICROS = TimeCodec(_from_windows, _to_windows)
@@ -1,23 +1,16 @@
 from .base import *
+from . import timestamps
+from .icons import ICON_MEMO_SIZE, IconPool
 
-from datetime import datetime
 import xml.etree.ElementTree as ET
 
+from functools import lru_cache
+
 """https://xbel.sourceforge.net/language/versions/1.0/xbel-1.0.xhtml"""
 XBEL_VERSION = "1.0"
 
-def from_fmt_time(iso):
-    if iso is None: return None
-    import sys
-    if not (sys.version_info.major >= 3 and sys.version_info.minor >= 11):
-        log("warn: parsing ISO 8601 dates properly requires Python >= 3.11")
-    return int(datetime.fromisoformat(iso).timestamp() * 1000000)
-
-def to_fmt_time(ue):
-    if ue is None: return None
-    # utcfromtimestap/isoformat are buggy, we have to add Z ourselves
-    iso = datetime.utcfromtimestamp(ue / 1000000.0).isoformat()
-    return iso if iso.endswith("Z") else iso + "Z"
+from_fmt_time = timestamps.ISO_8601.decode
+to_fmt_time = timestamps.ISO_8601.encode
 
 # we don't support aliases, nor likely ever will, as it's hard to fit into the other formats
 SUPPORTED_TAGS = ["xbel", "folder", "bookmark", "separator"]
@@ -28,20 +21,18 @@ SPECIAL_FOLDERS_BY_NAME = {
 
 SPECIAL_FOLDERS_BY_ENUM = {v: k for (k, v) in SPECIAL_FOLDERS_BY_NAME.items()}
 
-def from_ast(node):
-    node_type = node.tag
-    attrib = node.attrib
+def new_node(tag, attrib, icons=None):
+    """Create the node for an element, without its name or children, putting its icon through icons if given"""
     id = attrib.get("id", "")
     date_added = from_fmt_time(attrib.get("added", None))
-    title = node.find("title")
-    name = title.text if title is not None and title.text is not None else ""
     icon = attrib.get("icon", "")
+    if icons is not None:
+        icon = icons.intern(icon)
     date_modified = from_fmt_time(None) # TODO: not supported by format
-    if node_type == "folder" or node_type == "xbel":
-        children = [from_ast(c) for c in node if c.tag in SUPPORTED_TAGS]
-        special = SpecialFolder.TOOLBAR if node_type == "folder" and node.get("toolbar", "") == "yes" else None
-        return Folder(id, date_added, name, icon, date_modified, children, special)
-    elif node_type == "bookmark":
+    if tag == "folder" or tag == "xbel":
+        special = SpecialFolder.TOOLBAR if tag == "folder" and attrib.get("toolbar", "") == "yes" else None
+        return Folder(id, date_added, "", icon, date_modified, [], special)
+    elif tag == "bookmark":
         url = attrib["href"]
         url_date_modified = from_fmt_time(attrib.get("modified", None))
         url_date_visited = from_fmt_time(attrib.get("visited", None))
@@ -49,13 +40,25 @@ def from_ast(node):
             # floccus uses fake separators even though xbel supports real ones
             return Separator(id, date_added)
         else:
-            return Bookmark(id, date_added, name, icon, date_modified, url, url_date_modified, url_date_visited)
-    elif node_type == "separator":
+            return Bookmark(id, date_added, "", icon, date_modified, url, url_date_modified, url_date_visited)
+    elif tag == "separator":
         return Separator(id, date_added)
     else:
-        raise ValueError("unrecognised node type: %s" % node_type)
+        raise ValueError("unrecognised node type: %s" % tag)
+
+def from_ast_node(node, _depth):
+    """Convert a single element, with its children left empty"""
+    w = new_node(node.tag, node.attrib)
+    if not isinstance(w, Separator):
+        title = node.find("title")
+        w.name = title.text if title is not None and title.text is not None else ""
+    return (w, w.children if isinstance(w, Folder) else None)
 
-def to_ast(node, cull_special, cull_attr, depth=0):
+def from_ast(node):
+    return transform(node, from_ast_node, lambda node: [c for c in node if c.tag in SUPPORTED_TAGS])
+
+def to_ast_node(node, depth, cull_attr):
+    """Convert a single node, with its children left empty"""
     if isinstance(node, Separator):
         w = ET.Element("separator")
         w.attrib = _d({
@@ -65,7 +68,7 @@ def to_ast(node, cull_special, cull_attr, depth=0):
         if cull_attr:
             w.attrib.pop("id", None)
             w.attrib.pop("added", None)
-        return w
+        return (w, None)
     elif isinstance(node, Bookmark):
         w = ET.Element("bookmark")
         t = ET.SubElement(w, "title")
@@ -80,7 +83,7 @@ def to_ast(node, cull_special, cull_attr, depth=0):
             "modified": _on(to_fmt_time(node.url_date_modified)),
             "visited": _on(to_fmt_time(node.url_date_visited)),
         })
-        return w
+        return (w, None)
     elif isinstance(node, Folder):
         w = ET.Element("xbel" if depth == 0 else "folder")
         t = ET.SubElement(w, "title")
@@ -98,28 +101,203 @@ def to_ast(node, cull_special, cull_attr, depth=0):
             w.attrib["version"] = XBEL_VERSION
         if cull_attr and depth == 0:
             w.attrib.pop("icon", None)
-        w.extend([
-            to_ast(c, cull_special, cull_attr, depth+1) for c in node.children
-            if _keep_child(cull_special, SPECIAL_FOLDERS_BY_ENUM.keys(), c)
-        ])
-        return w
+        return (w, w)
     else:
         assert False
 
-def read(fp_in):
-    x = ET.parse(fp_in)
-    ver = x.getroot().attrib.get("version", None)
+def to_ast(node, cull_special, cull_attr):
+    children = lambda node: [
+        c for c in node.children
+        if _keep_child(cull_special, SPECIAL_FOLDERS_BY_ENUM.keys(), c)
+    ]
+    return transform(node, lambda node, depth: to_ast_node(node, depth, cull_attr), children)
+
+def check_version(elem):
+    ver = elem.attrib.get("version", None)
     if ver != XBEL_VERSION:
         raise ValueError("unsupported xbel version: %s" % ver)
-    root = from_ast(x.getroot())
+
+def read(fp_in, icons=None):
+    """Read a tree from fp_in incrementally, same as from_ast(ET.parse(fp_in).getroot()).
+
+    Nodes are created from start events, and each element is discarded once it
+    has been converted, so the whole ElementTree is never held in memory.
+    Icons are interned in icons, an IconPool, or a new one if not given.
+
+    fp_in is best binary, including an mmap: expat then decodes it as it
+    parses, in the encoding of the XML declaration.
+    """
+    icons = IconPool() if icons is None else icons
+    root = None
+    # [element, node or None if the element is ignored, whether we saw its title]
+    stack = []
+    for event, elem in ET.iterparse(fp_in, events=("start", "end")):
+        if event == "start":
+            if not stack:
+                check_version(elem)
+                node = root = new_node(elem.tag, elem.attrib, icons)
+            else:
+                parent = stack[-1][1]
+                if isinstance(parent, Folder) and elem.tag in SUPPORTED_TAGS:
+                    node = new_node(elem.tag, elem.attrib, icons)
+                    parent.children.append(node)
+                else:
+                    node = None
+            stack.append([elem, node, False])
+        else:
+            stack.pop()
+            if not stack: continue
+            owner = stack[-1]
+            if elem.tag == "title" and not owner[2]:
+                owner[2] = True
+                if owner[1] is not None and not isinstance(owner[1], Separator):
+                    owner[1].name = elem.text if elem.text is not None else ""
+            # we've converted everything we need, drop it
+            elem.clear()
+            del owner[0][:]
     assert isinstance(root, Folder)
     return root
 
+def events(fp_in, icons=None):
+    """Yield (event, node, depth) while reading fp_in incrementally, without building a tree.
+
+    Each node is only yielded once its title has been read, so a folder's
+    ENTER_FOLDER waits for its first child.
+    """
+    icons = IconPool() if icons is None else icons
+    # [element, node or None if the element is ignored, whether we saw its title, whether we entered it]
+    stack = []
+    def enter(frame, depth):
+        frame[3] = True
+        return (ENTER_FOLDER, frame[1], depth)
+    for event, elem in ET.iterparse(fp_in, events=("start", "end")):
+        if event == "start":
+            if not stack:
+                check_version(elem)
+                node = new_node(elem.tag, elem.attrib, icons)
+            else:
+                parent = stack[-1]
+                if isinstance(parent[1], Folder) and elem.tag in SUPPORTED_TAGS:
+                    node = new_node(elem.tag, elem.attrib, icons)
+                    if not parent[3]:
+                        # nodes are always nested directly, so depth is just position in the stack
+                        yield enter(parent, len(stack) - 1)
+                else:
+                    node = None
+            stack.append([elem, node, False, False])
+        else:
+            frame = stack.pop()
+            node = frame[1]
+            depth = len(stack)
+            if isinstance(node, Folder):
+                if not frame[3]:
+                    yield enter(frame, depth)
+                yield (EXIT_FOLDER, node, depth)
+            elif node is not None:
+                yield (LEAF, node, depth)
+            if not stack: continue
+            owner = stack[-1]
+            if elem.tag == "title" and not owner[2]:
+                owner[2] = True
+                if owner[1] is not None and not isinstance(owner[1], Separator):
+                    owner[1].name = elem.text if elem.text is not None else ""
+            elem.clear()
+            del owner[0][:]
+
+# same as the escaping done by ET
+def _escape_cdata(text):
+    if "&" in text: text = text.replace("&", "&amp;")
+    if "<" in text: text = text.replace("<", "&lt;")
+    if ">" in text: text = text.replace(">", "&gt;")
+    return text
+
+def _escape_attrib(text):
+    text = _escape_cdata(text)
+    if '"' in text: text = text.replace('"', "&quot;")
+    if "\r" in text: text = text.replace("\r", "&#13;")
+    if "\n" in text: text = text.replace("\n", "&#10;")
+    if "\t" in text: text = text.replace("\t", "&#09;")
+    return text
+
+def _attr(name, v):
+    return ' %s="%s"' % (name, _escape_attrib(v)) if v else ""
+
+@lru_cache(ICON_MEMO_SIZE)
+def _attr_icon(icon):
+    # the same few icons come up over and over, and are long to escape
+    return _attr("icon", icon)
+
+def _attr_time(name, ue):
+    return ' %s="%s"' % (name, to_fmt_time(ue)) if ue is not None else ""
+
+class XBELWriter(EventWriter):
+    """Write a tree directly as indented XBEL text, without building an ElementTree.
+
+    The output is the same as serialising to_ast() after ET.indent().
+    """
+    def __init__(self, fp_out, cull_special, cull_attr, bufsize=DEFAULT_WRITE_BUFSIZE):
+        super().__init__(fp_out, bufsize)
+        self.cull_special = cull_special
+        self.cull_attr = cull_attr
+
+    def write_title(self, node, depth):
+        self.emit("\n%s<title>%s</title>" % ("  " * (depth+1), _escape_cdata(node.name)))
+
+    def leaf(self, node, depth):
+        if depth > 0:
+            self.emit("\n" + "  " * depth)
+        if isinstance(node, Separator):
+            attrs = "" if self.cull_attr else _attr("id", node.id) + _attr_time("added", node.date_added)
+            self.emit("<separator%s></separator>" % attrs)
+        elif isinstance(node, Bookmark):
+            self.emit("<bookmark%s%s%s%s%s%s>" % (
+                _attr("id", node.id),
+                _attr_time("added", node.date_added),
+                _attr_icon(node.icon),
+                # TODO: date_modified not supported by format
+                ' href="%s"' % _escape_attrib(node.url),
+                _attr_time("modified", node.url_date_modified),
+                _attr_time("visited", node.url_date_visited),
+            ))
+            self.write_title(node, depth)
+            self.emit("\n%s</bookmark>" % ("  " * depth))
+        else:
+            assert False
+
+    def enter_folder(self, node, depth):
+        if depth > 0:
+            self.emit("\n" + "  " * depth)
+        self.emit("<%s%s%s%s%s%s>" % (
+            "xbel" if depth == 0 else "folder",
+            _attr("id", node.id),
+            _attr_time("added", node.date_added),
+            "" if self.cull_attr and depth == 0 else _attr_icon(node.icon),
+            # TODO: date_modified, other special values not supported by format
+            ' toolbar="yes"' if node.special == SpecialFolder.TOOLBAR else "",
+            ' version="%s"' % XBEL_VERSION if depth == 0 else "",
+        ))
+        self.write_title(node, depth)
+
+    def exit_folder(self, node, depth):
+        self.emit("\n%s</%s>" % ("  " * depth, "xbel" if depth == 0 else "folder"))
+
+    def write_events(self, events):
+        if self.cull_special:
+            events = cull_special_events(events, SPECIAL_FOLDERS_BY_ENUM.keys())
+        # same declaration as ET.ElementTree.write(encoding="unicode", xml_declaration=True)
+        encoding = getattr(self.fp_out, "encoding", None) or "utf-8"
+        self.emit("<?xml version='1.0' encoding='%s'?>\n" % encoding)
+        self.handle_events(events)
+        self.flush()
+
+    def write(self, root):
+        self.write_events(walk(root))
+
+def write_events(events, fp_out, cull_special, cull_attr):
+    XBELWriter(fp_out, cull_special, cull_attr).write_events(events)
+
 def write(root, fp_out, cull_special, cull_attr):
-    w = to_ast(root, cull_special, cull_attr)
-    ET.indent(w)
-    # we opened the file in string mode, so write in string mode
-    ET.ElementTree(w).write(fp_out, encoding="unicode", xml_declaration=True, short_empty_elements=False)
+    write_events(walk(root), fp_out, cull_special, cull_attr)
 
 def _roundtrip_acceptable_diff(cull_attr, depth, ty, attr, v_a, v_b):
     if attr == "id":
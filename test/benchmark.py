@@ -0,0 +1,452 @@
+#!/usr/bin/python3
+"""Benchmarks for bkmk, on large generated bookmark trees.
+
+These are not run as part of test-all.sh; run them manually like:
+
+    PYTHONPATH=src python3 test/benchmark.py [-n NUM_BOOKMARKS] [BENCHMARK...]
+"""
+
+from bkmk import *
+from bkmk.base import *
+
+import argparse
+import bkmk
+import base64
+import datetime
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+import xml.etree.ElementTree
+
+def gen_tree(n, icon_size=1024, folder_size=100, seed=0):
+    """Generate a tree of n bookmarks with inline icons, in folders of folder_size"""
+    rng = random.Random(seed)
+    root = Folder.new()
+    root.name = "Bookmarks"
+    folder = None
+    for i in range(n):
+        if i % folder_size == 0:
+            folder = Folder(str(len(root.children)), 1000000 * i, "folder %s" % i, "", None, [], None)
+            root.children.append(folder)
+        icon = "data:image/png;base64," + base64.b64encode(rng.randbytes(icon_size * 3 // 4)).decode("ascii")
+        url = "https://example.com/%s/page-%s" % (i % 97, i)
+        folder.children.append(Bookmark("b%s" % i, 1000000 * i, "bookmark number %s" % i, icon, None, url, None, None))
+    return root
+
+def gen_deep_tree(n, depth=500):
+    """Generate a tree of n bookmarks, in chains of folders depth deep"""
+    root = Folder.new()
+    folder = root
+    for i in range(n):
+        if i % depth == 0:
+            folder = root
+        child = Folder("f%s" % i, 1000000 * i, "folder %s" % i, "", None, [], None)
+        folder.children.append(Bookmark("b%s" % i, 1000000 * i, "bookmark %s" % i, "", None, "https://example.com/", None, None))
+        folder.children.append(child)
+        folder = child
+    return root
+
+def gen_file(root, fmt):
+    fp = tempfile.NamedTemporaryFile("wb" if is_binary(fmt) else "w", suffix=".bench", delete=False)
+    with fp:
+        Bookmarks(root).write(fp, fmt)
+    return fp.name
+
+def measure(f):
+    """Run f, returning (seconds, peak traced memory in bytes)"""
+    tracemalloc.start()
+    start = time.perf_counter()
+    f()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+def report(name, elapsed, peak, extra=""):
+    print("%-40s %8.3fs %10.1f MiB %s" % (name, elapsed, peak / 1048576.0, extra))
+
+def bench_node_memory(args):
+    import dataclasses
+    n = args.num
+    samples = {
+        Separator: ("1", 0),
+        Bookmark: ("1", 0, "name", "", 0, "https://example.com/", None, None),
+        Folder: ("1", 0, "name", "", 0, None, None),
+    }
+    for cls, fields in samples.items():
+        # the same class without __slots__, as it was before
+        unslotted = dataclasses.make_dataclass(cls.__name__, [(f.name, f.type) for f in dataclasses.fields(cls)])
+        for variant, ty in (("__dict__", unslotted), ("__slots__", cls)):
+            tracemalloc.start()
+            nodes = [ty(*fields) for _ in range(n)]
+            size, _ = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            del nodes
+            print("%-10s %-10s %6.1f bytes/node" % (cls.__name__, variant, size / n))
+
+def select_date_added(root, start, end):
+    r = []
+    root.map_mut(lambda n: r.append(n) if n.date_added is not None and start <= n.date_added < end else None)
+    return r
+
+def bench_columnar(args):
+    import functools
+    from bkmk import _fill_timestamp, _prefix_id
+    bm = Bookmarks(gen_tree(args.num, icon_size=0))
+    start = time.perf_counter()
+    columns = bm.to_columnar()
+    report("columnar: from_tree", time.perf_counter() - start, 0)
+    ts = int(time.time() * 1000000)
+    for (name, tree_op, columns_op) in (
+        ("fill_timestamps", lambda: bm.root.map_mut(functools.partial(_fill_timestamp, ts)), lambda: columns.fill_timestamps(ts)),
+        ("prefix_ids", lambda: bm.root.map_mut(functools.partial(_prefix_id, "x-")), lambda: columns.prefix_ids("x-")),
+        ("date range", lambda: select_date_added(bm.root, 0, ts // 2), lambda: columns.select("date_added", 0, ts // 2)),
+        ("date range again", lambda: select_date_added(bm.root, 0, ts // 2), lambda: columns.select("date_added", 0, ts // 2)),
+    ):
+        for (variant, op) in (("map_mut", tree_op), ("columnar", columns_op)):
+            start = time.perf_counter()
+            op()
+            report("%s: %s" % (variant, name), time.perf_counter() - start, 0)
+
+# the recursive versions, as they were before the traversal core
+def recursive_map_mut(node, mut):
+    mut(node)
+    if isinstance(node, Folder):
+        for c in node.children:
+            recursive_map_mut(c, mut)
+
+def recursive_to_ast(node):
+    w, out = bkmk_json.to_ast_node(node, 0)
+    if out is not None:
+        out.extend(map(recursive_to_ast, node.children))
+    return w
+
+def recursive_eq(a, b):
+    if not a._debug_eq_node(b, lambda *args: False, 0):
+        return False
+    if isinstance(a, Folder):
+        return all([recursive_eq(x, y) for (x, y) in zip(a.children, b.children)])
+    return True
+
+def bench_traversal(args):
+    xc = lambda children, depth: children
+    for (shape, root) in (("wide", gen_tree(args.num, icon_size=0)), ("deep", gen_deep_tree(args.num, sys.getrecursionlimit() // 4))):
+        copy = bkmk_json.from_ast(bkmk_json.to_ast(root))
+        for (name, recursive_op, op) in (
+            ("map_mut", lambda: recursive_map_mut(root, id), lambda: root.map_mut(id)),
+            ("to_ast", lambda: recursive_to_ast(root), lambda: bkmk_json.to_ast(root)),
+            ("_debug_eq", lambda: recursive_eq(root, copy), lambda: root._debug_eq(copy, lambda *args: False, xc)),
+        ):
+            for (variant, f) in (("recursive", recursive_op), ("iterative", op)):
+                start = time.perf_counter()
+                f()
+                report("%s %s: %s" % (variant, shape, name), time.perf_counter() - start, 0)
+
+def bench_normalize(args):
+    ts = int(time.time() * 1000000)
+    for variant in ("one at a time", "fused"):
+        bm = Bookmarks(gen_tree(args.num, icon_size=0))
+        bm.root.map_mut(lambda n: setattr(n, "id", "") if len(n.name) % 3 else None)
+        start = time.perf_counter()
+        if variant == "fused":
+            bm.normalize(True, True, True, "x-", ts)
+        else:
+            bm.fill_special()
+            bm.fill_ids()
+            bm.fill_timestamps(ts)
+            bm.prefix_ids("x-")
+        report("normalize, %s" % variant, time.perf_counter() - start, 0)
+
+def bench_index(args):
+    bm = Bookmarks(gen_tree(args.num, icon_size=64))
+    bm.fill_ids()
+    ids = [str(i) for i in range(1, args.num, max(1, args.num // 100))]
+    def scan():
+        for i in ids:
+            found = []
+            bm.root.map_mut(lambda n: found.append(n) if n.id == i else None)
+    report("100 lookups by id, map_mut", *measure(scan))
+    report("build index", *measure(lambda: bm.index))
+    report("100 lookups by id, index", *measure(lambda: [bm.index.get_id(i) for i in ids]))
+
+def bench_merge(args):
+    for copies in (2, 4, 8):
+        trees = [Bookmarks(gen_tree(args.num // copies, icon_size=64, seed=i % 2)) for i in range(copies)]
+        merged = Bookmarks.new()
+        report("merge %d trees of %d" % (copies, args.num // copies), *measure(lambda: merged.merge(*trees)))
+
+def bench_diff(args):
+    import copy
+    from bkmk import diff
+    a = Bookmarks(gen_tree(args.num, icon_size=64))
+    a.fill_ids()
+    b = copy.deepcopy(a)
+    folders = b.root.children
+    for i in range(0, len(folders), 10):
+        folders[i].children.pop()
+        folders[i].children[0].name += " (renamed)"
+        folders[i].children.append(folders[i + 1].children.pop(0) if i + 1 < len(folders) else Separator("", None))
+    patch = []
+    report("diff, without hashes", *measure(lambda: diff.diff(a.root, b.root)))
+    report("diff, hashing both trees", *measure(lambda: patch.append(a.diff(b))))
+    report("diff, hashes cached", *measure(lambda: a.diff(b)))
+    report("apply_patch", *measure(lambda: copy.deepcopy(a).apply_patch(patch[0])))
+    fp = io.StringIO()
+    b.write(fp, "bkmk-json")
+    print("patch: %s, %d bytes of JSON, whole tree %d bytes" % (
+        patch[0].summary(), len(json.dumps(patch[0].to_json())), len(fp.getvalue())))
+
+def bench_netscape_read_memory(args):
+    path = gen_file(gen_tree(args.num), "netscape-html")
+    try:
+        print("input size: %.1f MiB" % (os.path.getsize(path) / 1048576.0))
+        for bufsize in (-1, netscape_html.DEFAULT_BUFSIZE):
+            with open(path) as fp:
+                report("netscape-html read, bufsize=%s" % bufsize, *measure(lambda: netscape_html.read(fp, bufsize)))
+    finally:
+        os.unlink(path)
+
+def bench_netscape_read_engines(args):
+    path = gen_file(gen_tree(args.num, icon_size=64), "netscape-html")
+    try:
+        for engine in netscape_html.ENGINES:
+            with open(path) as fp:
+                start = time.perf_counter()
+                netscape_html.read(fp, engine=engine)
+                report("netscape-html read, engine=%s" % engine, time.perf_counter() - start, 0)
+    finally:
+        os.unlink(path)
+
+def bench_json_read_memory(args):
+    for (fmt, reference) in (
+        ("bkmk-json", lambda fp: bkmk_json.from_ast(json.load(fp))),
+        ("chrome-json", lambda fp: [chrome_json.from_ast(v) for v in json.load(fp)["roots"].values()]),
+    ):
+        path = gen_file(gen_tree(args.num), fmt)
+        try:
+            with open(path) as fp:
+                report("%s read, json.load + from_ast" % fmt, *measure(lambda: reference(fp)))
+            with open(path) as fp:
+                report("%s read, json_stream" % fmt, *measure(lambda: Bookmarks.read(fp, fmt)))
+        finally:
+            os.unlink(path)
+
+def bench_json_write(args):
+    root = gen_tree(args.num, icon_size=64)
+    with open(os.devnull, "w") as fp:
+        report("bkmk-json write, to_ast + json.dump", *measure(lambda: json.dump(bkmk_json.to_ast(root), fp, indent=2)))
+        report("bkmk-json write, JSONTreeWriter", *measure(lambda: bkmk_json.write(root, fp, False, False)))
+        report("chrome-json write, JSONTreeWriter", *measure(lambda: chrome_json.write(root, fp, False, False)))
+
+def bench_bin_read(args):
+    root = gen_tree(args.num)
+    for fmt in ("bkmk-json", "bkmk-bin"):
+        path = gen_file(root, fmt)
+        try:
+            mode = "rb" if is_binary(fmt) else "r"
+            with open(path, mode) as fp:
+                report("%s read" % fmt, *measure(lambda: Bookmarks.read(fp, fmt)), "%d bytes" % os.path.getsize(path))
+            with open(path, mode) as fp:
+                report("%s read and walk" % fmt, *measure(lambda: sum(1 for _ in preorder(Bookmarks.read(fp, fmt).root))))
+        finally:
+            os.unlink(path)
+
+def bench_binary_read(args):
+    """Reading text formats from text files, against binary files and mmaps that the formats decode"""
+    import mmap
+    root = gen_tree(args.num)
+    for fmt in ("xbel", "netscape-html", "bkmk-json", "chrome-json"):
+        path = gen_file(root, fmt)
+        try:
+            with open(path) as fp:
+                report("%s read, text" % fmt, *measure(lambda: Bookmarks.read(fp, fmt)))
+            with open(path, "rb") as fp:
+                report("%s read, binary" % fmt, *measure(lambda: Bookmarks.read(fp, fmt)))
+            with open(path, "rb") as fp, mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                report("%s read, mmap" % fmt, *measure(lambda: Bookmarks.read(buf, fmt)))
+        finally:
+            os.unlink(path)
+
+def bench_cache(args):
+    path = gen_file(gen_tree(args.num), "chrome-json")
+    try:
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = ReadCache(cache_dir)
+            for name in ("uncached", "cold cache", "warm cache"):
+                with open(path) as fp:
+                    report("chrome-json read, %s" % name, *measure(lambda: Bookmarks.read(fp, "chrome-json", cache=cache if name != "uncached" else None)))
+    finally:
+        os.unlink(path)
+
+def bench_compression(args):
+    """Reading compressed files in process, against decompressing them in another one first"""
+    import subprocess
+    root = gen_tree(args.num)
+    for (compression, tool) in ((None, None), ("gzip", "zcat"), ("bz2", "bzcat"), ("xz", "xzcat")):
+        fp = tempfile.NamedTemporaryFile("wb", suffix=".bench", delete=False)
+        with fp:
+            Bookmarks(root).write(fp, "xbel", compression=compression or [])
+        try:
+            name = compression or "uncompressed"
+            with open(fp.name, "rb") as fp_in:
+                report("xbel read, %s" % name, *measure(lambda: Bookmarks.read(fp_in, "xbel", compression=compression or [])),
+                    "%d bytes" % os.path.getsize(fp.name))
+            if tool is None: continue
+            def piped():
+                with subprocess.Popen([tool, fp.name], stdout=subprocess.PIPE) as proc:
+                    Bookmarks.read(io.TextIOWrapper(proc.stdout), "xbel")
+            report("xbel read, %s through %s" % (name, tool), *measure(piped))
+        finally:
+            os.unlink(fp.name)
+
+def bench_timestamps(args):
+    from bkmk import timestamps
+    def reference_to_iso(ue):
+        return None if ue is None else datetime.datetime.utcfromtimestamp(ue / 1000000.0).isoformat() + "Z"
+    def reference_from_iso(iso):
+        return None if iso is None else int(datetime.datetime.fromisoformat(iso).timestamp() * 1000000)
+    for (name, fill) in (("distinct", False), ("filled", True)):
+        root = gen_tree(args.num, icon_size=0)
+        bm = Bookmarks(root)
+        if fill:
+            bm.fill_timestamps()
+        values = [n.date_added for n in preorder(root)] + [n.date_modified for n in preorder(root)]
+        timestamps.ISO_8601.clear()
+        report("%s, datetime per call" % name, *measure(lambda: [reference_to_iso(v) for v in values]))
+        report("%s, ISO_8601.encode_many" % name, *measure(lambda: timestamps.ISO_8601.encode_many(values)))
+        isos = timestamps.ISO_8601.encode_many(values)
+        timestamps.ISO_8601.clear()
+        report("%s, fromisoformat per call" % name, *measure(lambda: [reference_from_iso(v) for v in isos]))
+        report("%s, ISO_8601.decode_many" % name, *measure(lambda: timestamps.ISO_8601.decode_many(isos)))
+        with open(os.devnull, "w") as fp:
+            report("%s, xbel write" % name, *measure(lambda: bm.write(fp, "xbel")))
+        path = gen_file(root, "xbel")
+        try:
+            with open(path) as fp:
+                report("%s, xbel read" % name, *measure(lambda: Bookmarks.read(fp, "xbel")))
+        finally:
+            os.unlink(path)
+
+def bench_icons(args):
+    """Reading icon-heavy exports, where every bookmark of a site has the same icon"""
+    class NoPool(IconPool):
+        def intern(self, icon):
+            return icon
+    root = gen_tree(args.num, icon_size=0)
+    icons = ["data:image/png;base64," + base64.b64encode(random.Random(i).randbytes(768)).decode("ascii") for i in range(97)]
+    for (i, node) in enumerate(preorder(root)):
+        if isinstance(node, Bookmark):
+            node.icon = icons[i % 97]
+    for fmt in ("netscape-html", "xbel", "bkmk-json"):
+        path = gen_file(root, fmt)
+        try:
+            for (name, pool) in (("not interned", NoPool()), ("interned", IconPool()), ("dropped", IconPool(drop=True))):
+                with open(path) as fp:
+                    report("%s read, icons %s" % (fmt, name), *measure(lambda: bkmk._format_module(fmt).read(fp, icons=pool)))
+        finally:
+            os.unlink(path)
+    with open(os.devnull, "w") as fp:
+        for fmt in ("netscape-html", "xbel", "bkmk-json"):
+            report("%s write" % fmt, *measure(lambda: Bookmarks(root).write(fp, fmt)))
+
+def bench_xbel_read_memory(args):
+    path = gen_file(gen_tree(args.num), "xbel")
+    try:
+        with open(path) as fp:
+            report("xbel read, ET.parse + from_ast", *measure(lambda: xbel.from_ast(xml.etree.ElementTree.parse(fp).getroot())))
+        with open(path) as fp:
+            report("xbel read, iterparse", *measure(lambda: xbel.read(fp)))
+    finally:
+        os.unlink(path)
+
+def bench_xbel_write(args):
+    root = gen_tree(args.num, icon_size=64)
+    def et_write(fp):
+        w = xbel.to_ast(root, False, False)
+        xml.etree.ElementTree.indent(w)
+        xml.etree.ElementTree.ElementTree(w).write(fp, encoding="unicode", xml_declaration=True, short_empty_elements=False)
+    with open(os.devnull, "w") as fp:
+        report("xbel write, to_ast + ET", *measure(lambda: et_write(fp)))
+        report("xbel write, XBELWriter", *measure(lambda: xbel.write(root, fp, False, False)))
+
+def bench_netscape_write(args):
+    bm = Bookmarks(gen_tree(args.num, icon_size=64))
+    with open(os.devnull, "w") as fp:
+        report("netscape-html write", *measure(lambda: bm.write(fp, "netscape-html")))
+
+def bench_stream_memory(args):
+    for (fmt_in, fmt_out) in (("netscape-html", "xbel"), ("xbel", "chrome-json"), ("chrome-json", "netscape-html")):
+        path = gen_file(gen_tree(args.num), fmt_in)
+        try:
+            with open(path) as fp, open(os.devnull, "w") as fp_out:
+                report("%s -> %s, tree" % (fmt_in, fmt_out),
+                    *measure(lambda: Bookmarks.read(fp, fmt_in).write(fp_out, fmt_out)))
+            with open(path) as fp, open(os.devnull, "w") as fp_out:
+                report("%s -> %s, events" % (fmt_in, fmt_out),
+                    *measure(lambda: write_events(read_events(fp, fmt_in), fp_out, fmt_out)))
+        finally:
+            os.unlink(path)
+
+def bench_startup(args):
+    """Time to start up, in new processes so nothing is imported yet; -n is ignored"""
+    import subprocess
+    runs = 20
+    path = gen_file(gen_tree(10), "netscape-html")
+    try:
+        for (name, argv) in (("import bkmk", ["-c", "import bkmk"]),
+                ("bkmk --help", ["-m", "bkmk", "--help"]),
+                ("bkmk netscape-html -> xbel", ["-m", "bkmk", "-f", "netscape-html", "-t", "xbel", path, "-"])):
+            def run():
+                for _ in range(runs):
+                    subprocess.run([sys.executable, *argv], stdout=subprocess.DEVNULL, check=True)
+            (seconds, _) = measure(run)
+            print("%-40s %8.1f ms per run" % (name, seconds / runs * 1000))
+    finally:
+        os.unlink(path)
+
+BENCHMARKS = {
+    "node-memory": bench_node_memory,
+    "columnar": bench_columnar,
+    "traversal": bench_traversal,
+    "normalize": bench_normalize,
+    "index": bench_index,
+    "merge": bench_merge,
+    "diff": bench_diff,
+    "netscape-read-memory": bench_netscape_read_memory,
+    "netscape-read-engines": bench_netscape_read_engines,
+    "netscape-write": bench_netscape_write,
+    "json-read-memory": bench_json_read_memory,
+    "json-write": bench_json_write,
+    "bin-read": bench_bin_read,
+    "binary-read": bench_binary_read,
+    "cache": bench_cache,
+    "compression": bench_compression,
+    "timestamps": bench_timestamps,
+    "icons": bench_icons,
+    "xbel-read-memory": bench_xbel_read_memory,
+    "xbel-write": bench_xbel_write,
+    "stream-memory": bench_stream_memory,
+    "startup": bench_startup,
+}
+
+def main(_, *argv):
+    parser = argparse.ArgumentParser(prog="benchmark.py")
+    parser.add_argument("-n", "--num", type=int, default=20000, help="Number of bookmarks to generate")
+    parser.add_argument("benchmarks", nargs="*", metavar="BENCHMARK",
+        help="Benchmarks to run, any of: %s. Omit to run all of them." % ", ".join(BENCHMARKS.keys()))
+    args = parser.parse_args(argv)
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark: %s" % name)
+    for name in args.benchmarks or BENCHMARKS.keys():
+        print("==", name)
+        BENCHMARKS[name](args)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(*sys.argv))
@@ -1,16 +1,28 @@
 from bkmk import *
 from bkmk.base import *
 
+import bkmk
+import contextlib
+import copy
+import dataclasses
+
 import functools
+import html
 import itertools
 import io
+import json
+import struct
 import sys
 import traceback
+import xml.etree.ElementTree as ET
 
 def xchildren(cull_special, supported, sortkey, children, depth):
     children = [c for c in children if _keep_child(cull_special, supported, c)]
     return sorted(children, key=sortkey) if sortkey and depth == 0 else children
 
+def new_buffer(fmt):
+    return io.BytesIO() if is_binary(fmt) else io.StringIO()
+
 def test_roundtrip(arg):
     all_passing = True
 
@@ -33,19 +45,19 @@ def test_roundtrip(arg):
 
         for fmt in FORMATS.keys():
             try:
-                fp1 = io.StringIO()
+                fp1 = new_buffer(fmt)
                 bm.write(fp1, fmt, **write_args)
                 fp1.flush()
                 fp1.seek(0)
                 bm1 = Bookmarks.read(fp1, fmt, **read_args)
 
-                fp2 = io.StringIO()
+                fp2 = new_buffer(fmt)
                 bm.write(fp2, fmt, **write_args)
                 fp2.flush()
                 fp2.seek(0)
                 bm2 = Bookmarks.read(fp2, fmt, **read_args)
 
-                fmt_module = globals()[fmt.replace("-", "_")]
+                fmt_module = bkmk._format_module(fmt)
                 accept = fmt_module._roundtrip_acceptable_diff
                 supported = list(getattr(fmt_module, "SPECIAL_FOLDERS_BY_ENUM", FOLDER_DEFAULT_NAMES).keys())
                 sortkey = getattr(fmt_module, "_roundtrip_sortkey", None)
@@ -55,7 +67,12 @@ def test_roundtrip(arg):
                 assert bm._debug_eq(bm1, ac, xc)
                 assert bm._debug_eq(bm2, ac, xc)
 
-                assert bm1._debug_eq(bm2, ac, xc)
+                # both were read from the same text, so they should be exactly
+                # equal, unless fill_timestamps filled in different times
+                if fill_timestamps:
+                    assert bm1._debug_eq(bm2, ac, xc)
+                else:
+                    assert bm1.hash() == bm2.hash()
                 fp1.seek(0)
                 fp2.seek(0)
                 assert fp1.read() == fp2.read()
@@ -68,9 +85,1032 @@ def test_roundtrip(arg):
         print("PASSED:", arg)
     return all_passing
 
+# the original print()-per-line netscape-html writer, which the buffered
+# netscape_html.NetscapeHTMLWriter must match byte-for-byte
+def reference_netscape_write_node(node, fp_out, cull_special, cull_attr, depth=0):
+    expand_attrs = lambda attrs: "".join(' %s="%s"' % (k.upper(), html.escape(v, quote=True)) for k, v in attrs.items())
+    to_fmt_time = netscape_html.to_fmt_time
+    indent = "    " * depth
+    if isinstance(node, Separator):
+        attrs = _d({
+            "id": _oe(node.id),
+            "add_date": _on(to_fmt_time(node.date_added)),
+        })
+        if cull_attr:
+            attrs.pop("id", None)
+            attrs.pop("add_date", None)
+        print("%s<HR%s>" % (indent, expand_attrs(attrs)), file=fp_out)
+    elif isinstance(node, Bookmark):
+        attrs = _d({
+            "id": _oe(node.id),
+            "add_date": _on(to_fmt_time(node.date_added)),
+            "icon": _oe(node.icon),
+            "last_modified": _on(to_fmt_time(node.date_modified)),
+            "href": node.url,
+            "last_visit": _on(to_fmt_time(node.url_date_visited)),
+        })
+        if cull_attr:
+            attrs.pop("id", None)
+        print("%s<DT><A%s>%s</A>" % (indent, expand_attrs(attrs), html.escape(node.name)), file=fp_out)
+    elif isinstance(node, Folder):
+        attrs = _d({
+            "id": _oe(node.id),
+            "add_date": _on(to_fmt_time(node.date_added)),
+            "icon": _oe(node.icon),
+            "last_modified": _on(to_fmt_time(node.date_modified)),
+            **netscape_html.to_special_folder(node),
+        })
+        if cull_attr:
+            attrs.pop("id", None)
+            attrs.pop("icon", None)
+        if depth == 0:
+            if cull_attr:
+                attrs = {}
+            print("<TITLE>%s</TITLE>" % html.escape(node.name), file=fp_out)
+            print("<H1%s>%s</H1>" % (expand_attrs(attrs), html.escape(node.name)), file=fp_out)
+        else:
+            print("%s<DT><H3%s>%s</H3>" % (indent, expand_attrs(attrs), html.escape(node.name)), file=fp_out)
+        print("%s<DL><p>" % indent, file=fp_out)
+        for c in node.children:
+            if _keep_child(cull_special, netscape_html.SPECIAL_FOLDERS_BY_ENUM.keys(), c):
+                reference_netscape_write_node(c, fp_out, cull_special, cull_attr, depth+1)
+        print("%s</DL><p>" % indent, file=fp_out)
+
+def reference_netscape_write(root, fp_out, cull_special, cull_attr):
+    print("<!DOCTYPE %s>" % netscape_html.DOCTYPE, file=fp_out)
+    print('<META HTTP-EQUIV="Content-Type" CONTENT="text/html; charset=UTF-8">', file=fp_out)
+    reference_netscape_write_node(root, fp_out, cull_special, cull_attr, 0)
+
+def reference_xbel_write(root, fp_out, cull_special, cull_attr):
+    w = xbel.to_ast(root, cull_special, cull_attr)
+    ET.indent(w)
+    ET.ElementTree(w).write(fp_out, encoding="unicode", xml_declaration=True, short_empty_elements=False)
+
+def reference_bkmk_json_write(root, fp_out, _cull_special, _cull_attr):
+    json.dump(bkmk_json.to_ast(root), fp_out, indent=2)
+
+def reference_chrome_json_write(root, fp_out, cull_special, _cull_attr):
+    w = {"version": chrome_json.SUPPORTED_VERSION, "roots": {}}
+    is_special = lambda c: isinstance(c, Folder) and c.special is not None
+    for r in root.children:
+        if is_special(r):
+            w["roots"][chrome_json.SPECIAL_FOLDERS_BY_ENUM[r.special]] = chrome_json.to_ast(r, cull_special)
+    rest = Folder(root.id, root.date_added, root.name, root.icon, root.date_modified,
+        [c for c in root.children if not is_special(c)], root.special)
+    w["roots"]["synced"] = chrome_json.to_ast(rest, cull_special)
+    json.dump(w, fp_out, indent=2)
+
+WRITERS = [
+    ("netscape-html", reference_netscape_write, lambda root, fp_out, cs, ca, bs: netscape_html.NetscapeHTMLWriter(fp_out, cs, ca, bs).write(root)),
+    ("xbel", reference_xbel_write, lambda root, fp_out, cs, ca, bs: xbel.XBELWriter(fp_out, cs, ca, bs).write(root)),
+    ("bkmk-json", reference_bkmk_json_write, bkmk_json.write),
+    ("chrome-json", reference_chrome_json_write, chrome_json.write),
+]
+
+def test_writers(arg):
+    with open(arg) as fp_in:
+        bm = Bookmarks.read(fp_in, guess_format(arg))
+    for (cull_special, cull_attr) in itertools.product((False, True), repeat=2):
+        for (fmt, reference_write, write) in WRITERS:
+            expected = io.StringIO()
+            reference_write(bm.root, expected, cull_special, cull_attr)
+            for bufsize in (1, DEFAULT_WRITE_BUFSIZE):
+                actual = io.StringIO()
+                write(bm.root, actual, cull_special, cull_attr, bufsize)
+                if actual.getvalue() != expected.getvalue():
+                    print("FAILED:", arg, fmt, "writer differs from reference", cull_special, cull_attr, bufsize)
+                    return False
+    return True
+
+def _event_key(ev):
+    (event, node, depth) = ev
+    # folders from a stream don't have their children
+    return (event, depth, dataclasses.replace(node, children=[]) if isinstance(node, Folder) else node)
+
+def test_events(arg):
+    fmt = guess_format(arg)
+    with open(arg) as fp_in:
+        bm = Bookmarks.read(fp_in, fmt)
+    expected = list(map(_event_key, walk(bm.root)))
+    with open(arg) as fp_in:
+        if list(map(_event_key, read_events(fp_in, fmt))) != expected:
+            print("FAILED:", arg, "events differ from walking the tree")
+            return False
+    if fmt == "netscape-html":
+        with open(arg) as fp_in:
+            if list(map(_event_key, bkmk.netscape_html.events(fp_in, 7))) != expected:
+                print("FAILED:", arg, "events differ from walking the tree", 7)
+                return False
+    bm.normalize(fill_timestamps=True, prefix_ids="x-", ts=1234)
+    for (cull_special, cull_attr) in itertools.product((False, True), repeat=2):
+        for fmt_out in FORMATS:
+            expected = new_buffer(fmt_out)
+            bm.write(expected, fmt_out, cull_special, cull_attr)
+            actual = new_buffer(fmt_out)
+            with open(arg) as fp_in:
+                events = normalize_events(read_events(fp_in, fmt), True, "x-", 1234)
+                write_events(events, actual, fmt_out, cull_special, cull_attr)
+            if actual.getvalue() != expected.getvalue():
+                print("FAILED:", arg, fmt_out, "streaming write differs", cull_special, cull_attr)
+                return False
+    return True
+
+def test_stream():
+    # text after a subfolder, and far enough after the folder's start that
+    # it has been streamed out by then
+    text = """<!DOCTYPE NETSCAPE-Bookmark-file-1>
+<TITLE>Bookmarks</TITLE><H1>Bookmarks</H1>
+<DL><p>
+<DT><H3>Folder</H3>
+<DL><p>
+<DT><H3>Sub</H3>
+<DL><p>
+%s</DL><p>
+stray
+</DL><p>
+</DL><p>
+""" % "".join('<DT><A HREF="http://example.com/%d">%d</A>\n' % (i, i) for i in range(5000))
+    tree = io.StringIO()
+    Bookmarks.read(io.StringIO(text), "netscape-html").write(tree, "xbel")
+    for stream in (False, True):
+        actual = io.StringIO()
+        convert(io.StringIO(text), "netscape-html", actual, "xbel", stream=stream)
+        expected = tree.getvalue() if not stream else tree.getvalue().replace("Folderstray", "Folder")
+        if actual.getvalue() != expected:
+            print("FAILED: convert differs from the tree, stream:", stream)
+            return False
+    # partial output is only left behind when streaming
+    truncated = text[:len(text) // 2]
+    for stream in (False, True):
+        actual = io.StringIO()
+        try:
+            convert(io.StringIO(truncated), "netscape-html", actual, "xbel", stream=stream)
+            print("FAILED: convert of malformed input did not fail, stream:", stream)
+            return False
+        except ValueError:
+            pass
+        if bool(actual.getvalue()) != stream:
+            print("FAILED: convert of malformed input wrote wrongly, stream:", stream, len(actual.getvalue()))
+            return False
+    return True
+
+def _reread(bm, fmt):
+    fp = new_buffer(fmt)
+    bm.write(fp, fmt)
+    fp.seek(0)
+    return (fp, fmt)
+
+def test_write_many(arg):
+    with open(arg) as fp_in:
+        bm = Bookmarks.read(fp_in, guess_format(arg))
+    before = copy.deepcopy(bm)
+    outputs = [(fmt, {"cull_special": cs, "cull_attr": ca})
+        for fmt in FORMATS for (cs, ca) in itertools.product((False, True), repeat=2)]
+    expected = []
+    for (fmt, opts) in outputs:
+        expected.append(new_buffer(fmt))
+        bm.write(expected[-1], fmt, **opts)
+    for parallel in (None, "threads", "processes"):
+        actual = [new_buffer(fmt) for (fmt, _) in outputs]
+        bm.write_many([(fp, fmt, opts) for (fp, (fmt, opts)) in zip(actual, outputs)], parallel)
+        for (a, e, (fmt, opts)) in zip(actual, expected, outputs):
+            if a.getvalue() != e.getvalue():
+                print("FAILED:", arg, fmt, "write_many differs", parallel, opts)
+                return False
+    # compressed, which is bytes whatever the format
+    for parallel in (None, "threads", "processes"):
+        actual = [io.BytesIO() for _ in FORMATS]
+        bm.write_many([(fp, fmt, {"compression": "gzip"}) for (fp, fmt) in zip(actual, FORMATS)], parallel)
+        for (fp, fmt) in zip(actual, FORMATS):
+            fp.seek(0)
+            if Bookmarks.read(fp, fmt, compression="gzip") != Bookmarks.read(*_reread(bm, fmt)):
+                print("FAILED:", arg, fmt, "compressed write_many differs", parallel)
+                return False
+    # real files, in an encoding the writers have to declare
+    import os
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = [os.path.join(tmp, "%d%s" % (i, format_ext(fmt))) for (i, (fmt, _)) in enumerate(outputs)]
+        expected = None
+        for parallel in (None, "threads", "processes"):
+            with contextlib.ExitStack() as stack:
+                fps = [stack.enter_context(open(path, "wb") if is_binary(fmt) else open(path, "w", encoding="utf-16"))
+                    for (path, (fmt, _)) in zip(paths, outputs)]
+                bm.write_many([(fp, fmt, opts) for (fp, (fmt, opts)) in zip(fps, outputs)], parallel)
+            actual = []
+            for path in paths:
+                with open(path, "rb") as fp:
+                    actual.append(fp.read())
+            if expected is None:
+                expected = actual
+            elif actual != expected:
+                print("FAILED:", arg, "write_many to files differs", parallel)
+                return False
+            for (path, (fmt, opts)) in zip(paths, outputs):
+                if fmt != "xbel": continue
+                # it declares the encoding, so must read back the same
+                sio = io.StringIO()
+                bm.write(sio, fmt, **opts)
+                sio.seek(0)
+                with open(path, "rb") as fp:
+                    if Bookmarks.read(fp, fmt) != Bookmarks.read(sio, fmt):
+                        print("FAILED:", arg, "write_many to files reads back differently", parallel)
+                        return False
+    if bm != before:
+        print("FAILED:", arg, "write_many modified the tree")
+        return False
+    return True
+
+def test_write_many_lazy():
+    # each folder of a lazily read tree loads on whichever thread reaches it first
+    root = Folder.new()
+    for i in range(200):
+        root.children.append(Folder("", None, "f%d" % i, "", None, [], None))
+        for j in range(100):
+            root.children[-1].children.append(Bookmark("", None, "b%d" % j, "", None, "http://b/%d" % j, None, None))
+    fp = io.BytesIO()
+    Bookmarks(root).write(fp, "bkmk-bin")
+    for _ in range(5):
+        bm = Bookmarks.read(io.BytesIO(fp.getvalue()), "bkmk-bin")
+        actual = [io.StringIO() for _ in range(4)]
+        bm.write_many([(a, "bkmk-json", {}) for a in actual], "threads")
+        if len({a.getvalue() for a in actual}) != 1:
+            print("FAILED: write_many on threads of a lazily read tree differs")
+            return False
+    return True
+
+def _index_state(index):
+    return (
+        {k: id(v) for (k, v) in index.by_id.items()},
+        {k: list(map(id, v)) for (k, v) in index.by_url.items()},
+        {k: id(v) for (k, v) in index.parents.items()},
+        {k: list(map(id, v)) for (k, v) in index.dups.items()},
+    )
+
+def test_index(arg):
+    with open(arg) as fp_in:
+        bm = Bookmarks.read(fp_in, guess_format(arg))
+    nodes = []
+    parents = {}
+    def visit(node):
+        nodes.append(node)
+        if isinstance(node, Folder):
+            for c in node.children:
+                parents[id(c)] = node
+    bm.root.map_mut(visit)
+    index = bm.index
+    for node in nodes:
+        if node.id and index.get_id(node.id) is not next(n for n in nodes if n.id == node.id):
+            print("FAILED:", arg, "index by id is wrong", node.id)
+            return False
+        if isinstance(node, Bookmark) and list(map(id, index.get_url(node.url))) != [
+            id(n) for n in nodes if isinstance(n, Bookmark) and n.url == node.url]:
+            print("FAILED:", arg, "index by url is wrong", node.url)
+            return False
+        path = index.path(node)
+        if index.parent(node) is not parents.get(id(node)) or (path and path[0] is not bm.root):
+            print("FAILED:", arg, "index parent is wrong", node.id)
+            return False
+    dups = {k: [n for n in nodes if n.id == k] for k in set(n.id for n in nodes if n.id)}
+    if {k: list(map(id, v)) for (k, v) in dups.items() if len(v) > 1} != _index_state(index)[3]:
+        print("FAILED:", arg, "index duplicate ids are wrong")
+        return False
+    # mutations keep the index up to date
+    for (fill_special, fill_ids, prefix_ids) in itertools.product((False, True), (False, True), ("", "x-")):
+        with open(arg) as fp_in:
+            bm = Bookmarks.read(fp_in, guess_format(arg))
+        bm.index
+        bm.normalize(fill_special=fill_special, fill_ids=fill_ids, prefix_ids=prefix_ids)
+        kept = _index_state(bm.index)
+        bm.invalidate_index()
+        if kept != _index_state(bm.index):
+            print("FAILED:", arg, "index differs after normalize", fill_special, fill_ids, prefix_ids)
+            return False
+    return True
+
+def test_merge(arg):
+    with open(arg) as fp_in:
+        bm = Bookmarks.read(fp_in, guess_format(arg))
+    before = copy.deepcopy(bm)
+    urls = []
+    bm.root.map_mut(lambda n: urls.append(n.url) if isinstance(n, Bookmark) else None)
+    for dedup in DEDUP_KEYS:
+        merged = Bookmarks.new()
+        merged.merge(bm, bm, dedup=dedup)
+        merged_urls = []
+        merged.root.map_mut(lambda n: merged_urls.append(n.url) if isinstance(n, Bookmark) else None)
+        if dedup == "url" and sorted(merged_urls) != sorted(set(urls)):
+            print("FAILED:", arg, "merge did not dedup by url")
+            return False
+        if dedup is None and sorted(merged_urls) != sorted(urls * 2):
+            print("FAILED:", arg, "merge without dedup lost bookmarks")
+            return False
+        kept = _index_state(merged.index)
+        merged.invalidate_index()
+        if kept != _index_state(merged.index):
+            print("FAILED:", arg, "index differs after merge", dedup)
+            return False
+    # merging a tree into itself changes nothing
+    for strategy in MERGE_STRATEGIES:
+        merged = copy.deepcopy(bm)
+        merged.merge(bm, strategy=strategy)
+        if merged != before:
+            print("FAILED:", arg, "merging with itself is not a no-op", strategy)
+            return False
+    if bm != before:
+        print("FAILED:", arg, "merge modified its input")
+        return False
+    return True
+
+def test_merge_strategy():
+    def tree(name, date_modified):
+        return Bookmarks(Folder("", None, "", "", None, [
+            Folder("", None, "a", "", None, [
+                Bookmark("", 5, name, "", date_modified, "https://example.com/", None, None),
+            ], None),
+        ], None))
+    for (strategy, expected) in (("newest", "new"), ("first", "old"), ("last", "none")):
+        merged = tree("old", 100)
+        merged.merge(tree("new", 200), tree("none", None), strategy=strategy)
+        folder = merged.root.children
+        if len(folder) != 1 or len(folder[0].children) != 1 or folder[0].children[0].name != expected:
+            print("FAILED: merge strategy", strategy, merged)
+            return False
+    return True
+
+def _mutate(bm, seed):
+    """Make random changes of every kind that a patch can describe"""
+    import random
+    rng = random.Random(seed)
+    nodes = []
+    bm.root.map_mut(nodes.append)
+    folders = [n for n in nodes if isinstance(n, Folder)]
+    for _ in range(max(3, len(nodes) // 10)):
+        folder = rng.choice(folders)
+        if not folder.children: continue
+        i = rng.randrange(len(folder.children))
+        what = rng.randrange(5)
+        if what == 0:
+            del folder.children[i]
+        elif what == 1:
+            folder.children.insert(i, Bookmark("", 1, "new", "", None, "https://example.com/%d" % rng.random(), None, None))
+        elif what == 2:
+            node = folder.children.pop(i)
+            target = rng.choice(folders)
+            # don't move a folder into itself
+            if isinstance(node, Folder) and any(n is target for n in preorder(node)):
+                target = bm.root
+            target.children.insert(rng.randint(0, len(target.children)), node)
+        elif what == 3:
+            folder.children[i].date_added = 42
+        else:
+            folder.children.reverse()
+
+def test_hash(arg):
+    with open(arg) as fp_in:
+        bm = Bookmarks.read(fp_in, guess_format(arg), fill_ids=True)
+    other = copy.deepcopy(bm)
+    if bm.hash() != other.hash():
+        print("FAILED:", arg, "hash differs for a copy")
+        return False
+    nodes = []
+    other.root.map_mut(nodes.append)
+    for node in nodes[1::max(1, len(nodes) // 5)]:
+        before = other.hash()
+        date_added = node.date_added
+        node.date_added = (date_added or 0) + 1
+        other.index.changed(node)
+        after = other.hash()
+        if after == before or after != TreeIndex(other.root).hash():
+            print("FAILED:", arg, "hash not updated after a change", node.id)
+            return False
+        # unchanged subtrees keep their hash
+        for c in nodes:
+            if not any(n is node for n in preorder(c)) and other.index.hash(c) != bm.index.hash(bm.index.get_id(c.id)):
+                print("FAILED:", arg, "hash of an unchanged subtree differs", c.id)
+                return False
+        node.date_added = date_added
+        other.index.changed(node)
+        if other.hash() != bm.hash():
+            print("FAILED:", arg, "hash differs after undoing a change", node.id)
+            return False
+    return True
+
+def test_diff(args):
+    trees = []
+    for arg in args:
+        with open(arg) as fp_in:
+            trees.append(Bookmarks.read(fp_in, guess_format(arg)))
+    for (i, a) in enumerate(trees):
+        mutated = copy.deepcopy(a)
+        _mutate(mutated, i)
+        # against itself, a changed copy, and the next file
+        for b in (a, mutated, trees[(i + 1) % len(trees)]):
+            # with hashes, equal subtrees may be matched differently
+            for patch in (a.diff(b), bkmk.diff.diff(a.root, b.root)):
+                if b is a and patch.ops:
+                    print("FAILED:", args[i], "diff against itself is not empty", patch.ops[:3])
+                    return False
+                patched = copy.deepcopy(a)
+                patched.apply_patch(Patch.from_json(json.loads(json.dumps(patch.to_json()))))
+                if patched != b:
+                    print("FAILED:", args[i], "applying diff does not give the other tree", patch.summary())
+                    return False
+        # changed directly after being hashed, without telling the index
+        if not a.root.children: continue
+        edited = copy.deepcopy(a)
+        edited.hash()
+        edited.root.children[0].name += " CHANGED"
+        if not a.diff(edited).ops or not edited.diff(a).ops or a._debug_eq(edited, lambda *_: False, lambda children, _: children):
+            print("FAILED:", args[i], "a direct change after hashing was not seen")
+            return False
+    return True
+
+def test_batch(args):
+    import bkmk.__main__
+    import filecmp
+    import os
+    import shutil
+    import tempfile
+    with tempfile.TemporaryDirectory() as out_dir:
+        summary_path = os.path.join(out_dir, "summary.json")
+        # the same stem twice, and a missing file, must fail without stopping the others
+        inputs = [a for a in args if not a.endswith(".json")] + ["missing.xbel"]
+        argv = ["--batch", "-j", "2", "--out-dir", out_dir, "--summary", summary_path, "-t", "bkmk-json", *inputs]
+        rc = bkmk.__main__._real_main("bkmk", *argv)
+        with open(summary_path) as fp:
+            summary = json.load(fp)
+        if rc != 1 or [r["input"] for r in summary["files"]] != inputs or summary["files"][-1]["ok"]:
+            print("FAILED: batch summary is wrong", rc, summary)
+            return False
+        outputs = set()
+        for r in summary["files"][:-1]:
+            if r["ok"] == (r["output"] in outputs):
+                print("FAILED: batch conversion failed", r)
+                return False
+            if not r["ok"]: continue
+            outputs.add(r["output"])
+            with open(r["input"]) as fp:
+                expected = io.StringIO()
+                convert(fp, guess_format(r["input"]), expected, "bkmk-json")
+            with open(r["output"]) as fp:
+                if fp.read() != expected.getvalue():
+                    print("FAILED:", r["input"], "batch output differs")
+                    return False
+        if any(name.startswith(".tmp-") for name in os.listdir(out_dir)):
+            print("FAILED: batch left temporary files behind", os.listdir(out_dir))
+            return False
+        # an output that would overwrite its own input must fail, leaving the input alone
+        path_in = os.path.join(out_dir, "a.xbel")
+        shutil.copyfile("data/test.xbel", path_in)
+        argv = ["--batch", "--out-dir", out_dir, "--summary", summary_path, "-t", "xbel", path_in]
+        rc = bkmk.__main__._real_main("bkmk", *argv)
+        with open(summary_path) as fp:
+            summary = json.load(fp)
+        if rc != 1 or summary["files"][0]["ok"] or not filecmp.cmp("data/test.xbel", path_in, shallow=False):
+            print("FAILED: batch overwrote its input", rc, summary)
+            return False
+    return True
+
+def test_cache(args):
+    import os
+    import shutil
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = ReadCache(os.path.join(tmp, "cache"))
+        def read(path, **opts):
+            with open(path) as fp_in:
+                return Bookmarks.read(fp_in, guess_format(path), **opts, cache=cache)
+        for arg in args:
+            with open(arg) as fp_in:
+                expected = Bookmarks.read(fp_in, guess_format(arg), fill_ids=True)
+            # parsed, then from the cache; then by content, after a copy
+            copied = os.path.join(tmp, os.path.basename(arg))
+            shutil.copyfile(arg, copied)
+            # other read options are cached apart
+            for (path, opts, hit) in ((arg, True, False), (arg, True, True), (copied, True, True), (arg, False, False)):
+                (cache.hits, cache.misses) = (0, 0)
+                bm = read(path, fill_ids=opts)
+                if (cache.hits, cache.misses) != ((1, 0) if hit else (0, 1)):
+                    print("FAILED:", arg, "cached read hit or missed wrongly", path, opts, cache.hits, cache.misses)
+                    return False
+                if opts and bm != expected:
+                    print("FAILED:", arg, "cached read differs")
+                    return False
+            # a damaged entry, here cut off inside its strings, is parsed again
+            for name in os.listdir(cache.cache_dir):
+                if name.endswith(bkmk.cache.ENTRY_SUFFIX):
+                    with open(os.path.join(cache.cache_dir, name), "r+b") as fp:
+                        fp.truncate(os.fstat(fp.fileno()).st_size - 1)
+            (cache.hits, cache.misses) = (0, 0)
+            with contextlib.redirect_stderr(io.StringIO()):
+                bm = read(arg, fill_ids=True)
+            if (cache.hits, cache.misses) != (0, 1) or bm != expected:
+                print("FAILED:", arg, "damaged cache entry used", cache.hits, cache.misses)
+                return False
+        # with a limit this small, every file is evicted
+        cache.max_bytes = 1
+        cache.evict()
+        if os.listdir(cache.cache_dir):
+            print("FAILED: cache not evicted", os.listdir(cache.cache_dir))
+            return False
+    return True
+
+def test_icons(arg):
+    fmt = guess_format(arg)
+    with open(arg) as fp_in:
+        bm = Bookmarks.read(fp_in, fmt)
+    seen = {}
+    for node in preorder(bm.root):
+        if isinstance(node, Separator): continue
+        if seen.setdefault(node.icon, node.icon) is not node.icon:
+            print("FAILED:", arg, "equal icons not shared")
+            return False
+    counts = bm.icon_refcounts()
+    expected = {}
+    for node in preorder(bm.root):
+        if not isinstance(node, Separator) and node.icon:
+            expected[node.icon] = expected.get(node.icon, 0) + 1
+    if counts != expected:
+        print("FAILED:", arg, "icon refcounts differ")
+        return False
+    for icon in counts:
+        if icon.startswith("data:image/") and ";base64," in icon and icon_data(icon) is None:
+            print("FAILED:", arg, "icon could not be decoded", icon[:40])
+            return False
+    with open(arg) as fp_in:
+        dropped = Bookmarks.read(fp_in, fmt, drop_icons=True)
+    if dropped.icon_refcounts():
+        print("FAILED:", arg, "icons not dropped")
+        return False
+    for node in preorder(bm.root):
+        if not isinstance(node, Separator):
+            node.icon = ""
+    if dropped != bm:
+        print("FAILED:", arg, "dropping icons changed more than icons")
+        return False
+    return True
+
+def test_bin(arg):
+    import os
+    import tempfile
+    with open(arg) as fp_in:
+        bm = Bookmarks.read(fp_in, guess_format(arg))
+    fp = io.BytesIO()
+    bm.write(fp, "bkmk-bin")
+    mmap_min_size = bkmk_bin.MMAP_MIN_SIZE
+    with tempfile.TemporaryFile() as fp_file, contextlib.ExitStack() as stack:
+        fp_file.write(fp.getvalue())
+        fp_file.seek(0)
+        # from a real file through mmap, however small, and from memory
+        bkmk_bin.MMAP_MIN_SIZE = 0
+        stack.callback(setattr, bkmk_bin, "MMAP_MIN_SIZE", mmap_min_size)
+        for fp_in in (fp_file, io.BytesIO(fp.getvalue())):
+            read = Bookmarks.read(fp_in, "bkmk-bin")
+            if bm.root.children and read.root.children._loader is None:
+                print("FAILED:", arg, "bkmk-bin read children eagerly")
+                return False
+            if read != bm:
+                print("FAILED:", arg, "bkmk-bin roundtrip differs")
+                return False
+            fp_in.seek(0)
+            if Bookmarks.read(fp_in, "bkmk-bin") != Bookmarks.read(io.BytesIO(fp.getvalue()), "bkmk-bin"):
+                print("FAILED:", arg, "bkmk-bin reads differ from each other")
+                return False
+            expected = io.StringIO()
+            bm.write(expected, "bkmk-json")
+            actual = io.StringIO()
+            fp_in.seek(0)
+            Bookmarks.read(fp_in, "bkmk-bin").write(actual, "bkmk-json")
+            if actual.getvalue() != expected.getvalue():
+                print("FAILED:", arg, "bkmk-bin to bkmk-json differs")
+                return False
+    # read, changed and written back to the same file, which a small file,
+    # being read into memory, can be while the tree is still lazy
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "a.bkmk.bin")
+        with open(path, "wb") as fp_out:
+            bm.write(fp_out, "bkmk-bin")
+        with open(path, "rb") as fp_in:
+            changed = Bookmarks.read(fp_in, "bkmk-bin")
+        changed.root.children.append(Bookmark("", None, "new", "", None, "http://new/", None, None))
+        with open(path, "wb") as fp_out:
+            changed.write(fp_out, "bkmk-bin")
+        with open(path, "rb") as fp_in:
+            if Bookmarks.read(fp_in, "bkmk-bin").root.children[-1].name != "new":
+                print("FAILED:", arg, "bkmk-bin rewritten in place differs")
+                return False
+    # damage is found once the damaged part is reached, never read past
+    data = fp.getvalue()
+    reader = bkmk_bin.BinaryReader(data, None)
+    damaged = [data[:-1], data + b"\0", data[:reader.nodes_at] + b"\7" + data[reader.nodes_at + 1:]]
+    if reader.offsets_at > reader.children_at:
+        at = reader.children_at
+        damaged.append(data[:at] + struct.pack("<I", reader.node_count) + data[at + 4:])
+        damaged.append(data[:at] + struct.pack("<I", 0) + data[at + 4:])
+    if reader.string_count > 1:
+        at = reader.offsets_at + 8
+        damaged.append(data[:at] + struct.pack("<Q", reader.pool_size + 1) + data[at + 8:])
+    for d in damaged:
+        try:
+            for _ in preorder(Bookmarks.read(io.BytesIO(d), "bkmk-bin").root): pass
+        except ValueError:
+            continue
+        print("FAILED:", arg, "damaged bkmk-bin read without an error")
+        return False
+    return True
+
+def test_compression(arg):
+    import bkmk.__main__
+    import os
+    import subprocess
+    import tempfile
+    fmt = guess_format(arg)
+    with open(arg) as fp_in:
+        bm = Bookmarks.read(fp_in, fmt)
+    for compression in ("gzip", "bz2", "xz", ["xz", "gzip"]):
+        fp = io.BytesIO()
+        bm.write(fp, fmt, compression=compression)
+        for how in (compression, "auto"):
+            fp.seek(0)
+            if Bookmarks.read(fp, fmt, compression=how) != bm:
+                print("FAILED:", arg, "compressed roundtrip differs", compression, how)
+                return False
+        # stacked, the outermost is undone first
+        fp.seek(0)
+        if bkmk.compression.detect(fp) != ([compression] if isinstance(compression, str) else compression):
+            print("FAILED:", arg, "wrong compression detected", compression)
+            return False
+    with tempfile.TemporaryDirectory() as tmp:
+        stem = os.path.join(tmp, os.path.basename(arg))
+        expected = io.StringIO()
+        bm.write(expected, "bkmk-json")
+        for (path_in, path_out) in ((arg, stem + ".bz2"), (stem + ".bz2", stem + ".bkmk.json.gz.xz")):
+            if bkmk.__main__._real_main("bkmk", path_in, path_out) != 0:
+                print("FAILED:", arg, "converting", path_in, path_out)
+                return False
+        with open(stem + ".bkmk.json.gz.xz", "rb") as fp:
+            compressed = fp.read()
+        # and from stdin, by the magic bytes
+        out = subprocess.run([sys.executable, "-m", "bkmk", "-f", "bkmk-json", "-t", "bkmk-json"],
+            input=compressed, capture_output=True, check=True).stdout
+        if out.decode() != expected.getvalue():
+            print("FAILED:", arg, "compressed stdin read differs")
+            return False
+    return True
+
+def test_binary_read(arg):
+    import codecs
+    import mmap
+    fmt = guess_format(arg)
+    fmt_module = bkmk._format_module(fmt)
+    with open(arg) as fp_in:
+        expected = Bookmarks.read(fp_in, fmt)
+    with open(arg, "rb") as fp_in:
+        data = fp_in.read()
+        with mmap.mmap(fp_in.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            if Bookmarks.read(buf, fmt) != expected:
+                print("FAILED:", arg, "mmap read differs")
+                return False
+    # the same in other encodings, as each format declares them
+    text = data.decode("utf-8")
+    encoded = [data]
+    if fmt in ("bkmk-json", "chrome-json"):
+        encoded += [codecs.BOM_UTF8 + data, text.encode("utf-16"), text.encode("utf-32-be")]
+    elif fmt == "netscape-html":
+        encoded.append(codecs.BOM_UTF8 + data)
+        declared = text.replace("charset=UTF-8", "charset=windows-1252")
+        try:
+            if declared != text:
+                encoded.append(declared.encode("cp1252"))
+        except UnicodeEncodeError:
+            # not all of it fits
+            pass
+    elif fmt == "xbel":
+        encoded.append(text.replace('encoding="UTF-8"', 'encoding="UTF-16"').encode("utf-16"))
+    for (i, b) in enumerate(encoded):
+        for bufsize in ((1, 7, -1) if fmt != "xbel" else (None,)):
+            opts = {"bufsize": bufsize} if bufsize is not None else {}
+            if fmt_module.read(io.BytesIO(b), **opts) != expected.root:
+                print("FAILED:", arg, "binary read differs, encoding:", i, "bufsize:", bufsize)
+                return False
+        events = list(fmt_module.events(io.BytesIO(b)))
+        if [(e, n.id, d) for (e, n, d) in events] != [(e, n.id, d) for (e, n, d) in walk(expected.root)]:
+            print("FAILED:", arg, "binary events differ, encoding:", i)
+            return False
+    return True
+
+def test_columnar(arg):
+    with open(arg) as fp_in:
+        bm = Bookmarks.read(fp_in, guess_format(arg), fill_special=True, fill_ids=True)
+    columns = bm.to_columnar()
+    if Bookmarks.from_columnar(columns) != bm:
+        print("FAILED:", arg, "columnar roundtrip differs")
+        return False
+    added = []
+    bm.root.map_mut(lambda n: added.append(n.date_added))
+    for (start, end) in ((None, None), (0, None), (None, 1234), (1000, 2000000000000000)):
+        expected = [i for (i, t) in enumerate(added)
+            if t is not None and (start is None or start <= t) and (end is None or t < end)]
+        if list(columns.select("date_added", start, end)) != expected:
+            print("FAILED:", arg, "columnar select differs")
+            return False
+    columns.fill_timestamps(1234)
+    columns.prefix_ids("x-")
+    bm.fill_timestamps(1234)
+    bm.prefix_ids("x-")
+    if Bookmarks.from_columnar(columns) != bm:
+        print("FAILED:", arg, "columnar operations differ")
+        return False
+    if list(columns.select("date_added", 1234, 1235)) != [i for (i, t) in enumerate(added) if t is None or t == 1234]:
+        print("FAILED:", arg, "columnar select differs after fill_timestamps")
+        return False
+    return True
+
+# the sequential normalisation, as it was before Bookmarks.normalize
+def reference_normalize(bm, fill_special, fill_ids, fill_timestamps, prefix_ids, ts):
+    root = bm.root
+    if fill_special:
+        rem = dict(FOLDER_DEFAULT_NAMES)
+        root_name = rem.pop(None)
+        if not root.name:
+            root.name = root_name
+        root.map_mut(lambda n: rem.pop(n.special, None) if isinstance(n, Folder) else None)
+        root.children = [Folder("", None, name, "", None, [], special) for (special, name) in rem.items()] + root.children
+    if fill_ids:
+        max_id = [bkmk._to_numid("")]
+        root.map_mut(lambda n: max_id.__setitem__(0, max(max_id[0], bkmk._to_numid(n.id))))
+        next_id = [max_id[0][0] + 1]
+        def fill_id(n):
+            if not n.id:
+                n.id = str(next_id[0])
+                next_id[0] += 1
+        root.map_mut(fill_id)
+    if fill_timestamps:
+        root.map_mut(functools.partial(bkmk._fill_timestamp, ts))
+    if prefix_ids:
+        root.map_mut(functools.partial(bkmk._prefix_id, prefix_ids))
+
+def test_normalize(arg):
+    fmt = guess_format(arg)
+    for (fill_special, fill_ids, fill_timestamps, prefix) in itertools.product((False, True), repeat=4):
+        args = (fill_special, fill_ids, fill_timestamps, "x-" if prefix else "", 1234)
+        with open(arg) as fp_in:
+            expected = Bookmarks.read(fp_in, fmt)
+        reference_normalize(expected, *args)
+        with open(arg) as fp_in:
+            bm = Bookmarks.read(fp_in, fmt)
+        bm.normalize(*args)
+        if bm != expected:
+            print("FAILED:", arg, "normalize differs from sequential", args)
+            return False
+    return True
+
+def test_xbel_read(arg):
+    with open(arg) as fp_in:
+        expected = xbel.from_ast(ET.parse(fp_in).getroot())
+    with open(arg) as fp_in:
+        if xbel.read(fp_in) != expected:
+            print("FAILED:", arg, "incremental xbel read differs from from_ast")
+            return False
+    return True
+
+def test_deep_xbel_read():
+    depth = sys.getrecursionlimit() * 2
+    text = '<xbel version="1.0">' + "<folder><title>x</title>" * depth + "</folder>" * depth + "</xbel>"
+    node = xbel.read(io.StringIO(text))
+    for _ in range(depth):
+        node, = node.children
+    return not node.children
+
+def test_timestamps():
+    import datetime
+    import random
+    from bkmk import timestamps
+    rng = random.Random(0)
+    values = [None, 0, -1, 1, -1000000, 1669148785067968, 1669148785000000] + [rng.randrange(-10**16, 10**16) for _ in range(1000)]
+    for codec in (timestamps.ISO_8601, timestamps.UNIX_SECONDS, timestamps.WINDOWS_MICROS):
+        # twice, the second time memoised
+        for _ in range(2):
+            encoded = codec.encode_many(values)
+            decoded = codec.decode_many(encoded)
+            expected = values if codec is not timestamps.UNIX_SECONDS else [
+                None if v is None else int(v / 1000000) * 1000000 for v in values]
+            if decoded != expected:
+                print("FAILED: timestamps differ after roundtrip", [(v, d) for (v, d) in zip(expected, decoded) if v != d][:5])
+                return False
+    epoch = datetime.datetime(1970, 1, 1)
+    for v in values[1:]:
+        if timestamps.ISO_8601.encode(v) != (epoch + datetime.timedelta(microseconds=v)).isoformat() + "Z":
+            print("FAILED: ISO 8601 timestamp differs from datetime", v, timestamps.ISO_8601.encode(v))
+            return False
+    if timestamps.ISO_8601.decode("2022-11-22T21:26:25.067968+01:00") != 1669148785067968:
+        print("FAILED: ISO 8601 timestamp with offset decoded wrongly")
+        return False
+    return True
+
+def test_import_time():
+    # importing bkmk must not import any format, nor what they need
+    import subprocess
+    lazy = {"bkmk.bkmk_json", "bkmk.bkmk_bin", "bkmk.xbel", "bkmk.chrome_json", "bkmk.netscape_html",
+        "json", "xml.etree.ElementTree", "html.parser", "importlib.metadata", "concurrent.futures",
+        "gzip", "bz2", "lzma"}
+    # nor the command line, before it knows which formats it needs
+    for module in ("bkmk", "bkmk.__main__"):
+        out = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module],
+            capture_output=True, text=True, check=True).stderr
+        imported = {line.split("|")[-1].strip() for line in out.splitlines() if line.startswith("import time:")}
+        if imported & lazy:
+            print("FAILED: importing", module, "imported:", ", ".join(sorted(imported & lazy)))
+            return False
+    return True
+
+def test_registry():
+    import bkmk.formats
+    test_fmt = Format("test-json", "for testing", "bkmk.bkmk_json", (".test", ".json"))
+    class FakeEntryPoint:
+        name = "test"
+        def load(self):
+            return test_fmt
+    registry = bkmk.formats.FormatRegistry(bkmk.formats.BUILTIN_FORMATS)
+    entry_points = bkmk.formats._entry_points
+    bkmk.formats._entry_points = lambda: [FakeEntryPoint()]
+    try:
+        # built in formats don't need the plugins, anything else does
+        if registry.guess("a.json") != (".json", ["chrome-json", "bkmk-json"]) or registry.plugins_loaded:
+            print("FAILED: registry guessed wrongly", registry.guess("a.json"))
+            return False
+        if registry.guess("a.test") != (".test", ["test-json"]) or not registry.plugins_loaded:
+            print("FAILED: registry did not guess plugin format", registry.guess("a.test"))
+            return False
+        if registry.guess("a.json") != (".json", ["chrome-json", "bkmk-json", "test-json"]):
+            print("FAILED: registry guessed wrongly with plugins", registry.guess("a.json"))
+            return False
+        if registry.module("test-json") is not bkmk_json:
+            print("FAILED: registry loaded the wrong module")
+            return False
+    finally:
+        bkmk.formats._entry_points = entry_points
+    try:
+        registry.register(test_fmt)
+        print("FAILED: registry registered a format twice")
+        return False
+    except ValueError:
+        pass
+    if list(FORMATS) != [f.name for f in bkmk.formats.BUILTIN_FORMATS] or FORMAT_EXTS[".json"] != ["chrome-json", "bkmk-json"]:
+        print("FAILED: FORMATS or FORMAT_EXTS wrong", FORMATS, FORMAT_EXTS)
+        return False
+    return test_text_plugin()
+
+def test_text_plugin():
+    """A plugin format that only reads text is never given bytes, even through a decompressor"""
+    import bkmk.__main__
+    import bkmk.formats
+    import gzip
+    import os
+    import tempfile
+    import types
+    def read(fp_in, icons=None):
+        if not isinstance(fp_in, io.TextIOBase):
+            raise TypeError("text-xbel given a binary file")
+        return xbel.read(fp_in, icons)
+    module = types.ModuleType("bkmk_test_text_xbel")
+    (module.read, module.events, module.write, module.write_events) = (read, None, xbel.write, xbel.write_events)
+    sys.modules[module.__name__] = module
+    bkmk.formats.register_format(Format("text-xbel", "for testing", module.__name__, (".txbel",)))
+    try:
+        with open("data/test.xbel") as fp_in:
+            text = fp_in.read()
+            expected = Bookmarks.read(io.StringIO(text), "xbel")
+        if Bookmarks.read(io.BytesIO(gzip.compress(text.encode())), "text-xbel", compression="auto") != expected:
+            print("FAILED: compressed text plugin read differs")
+            return False
+        with tempfile.TemporaryDirectory() as tmp:
+            for (name, data) in (("a.txbel", text.encode()), ("a.txbel.gz", gzip.compress(text.encode()))):
+                path = os.path.join(tmp, name)
+                with open(path, "wb") as fp:
+                    fp.write(data)
+                if bkmk.__main__._real_main("bkmk", path, path + ".xbel") != 0:
+                    print("FAILED: text plugin not read by the command line", name)
+                    return False
+                with open(path + ".xbel") as fp:
+                    if Bookmarks.read(fp, "xbel") != expected:
+                        print("FAILED: text plugin read by the command line differs", name)
+                        return False
+    finally:
+        del bkmk.formats.REGISTRY.formats["text-xbel"]
+        bkmk.formats.REGISTRY.modules.pop("text-xbel", None)
+        del sys.modules[module.__name__]
+    return True
+
+def test_deep_tree():
+    depth = sys.getrecursionlimit() * 2
+    root = folder = Folder.new()
+    for _ in range(depth):
+        folder.children.append(Folder("", None, "x", "", None, [], None))
+        folder = folder.children[0]
+    folder.children.append(Separator("", None))
+    bm = Bookmarks(root)
+    bm.fill_ids()
+    bm.fill_timestamps(1234000000)
+    bm.prefix_ids("x-")
+    xc = lambda children, depth: children
+    copies = {
+        "bkmk-json ast": bkmk_json.from_ast(bkmk_json.to_ast(root)),
+        "chrome-json ast": chrome_json.from_ast(chrome_json.to_ast(root, False)),
+        "xbel ast": xbel.from_ast(xbel.to_ast(root, False, False)),
+    }
+    for fmt in FORMATS.keys():
+        fp = new_buffer(fmt)
+        bm.write(fp, fmt)
+        fp.seek(0)
+        copies[fmt] = Bookmarks.read(fp, fmt).root
+    for (name, copy) in copies.items():
+        fmt_module = bkmk._format_module(name.split()[0])
+        if not root._debug_eq(copy, functools.partial(fmt_module._roundtrip_acceptable_diff, False), xc):
+            print("FAILED: deep tree differs after", name)
+            return False
+    if Bookmarks(copies["bkmk-json"]).hash() != bm.hash():
+        print("FAILED: deep tree hash differs")
+        return False
+    return True
+
+# chrome_json.read, as it was before json_stream
+def reference_chrome_read(fp_in):
+    p = json.load(fp_in)
+    w = chrome_json.from_ast(p["roots"]["synced"], None)
+    special_children = [chrome_json.from_ast(v, chrome_json.SPECIAL_FOLDERS_BY_NAME[k]) for (k, v) in p["roots"].items() if k != "synced"]
+    w.children = special_children + w.children
+    return w
+
+def test_json_read(arg):
+    fmt = guess_format(arg)
+    fmt_module = bkmk._format_module(fmt)
+    with open(arg) as fp_in:
+        expected = bkmk_json.from_ast(json.load(fp_in)) if fmt == "bkmk-json" else reference_chrome_read(fp_in)
+    for bufsize in (1, 7, 4096, -1):
+        with open(arg) as fp_in:
+            if fmt_module.read(fp_in, bufsize) != expected:
+                print("FAILED:", arg, "incremental json read differs, bufsize:", bufsize)
+                return False
+    if fmt == "bkmk-json":
+        # keys it doesn't know are ignored, even ones holding objects
+        with open(arg) as fp_in:
+            ast = json.load(fp_in)
+        stack = [ast]
+        while stack:
+            node = stack.pop()
+            node["meta"] = {"a": 1, "b": {"type": "other"}, "c": [{"type": "folder"}]}
+            stack.extend(node.get("children", []))
+        if bkmk_json.read(io.StringIO(json.dumps(ast))) != expected:
+            print("FAILED:", arg, "incremental json read with unknown keys differs")
+            return False
+        for child in ({"a": 1}, {"type": "other"}, "x"):
+            ast["children"] = [child]
+            try:
+                bkmk_json.read(io.StringIO(json.dumps(ast)))
+            except (KeyError, TypeError, ValueError):
+                continue
+            print("FAILED:", arg, "incremental json read a child that isn't a node", child)
+            return False
+    return True
+
+def test_netscape_read(arg):
+    with open(arg) as fp_in:
+        text = fp_in.read()
+    whole = netscape_html.read(io.StringIO(text), -1)
+    for bufsize in (1, 7, 4096):
+        if netscape_html.read(io.StringIO(text), bufsize) != whole:
+            print("FAILED:", arg, "chunked read differs, bufsize:", bufsize)
+            return False
+    parser = netscape_html.NetscapeFastParser()
+    parser.parse(text)
+    if parser.result != whole:
+        print("FAILED:", arg, "fast engine differs")
+        return False
+    return True
+
 def main(_, *argv):
-    r = []
+    r = [test_import_time(), test_stream(), test_registry(), test_timestamps(), test_deep_xbel_read(), test_deep_tree(), test_merge_strategy(), test_diff(argv), test_batch(argv), test_cache(argv), test_write_many_lazy()]
     for arg in argv:
+        if guess_format(arg) == "xbel":
+            r.append(test_xbel_read(arg))
+        if guess_format(arg) == "netscape-html":
+            r.append(test_netscape_read(arg))
+        if guess_format(arg) in ("bkmk-json", "chrome-json"):
+            r.append(test_json_read(arg))
+        r.append(test_writers(arg))
+        r.append(test_events(arg))
+        r.append(test_bin(arg))
+        r.append(test_compression(arg))
+        r.append(test_binary_read(arg))
+        r.append(test_icons(arg))
+        r.append(test_write_many(arg))
+        r.append(test_index(arg))
+        r.append(test_merge(arg))
+        r.append(test_hash(arg))
+        r.append(test_columnar(arg))
+        r.append(test_normalize(arg))
         r.append(test_roundtrip(arg))
     return 0 if all(r) else 1
 